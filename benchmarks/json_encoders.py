@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+benchmarks.json_encoders
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+JSON encoders cost on `get_data` payloads of different sizes
+
+    python benchmarks/json_encoders.py
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado.escape
+from tornado.escape import utf8
+
+from httphq.encoders import JSON_ENCODERS
+
+HEADERS = {"Host": "h.wrttn.me",
+           "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/115.0",
+           "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+           "Accept-Language": "en-US,en;q=0.5",
+           "Accept-Encoding": "gzip, deflate",
+           "Connection": "keep-alive"}
+
+
+def get_data(args=0, headers=0, body=None):
+    data = {'args': dict(("arg%d" % i, ["value %d" % i]) for i in range(args)),
+            'headers': dict(HEADERS, **dict(("X-Header-%d" % i, "value %d" % i) for i in range(headers))),
+            'ip': "127.0.0.1",
+            'url': "http://h.wrttn.me/get",
+            'request_time': 0.000123,
+            'start_time': time.time()}
+    if body is not None:
+        data['body'] = body
+        data['files'] = {}
+    return data
+
+
+PAYLOADS = (
+    ("small GET", get_data()),
+    ("medium GET", get_data(args=30, headers=20)),
+    ("POST 4 KB", get_data(body=u"x=" + u"й" * 2048)),
+    ("POST 64 KB", get_data(body=u"x=" + u"a" * 65536)),
+)
+
+
+def tornado_dumps(data):
+    """Previous `json_response` encoding
+    """
+    return utf8(tornado.escape.json_encode(data))
+
+
+def main(number=2000):
+    encoders = [("tornado", tornado_dumps)] + list(JSON_ENCODERS.items())
+
+    print("%-12s %10s" % ("payload", "size") + "".join("%12s" % x[0] for x in encoders))
+    for name, data in PAYLOADS:
+        results = []
+        for encoder_name, encoder in encoders:
+            seconds = min(timeit.repeat(lambda: encoder(data), number=number, repeat=3))
+            results.append("%.1f us" % (seconds / number * 1000000))
+        print("%-12s %10d" % (name, len(tornado_dumps(data))) + "".join("%12s" % x for x in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+benchmarks.oauth_signature
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Per request cost of OAuth 1.0 signature verification
+
+    python benchmarks/oauth_signature.py
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+
+from httphq.app import normalize_request, SIGNATURES_METHODS
+from httphq.utils import Authorization
+
+AUTHORIZATION = Authorization('OAuth', {
+    'realm': "Example",
+    'oauth_consumer_key': "9djdj82h48djs9d2",
+    'oauth_token': "kkk9d7dh3k39sjv7",
+    'oauth_timestamp': "137131201",
+    'oauth_nonce': "7d8f3e4a"})
+
+REQUEST = HTTPServerRequest(
+    method="POST", uri="/request?b5=%3D%253D&a3=a&c%40=&a2=r%20b", body=b"c2&a3=2+q",
+    headers=HTTPHeaders({"Host": "example.com",
+                         "Content-Type": "application/x-www-form-urlencoded"}))
+
+
+def normalize():
+    return normalize_request(REQUEST, AUTHORIZATION)
+
+
+def verify(signature_method, request_info, signature):
+    key, raw = signature_method.signing_base(request_info, "consumer secret", "token secret")
+    return signature_method.verify(key, raw, signature)
+
+
+def verify_cold(signature_method, request_info, signature):
+    signature_method.keys.clear()
+    return verify(signature_method, request_info, signature)
+
+
+def measure(func, number):
+    return "%.1f us" % (min(timeit.repeat(func, number=number, repeat=3)) / number * 1000000)
+
+
+def main(number=20000):
+    print("normalize request: %s" % measure(normalize, number))
+    print("%-12s %14s %14s" % ("method", "verify", "cold key"))
+    for name in sorted(SIGNATURES_METHODS):
+        signature_method = SIGNATURES_METHODS[name]
+        AUTHORIZATION['oauth_signature_method'] = name
+        request_info = normalize()
+        signature = signature_method.sign(request_info, "consumer secret", "token secret")
+        assert verify(signature_method, request_info, signature)
+
+        # RSA key doesn't depend on secrets and is loaded once
+        count = number // 20 if name == "RSA-SHA1" else number
+        print("%-12s %14s %14s" % (
+            name, measure(lambda: verify(signature_method, request_info, signature), count),
+            "-" if name == "RSA-SHA1" else
+            measure(lambda: verify_cold(signature_method, request_info, signature), count)))
+
+
+if __name__ == "__main__":
+    main()
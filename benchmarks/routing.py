@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+benchmarks.routing
+~~~~~~~~~~~~~~~~~~
+
+Dispatch cost of routes trie versus tornado sequential regexps scan
+
+    python benchmarks/routing.py
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado.web
+from tornado.httputil import HTTPServerRequest
+
+from httphq.app import application
+
+PATHS = (
+    ("short", "/get"),
+    ("last route", "/oauth/1.0/protected_resource/consumer_secret/token_secret"),
+    ("not found", "/not/found"),
+    ("long oauth", "/oauth/1.0/access_token/" + "/".join(["x" * 256] * 7)),
+    ("adversarial oauth", "/oauth/" + "a/" * 200 + "x"),
+    ("adversarial digest", "/digest-auth/" + "a/" * 200),
+)
+
+
+def measure(find_handler, path, duration=0.5):
+    request = HTTPServerRequest(method="GET", uri=path)
+    count = 0
+    started = time.time()
+    while time.time() - started < duration:
+        find_handler(request)
+        count += 1
+    return "%.1f us" % ((time.time() - started) / count * 1000000)
+
+
+def main():
+    # The same routes in plain tornado application
+    scan = tornado.web.Application([(h[0], h[1]) for h in application.dirty_handlers])
+
+    print("%-20s %14s %14s" % ("path", "regexps scan", "trie"))
+    for name, path in PATHS:
+        print("%-20s %14s %14s" % (name, measure(scan.find_handler, path),
+                                   measure(application.find_handler, path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,17 @@ Local debug runner
 :license: BSD, see LICENSE for more details.
 """
 import tornado.ioloop
-from tornado import httpserver, autoreload
+from tornado import autoreload
 from tornado.options import options, parse_command_line
 
-from httphq.app import application, rel
+from httphq.app import application, rel, wrap_application
+from httphq.admission import HTTPServer
 
 
 if __name__ == '__main__':
     parse_command_line()
-    http_server = httpserver.HTTPServer(application)
-    https_server = httpserver.HTTPServer(application, ssl_options={
+    http_server = HTTPServer(wrap_application(application))
+    https_server = HTTPServer(wrap_application(application), ssl_options={
         "certfile": rel("..", "server.crt"),
         "keyfile": rel("..", "server.key"),
         })
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.accesslog
+~~~~~~~~~~~~~~~~
+
+Structured access log in JSON lines format
+
+Request handling only appends a tuple to in-memory queue, records are
+encoded and written in batches by background thread. When the queue is
+full records are dropped and counted, so slow disk never blocks IOLoop.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import time
+import threading
+from collections import deque
+
+from httphq.encoders import stdlib_dumps
+
+FIELDS = ("time", "method", "route", "path", "status", "bytes", "duration", "ip")
+
+
+class AccessLog(object):
+    """Access log with batched writer thread and file rotation
+
+    :param path: log file path
+    :param max_bytes: rotate file when it grows bigger, 0 - never
+    :param rotate_interval: rotate file every N seconds, None - never
+    :param backups: number of rotated files to keep as `path.1` ... `path.N`
+    :param sample: record every N-th request only
+    :param queue_size: max records waiting for writer, newer are dropped
+    :param flush_interval: max seconds record waits in queue
+    :param batch_size: wake up writer when so many records are queued
+    :param dumps: function encoding dict to JSON bytes
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, rotate_interval=None, backups=5,
+                 sample=1, queue_size=10000, flush_interval=1.0, batch_size=1000, dumps=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.sample = max(1, sample)
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dumps = dumps or stdlib_dumps
+
+        # Counters
+        self.written = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.errors = 0
+        self.rotations = 0
+
+        self._seen = 0
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._file = None
+        self._size = 0
+        self._opened_at = None
+
+    def record(self, method, route, path, status, size, duration, ip):
+        """Queue finished request, never blocks
+
+        :return: False if request was skipped by sampling or dropped
+        """
+        self._seen += 1
+        if self._seen % self.sample:
+            self.skipped += 1
+            return False
+
+        queue = self._queue
+        if len(queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+
+        queue.append((time.time(), method, route, path, status, size, duration, ip))
+        if len(queue) == self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        """Start writer thread, must be called after fork
+        """
+        self._open()
+        self._thread = threading.Thread(target=self._run, name="httphq-access-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Write queued records and stop writer thread
+        """
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.write_batch()
+            if self._stopping and not self._queue:
+                break
+        self._file.close()
+        self._file = None
+
+    def _open(self):
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+        self._opened_at = time.time()
+
+    def write_batch(self):
+        """Encode and write all queued records
+        """
+        queue = self._queue
+        lines = []
+        for _ in range(len(queue)):
+            lines.append(self.dumps(dict(zip(FIELDS, queue.popleft()))))
+        if lines:
+            lines.append(b"")
+            data = b"\n".join(lines)
+            try:
+                self._file.write(data)
+                self._file.flush()
+            except (IOError, OSError):
+                self.errors += 1
+            else:
+                self.written += len(lines) - 1
+                self._size += len(data)
+
+        if self._should_rotate():
+            try:
+                self.rotate()
+            except (IOError, OSError):
+                self.errors += 1
+
+    def _should_rotate(self):
+        if not self._size:
+            return False
+        if self.max_bytes and self._size >= self.max_bytes:
+            return True
+        return bool(self.rotate_interval) and time.time() - self._opened_at >= self.rotate_interval
+
+    def rotate(self):
+        """Rename `path` to `path.1`, shift older files and reopen `path`
+        """
+        self._file.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                source = "%s.%d" % (self.path, i)
+                if os.path.exists(source):
+                    os.rename(source, "%s.%d" % (self.path, i + 1))
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self._open()
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "skipped": self.skipped,
+                "errors": self.errors, "rotations": self.rotations, "queued": len(self._queue)}
+
+    def render(self, worker_id=0):
+        """Render counters in Prometheus text format
+        """
+        lines = ["# HELP httphq_access_log_records_total Access log records by result",
+                 "# TYPE httphq_access_log_records_total counter"]
+        for name in ("written", "dropped", "skipped"):
+            lines.append('httphq_access_log_records_total{worker="%d",result="%s"} %d' % (
+                worker_id, name, getattr(self, name)))
+        lines.extend(["# HELP httphq_access_log_errors_total Access log write errors",
+                      "# TYPE httphq_access_log_errors_total counter",
+                      'httphq_access_log_errors_total{worker="%d"} %d' % (worker_id, self.errors)])
+        return "\n".join(lines) + "\n"
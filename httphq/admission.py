@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.admission
+~~~~~~~~~~~~~~~~
+
+Admission control for HTTP server
+
+Limits are checked when request headers are received, rejected
+requests get 503, 413 or 431 response with `Retry-After` and the
+connection is closed before request body is read.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import weakref
+
+from tornado import httpserver, httputil
+from tornado.escape import utf8
+
+from httphq.settings import responses
+
+# Limit name -> response status
+LIMITS = (("connections", 503), ("in_flight", 503), ("headers", 431),
+          ("body", 413), ("route_body", 413))
+
+
+def reject_response(status, retry_after):
+    """Raw HTTP response closing connection
+    """
+    body = "%d %s\n" % (status, responses[status])
+    return utf8("HTTP/1.1 %d %s\r\n"
+                "Content-Type: text/plain\r\n"
+                "Content-Length: %d\r\n"
+                "Retry-After: %d\r\n"
+                "Connection: close\r\n\r\n%s" % (status, responses[status], len(body), retry_after, body))
+
+
+def close_with(stream, data):
+    """Write `data` to stream and close it
+    """
+    stream.write(data).add_done_callback(lambda future: stream.close())
+
+
+class Admission(object):
+    """Connections, in-flight requests, headers and body size limits
+
+    None disables limit.
+
+    :param max_connections: max open connections
+    :param max_in_flight: max requests being processed
+    :param max_body_size: max request body bytes
+    :param max_header_size: max request line and headers bytes
+    :param route_body_limits: handler class -> max request body bytes
+    :param routes: `RouteTrie` to find handler class of request
+    :param retry_after: seconds for `Retry-After` header
+    """
+
+    def __init__(self, max_connections=None, max_in_flight=None, max_body_size=None,
+                 max_header_size=None, route_body_limits=None, routes=None, retry_after=1):
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.max_body_size = max_body_size
+        self.max_header_size = max_header_size
+        self.route_body_limits = route_body_limits or {}
+        self.routes = routes
+        self.retry_after = retry_after
+
+        self.rejected = dict((name, 0) for name, status in LIMITS)
+        self.statuses = dict(LIMITS)
+        self.connections = 0
+        # Connections of requests being processed, forgotten
+        # connections are dropped with garbage
+        self._in_flight = weakref.WeakSet()
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def reject(self, limit):
+        """Count rejection and build response for it
+        """
+        self.rejected[limit] += 1
+        return reject_response(self.statuses[limit], self.retry_after)
+
+    def check_connection(self, connections):
+        """:return: rejection response or None
+        """
+        if self.max_connections is not None and connections >= self.max_connections:
+            return self.reject("connections")
+        self.connections = connections + 1
+        return None
+
+    def route_body_limit(self, path):
+        if not self.route_body_limits or self.routes is None:
+            return None
+        route = self.routes.find(path.split("?", 1)[0])
+        return self.route_body_limits.get(route[0]) if route is not None else None
+
+    def check_request(self, start_line, headers):
+        """Check request before its body is read
+
+        :return: (rejection response or None, body limit)
+        """
+        if self.max_header_size is not None:
+            size = len(start_line.method) + len(start_line.path) + len(start_line.version) + 4
+            for name, value in headers.get_all():
+                size += len(name) + len(value) + 4
+            if size > self.max_header_size:
+                return self.reject("headers"), None
+
+        if self.max_in_flight is not None and len(self._in_flight) >= self.max_in_flight:
+            return self.reject("in_flight"), None
+
+        try:
+            length = int(headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        has_body = length or "Transfer-Encoding" in headers
+
+        if has_body and self.max_body_size is not None and length > self.max_body_size:
+            return self.reject("body"), None
+
+        limit = self.route_body_limit(start_line.path) if has_body else None
+        if limit is not None and length > limit:
+            return self.reject("route_body"), None
+        return None, limit
+
+    def acquire(self, connection):
+        self._in_flight.add(connection)
+
+    def release(self, connection):
+        self._in_flight.discard(connection)
+
+    def render(self, worker_id=0):
+        """Render counters in Prometheus text format
+        """
+        lines = ["# HELP httphq_admission_rejected_total Requests rejected by admission limits",
+                 "# TYPE httphq_admission_rejected_total counter"]
+        for name, status in LIMITS:
+            lines.append('httphq_admission_rejected_total{worker="%d",limit="%s",code="%d"} %d' % (
+                worker_id, name, status, self.rejected[name]))
+        lines.extend(["# HELP httphq_connections Open connections",
+                      "# TYPE httphq_connections gauge",
+                      'httphq_connections{worker="%d"} %d' % (worker_id, self.connections),
+                      "# HELP httphq_requests_in_flight Requests being processed",
+                      "# TYPE httphq_requests_in_flight gauge",
+                      'httphq_requests_in_flight{worker="%d"} %d' % (worker_id, self.in_flight)])
+        return "\n".join(lines) + "\n"
+
+
+class AdmissionDelegate(httputil.HTTPMessageDelegate):
+    """Check request limits before passing it to application delegate
+    """
+
+    def __init__(self, admission, request_conn, delegate):
+        self.admission = admission
+        self.request_conn = request_conn
+        self.delegate = delegate
+        self.body_limit = None
+        self.body_size = 0
+        self.rejected = False
+
+    def headers_received(self, start_line, headers):
+        rejection, self.body_limit = self.admission.check_request(start_line, headers)
+        if rejection is not None:
+            # Detached connection isn't read anymore
+            close_with(self.request_conn.detach(), rejection)
+            return None
+        self.admission.acquire(self.request_conn)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        if self.rejected:
+            return None
+        # Chunked body size isn't known from headers
+        self.body_size += len(chunk)
+        max_body_size = self.admission.max_body_size
+        if max_body_size is not None and self.body_size > max_body_size:
+            return self.reject("body")
+        if self.body_limit is not None and self.body_size > self.body_limit:
+            return self.reject("route_body")
+        return self.delegate.data_received(chunk)
+
+    def reject(self, limit):
+        self.rejected = True
+        self.admission.release(self.request_conn)
+        close_with(self.request_conn.stream, self.admission.reject(limit))
+
+    def finish(self):
+        if not self.rejected:
+            self.delegate.finish()
+
+    def on_connection_close(self):
+        self.admission.release(self.request_conn)
+        self.delegate.on_connection_close()
+
+
+class HTTPServer(httpserver.HTTPServer):
+    """HTTP server rejecting connections over application `admission` limit
+
+    Tornado hard limits for body and headers are set above
+    admission limits, so oversized requests get response.
+    """
+
+    def initialize(self, request_callback, **kwargs):
+        admission = getattr(request_callback, "admission", None)
+        if admission is not None:
+            if admission.max_body_size is not None:
+                kwargs.setdefault("max_body_size", admission.max_body_size * 2)
+            if admission.max_header_size is not None:
+                kwargs.setdefault("max_header_size", admission.max_header_size * 2)
+        super(HTTPServer, self).initialize(request_callback, **kwargs)
+
+    def handle_stream(self, stream, address):
+        admission = getattr(self.request_callback, "admission", None)
+        if admission is not None:
+            rejection = admission.check_connection(len(self._connections))
+            if rejection is not None:
+                close_with(stream, rejection)
+                return
+        super(HTTPServer, self).handle_stream(stream, address)
+
+    def on_close(self, server_conn):
+        super(HTTPServer, self).on_close(server_conn)
+        admission = getattr(self.request_callback, "admission", None)
+        if admission is not None:
+            admission.connections = len(self._connections)
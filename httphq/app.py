@@ -15,9 +15,11 @@ import os
 import sys
 import time
 import tornado.ioloop
+import tornado.websocket
 import tornado
 import hmac
 import binascii
+from datetime import timedelta
 try:
     import urlparse
 except ImportError:
@@ -37,16 +39,16 @@ except ImportError:
 
 from tornado.web import Application
 from tornado.options import define, options
-from tornado import httpserver
 from tornado import autoreload
 from tornado.web import HTTPError
 from tornado.escape import utf8
+from tornado import httputil
 
 from random import choice
 from string import ascii_letters, ascii_uppercase, ascii_lowercase
 
 try:
-    from hashlib import sha1
+    from hashlib import sha1, sha256
     sha = sha1
 except ImportError:
     # hashlib was added in Python 2.5
@@ -54,9 +56,23 @@ except ImportError:
 
 
 from httphq.taglines import taglines
-from httphq.utils import Authorization, WWWAuthentication, response, HA1, HA2, H
+from httphq.utils import (Authorization, WWWAuthentication, response, HA1, HA2, H, etag_matches,
+                          BytesPool, parse_range_header, pattern_chunks, LRUCache,
+                          deflate_static, compress_chunks, load_rsa_key, rsa_sign_sha1,
+                          rsa_verify_sha1, choose_media_type, finite_float)
 from httphq.settings import responses
-from httphq.compat import unquote, urlencode, quote, BytesIO
+from httphq.metrics import Metrics
+from httphq.accesslog import AccessLog
+from httphq.admission import Admission, AdmissionDelegate, HTTPServer
+from httphq.ratelimit import RateLimiter
+from httphq.chaos import FaultInjector, FaultyConnection, FaultDelegate
+from httphq.network import NetworkProfiles, ShapedConnection, ShapingDelegate
+from httphq.bins import BinsStorage, Record
+from httphq import nonces
+from httphq.tokens import TokenCache
+from httphq.routing import RouteTrie
+from httphq.encoders import get_json_encoder, BINARY_ENCODERS, RESPONSE_FORMATS
+from httphq.compat import unquote, urlencode, quote, asynchronous, flush
 
 define("port", default=8889, help="run HTTP on the given port", type=int)
 define("ssl_port", default=8890, help="run HTTPS on the given port", type=int)
@@ -77,6 +93,138 @@ random_string = lambda x=10: ''.join([choice(ascii_letters + ascii_uppercase + a
                                    for x in range(x)])
 
 
+def build_endpoints(handlers):
+    """Build endpoints table for home page
+
+    Route patterns are converted to human readable format
+    and to default urls with random example values.
+    """
+    endpoints = []
+
+    replace_map = (
+        ("(?P<status_code>\d{3})", "{status_code: int}", str(choice(list(responses.keys())))),
+        ("(?P<name>.+)", "{name: str}", "test_name"),
+        ("(?P<value>.+)", "{value: str}", "test_value"),
+        ("(?P<num>\d{1,2})", "{redirects_num: int}", '4'),
+        ("(?P<seconds>\d+(?:\.\d+)?)", "{seconds: float}", '1.5'),
+        ("(?P<lines>\d+)", "{lines: int}", '10'),
+        ("(?P<size>\d+)", "{size: int}", '1024'),
+        ("(?P<bin_id>\w+)", "{bin_id: str}", 'bin_id'),
+        ("(?P<rate>\d+(?:\.\d+)?)", "{rate: float}", '2'),
+        ("(?P<burst>\d+)", "{burst: int}", '5'),
+        ("(?P<n>\d+)", "{n: int}", '10'),
+        ("(?P<username>.+)", "{username: str}", "test_username"),
+        ("(?P<password>.+)", "{password: str}", "test_password"),
+        ("(?P<qop>.+)", "{quality of protection: auth | auth-int}", "auth"),
+        ("(?P<algorithm>MD5|MD5-sess|SHA-256|SHA-256-sess)",
+         "{algorithm: MD5 | MD5-sess | SHA-256 | SHA-256-sess}", "SHA-256"),
+        ("(?P<version>.+)", "{version: float}", "1.0"),
+        ("(?P<consumer_key>.+)", "{consumer_key: str}", random_string(15)),
+        ("(?P<consumer_secret>.+)", "{consumer_secret: str}", random_string(15)),
+        ("(?P<client_id>.+)", "{client_id: str}", random_string(15)),
+        ("(?P<client_secret>.+)", "{client_secret: str}", random_string(15)),
+        ("(?P<pin>.+)", "{pin: str}", random_string(10)),
+        ("(?P<verifier>.+)", "{pin: str}", random_string(10)),
+        ("(?P<token_key>.+)", "{token_key: str}", random_string(10)),
+        ("(?P<token_secret>.+)", "{token_secret: str}", random_string(10)),
+        ("(?P<tmp_token_key>.+)", "{tmp_token_key: str}", random_string(10)),
+        ("(?P<tmp_token_secret>.+)", "{tmp_token_secret: str}", random_string(10)),
+        )
+
+    for point in handlers:
+        default_url = point[0]
+        api_format = point[0]
+        for r in replace_map:
+            default_url = default_url.replace(r[0], r[2])
+            api_format = api_format.replace(r[0], r[1])
+
+        description = point[2] if len(point) >= 3 else point[1].__doc__.strip()
+        endpoints.append({"default_url": default_url,
+                          "api_format": api_format,
+                          "description": description})
+    return endpoints
+
+
+def build_status_groups():
+    """Group known HTTP statuses by class for home page
+    """
+    responses_groups = (
+        (100, 200, "1xx Informational"),
+        (200, 300, "2xx Success"),
+        (300, 400, "3xx Redirection"),
+        (400, 500, "4xx Client Error"),
+        (500, 600, "5xx Server Error"))
+
+    return [[start, end, title,
+             [(k, v, get_status_extdescription(k)) for k, v in sorted(responses.items())
+              if start <= k < end]]
+            for start, end, title in responses_groups]
+
+
+class PagesCache(object):
+    """Rendered pages storage
+
+    Pages are stored as prebuilt bytes with strong ETag.
+    Keys include request host, so the least recently used pages
+    are dropped when storage grows over `max_size` items.
+    """
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self._pages = LRUCache(max_size)
+
+    def get(self, key):
+        return self._pages.get(key)
+
+    def set(self, key, body):
+        """Store rendered `body` and return (body, etag) pair
+        """
+        body = utf8(body)
+        return self._pages.set(key, (body, '"%s"' % sha1(body).hexdigest()))
+
+    def clear(self):
+        self._pages.clear()
+
+    def __len__(self):
+        return len(self._pages)
+
+
+class Ticker(object):
+    """Shared periodic timer
+
+    Single IOLoop timeout runs all subscribed callbacks every `interval`
+    seconds, so thousands of timed responses don't wake the loop separately.
+    Timer is stopped when there are no subscribers.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self._callbacks = set()
+        self._timeout = None
+
+    def add(self, callback):
+        self._callbacks.add(callback)
+        if self._timeout is None:
+            self._schedule()
+
+    def remove(self, callback):
+        self._callbacks.discard(callback)
+
+    def _schedule(self):
+        self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+            timedelta(seconds=self.interval), self._tick)
+
+    def _tick(self):
+        self._timeout = None
+        for callback in list(self._callbacks):
+            callback()
+        if self._callbacks:
+            self._schedule()
+
+    def __len__(self):
+        return len(self._callbacks)
+
+
 def get_status_extdescription(status):
     if status in STATUSES_WITH_PROXY_AUTH:
         return "Will also return this extra header: Proxy-Authenticate: Basic realm=\"Fake Realm\""
@@ -101,6 +249,10 @@ class HTTPApplication(Application):
             (r"/robots.txt", RobotsResourceHandler),
             (r"/humans.txt", HumansResourceHandler),
             (r"/ip", IPHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/bins", BinsHandler),
+            (r"/bins/(?P<bin_id>\w+)", BinHandler),
+            (r"/bin/(?P<bin_id>\w+)", BinRecordHandler),
             (r"/get", GETHandler, "GET method"),
             (r"/post", POSTHandler, "POST method"),
             (r"/put", PUTHandler, "PUT method"),
@@ -108,6 +260,7 @@ class HTTPApplication(Application):
             (r"/options", OPTIONSHandler, "OPTIONS method"),
             (r"/delete", DELETEHandler, "DELETE method"),
             (r"/gzip", GZipHandler),
+            (r"/deflate", DeflateHandler),
             (r"/user-agent", UserAgentHandler),
             (r"/headers", HeadersHandler),
             (r"/cookies", CookiesHandler, "Returns all user cookies"),
@@ -116,8 +269,22 @@ class HTTPApplication(Application):
             (r"/status/(?P<status_code>\d{3})", StatusHandler),
             (r"/redirect/(?P<num>\d{1,2})", RedirectHandler),
             (r"/redirect/end", RedirectEndHandler),
+            (r"/delay/(?P<seconds>\d+(?:\.\d+)?)", DelayHandler),
+            (r"/stream/(?P<lines>\d+)", StreamHandler),
+            (r"/bytes/(?P<size>\d+)", BytesHandler),
+            (r"/stream-bytes/(?P<size>\d+)", StreamBytesHandler),
+            (r"/range/(?P<size>\d+)", RangeHandler),
+            (r"/drip", DripHandler),
+            (r"/ratelimit/(?P<rate>\d+(?:\.\d+)?)/(?P<burst>\d+)", RateLimitHandler),
+            (r"/ws/echo", WebSocketEchoHandler),
+            (r"/ws/stream/(?P<n>\d+)", WebSocketStreamHandler),
             (r"/basic-auth/(?P<username>.+)/(?P<password>.+)", BasicAuthHandler),
+            (r"/digest-auth/(?P<qop>.+)/(?P<username>.+)/(?P<password>.+)/"
+             r"(?P<algorithm>MD5|MD5-sess|SHA-256|SHA-256-sess)", DigestAuthHandler),
             (r"/digest-auth/(?P<qop>.+)/(?P<username>.+)/(?P<password>.+)", DigestAuthHandler),
+            (r"/oauth/rsa_key", OAuthRSAKeyHandler),
+            (r"/oauth/2.0/token/(?P<client_id>.+)/(?P<client_secret>.+)", OAuth2TokenHandler),
+            (r"/oauth/2.0/protected_resource", OAuth2ProtectedResourceHandler),
             (r"/oauth/(?P<version>.+)/request_token/(?P<consumer_key>.+)/(?P<consumer_secret>.+)/(?P<token_key>.+)/(?P<token_secret>.+)", OAuthRequestTokenHandler),
             (r"/oauth/(?P<version>.+)/authorize/(?P<pin>.+)", OAuthAuthorizeHandler),
             (r"/oauth/(?P<version>.+)/access_token/(?P<consumer_key>.+)/(?P<consumer_secret>.+)/(?P<tmp_token_key>.+)/(?P<tmp_token_secret>.+)/(?P<verifier>.+)/(?P<token_key>.+)/(?P<token_secret>.+)", OAuthAccessTokenHandler),
@@ -130,34 +297,317 @@ class HTTPApplication(Application):
             xsrf_cookies=False,
             cookie_secret="11oETzfjkrebfgjKXQLKHFJKkjjnFLDnDKJjNSDAGaYdkL5gEmGeJJFuYh7EQnp2XdTP1o/Vo=",
             autoescape=None,
+            # Regenerate random example values on home page every N seconds
+            index_reseed_interval=None,
+            # Upper limit for /delay/{seconds}
+            max_delay=10,
+            # Upper limit for /drip duration
+            max_drip_duration=60,
+            # Upper limit for /drip numbytes
+            max_drip_size=10 * 1024 * 1024,
+            # Bigger /gzip and /deflate bodies are compressed on the fly
+            compress_cache_max_size=1024 * 1024,
+            # Upper limit for /gzip and /deflate size
+            max_compress_size=10 * 1024 * 1024,
+            # Memory budget for all request bins and max number of bins
+            bins_max_size=32 * 1024 * 1024,
+            bins_max_count=10000,
+            # Digest auth nonces lifetime in seconds and max tracked nonces
+            digest_nonce_ttl=300,
+            digest_nonce_max_size=100000,
+            # OAuth 2.0 tokens signing key and access tokens lifetime in seconds
+            jwt_secret=binascii.hexlify(os.urandom(32)),
+            oauth2_token_ttl=3600,
+            # JSON encoder backend: auto, orjson, ujson or stdlib
+            json_encoder="auto",
+            # JSON lines access log, rotated by size in bytes or
+            # interval in seconds, every N-th request is recorded
+            access_log=None,
+            access_log_max_bytes=100 * 1024 * 1024,
+            access_log_rotate_interval=None,
+            access_log_backups=5,
+            access_log_sample=1,
+            access_log_queue_size=10000,
+            # Admission limits, None - unlimited. Requests over limits get
+            # 503, 413 or 431 response with Retry-After before body is read
+            max_connections=None,
+            max_in_flight=None,
+            max_body_size=100 * 1024 * 1024,
+            max_header_size=64 * 1024,
+            # Route template -> max request body bytes, e.g. {"/post": 1024 * 1024}
+            route_body_limits={},
+            retry_after=1,
+            # Token bucket limits as (requests per second, burst), None - unlimited.
+            # Clients are identified by API key header or IP
+            rate_limit=None,
+            # Route template -> (requests per second, burst)
+            route_rate_limits={},
+            rate_limit_key_header="X-Api-Key",
+            rate_limit_max_keys=100000,
+            # Fault injection options applied to every request, e.g. {"error": 0.1},
+            # see `httphq.chaos`. Requests set own options with X-Chaos header
+            # or chaos query argument if `chaos_requests` is enabled
+            chaos=None,
+            chaos_seed=None,
+            chaos_requests=True,
+            # Network profile of every request, custom profiles as
+            # name -> `httphq.network.Profile` arguments. Requests select
+            # profile with X-Network-Profile header or network query argument
+            network_profile=None,
+            network_profiles={},
+            network_profile_requests=True,
+            network_seed=None,
+            # Max WebSocket message size, bigger messages close connection.
+            # Server pings every N seconds, None - only answer client pings
+            websocket_max_message_size=1024 * 1024,
+            websocket_ping_interval=None,
+            websocket_ping_timeout=None,
         )
-        tornado.web.Application.__init__(self, [(h[0], h[1]) for h in self.dirty_handlers], **settings)
+        # Routes are dispatched by trie in `find_handler`,
+        # tornado router serves only static files then
+        self.routes = RouteTrie(self.dirty_handlers)
+        handlers = [] if hasattr(tornado.web.Application, "find_handler") else \
+                   [(h[0], h[1]) for h in self.dirty_handlers]
+
+        tornado.web.Application.__init__(self, handlers, **settings)
+
+        self.pages = PagesCache()
+        self.bytes_pool = BytesPool()
+        self.ticker = Ticker()
+        # Finer timer releasing writes of shaped responses
+        self.shaping_ticker = Ticker(0.01)
+        # Precompressed static parts of /gzip and /deflate responses
+        self.compressed = LRUCache(64)
+        # Message payloads of /ws/stream shared by connections
+        self.payloads = LRUCache(16)
+        self.metrics = Metrics(self.dirty_handlers)
+        self.bins = BinsStorage(self.settings['bins_max_size'],
+                                max_bins=self.settings['bins_max_count'])
+        self.nonces = nonces.NonceStore(self.settings['digest_nonce_ttl'],
+                                        self.settings['digest_nonce_max_size'])
+        self.oauth_nonces = nonces.ReplayCache(OAuthBaseHandler.TIMESTAMP_TRESHOLD)
+        self.tokens = TokenCache(self.settings['jwt_secret'])
+        self.json_dumps = get_json_encoder(self.settings['json_encoder'])
+        self.access_log = None
+        self.admission = Admission(self.settings['max_connections'], self.settings['max_in_flight'],
+                                   self.settings['max_body_size'], self.settings['max_header_size'],
+                                   self.handler_limits(self.settings['route_body_limits']),
+                                   self.routes, self.settings['retry_after'])
+        self.rate_limiter = RateLimiter(self.settings['rate_limit_max_keys'])
+        self.route_rate_limits = self.handler_limits(self.settings['route_rate_limits'])
+        self.faults = FaultInjector(self.settings['chaos'], self.settings['chaos_seed'],
+                                    self.settings['chaos_requests'])
+        self.network = NetworkProfiles(self.settings['network_profiles'], self.settings['network_profile'],
+                                       self.settings['network_profile_requests'],
+                                       self.settings['network_seed'])
+        self.status_groups = build_status_groups()
+        self.reseed()
+
+    def handler_limits(self, limits):
+        """Map route templates to handler classes
+        """
+        result = {}
+        for handler in self.dirty_handlers:
+            limit = limits.get(self.metrics.route(handler[1]))
+            if limit is not None:
+                result[handler[1]] = limit
+        return result
+
+    def start_request(self, server_conn, request_conn):
+        return AdmissionDelegate(self.admission, request_conn,
+                                 super(HTTPApplication, self).start_request(server_conn, request_conn))
+
+    def find_handler(self, request, **kwargs):
+        """Dispatch request with routes trie, static files and
+        404 pages are handled by tornado router
+        """
+        route = self.routes.find(request.path)
+        if route is not None:
+            return self.get_handler_delegate(request, route[0], path_kwargs=route[1])
+        return super(HTTPApplication, self).find_handler(request, **kwargs)
+
+    def open_access_log(self, path=None, sample=None):
+        """Start access log writer thread, must be called after fork
+        """
+        settings = self.settings
+        self.access_log = AccessLog(path or settings['access_log'],
+                                    max_bytes=settings['access_log_max_bytes'],
+                                    rotate_interval=settings['access_log_rotate_interval'],
+                                    backups=settings['access_log_backups'],
+                                    sample=sample or settings['access_log_sample'],
+                                    queue_size=settings['access_log_queue_size'],
+                                    dumps=self.json_dumps)
+        self.access_log.start()
+        return self.access_log
+
+    def log_request(self, handler):
+        """Release admission slot of finished request and queue it to access
+        log instead of synchronous tornado logging when access log is enabled
+        """
+        self.admission.release(handler.request.connection)
+        if self.access_log is None:
+            return super(HTTPApplication, self).log_request(handler)
+
+        request = handler.request
+        if isinstance(handler, CustomHandler):
+            size, ip = handler._bytes_sent, handler.get_ip()
+        else:
+            size, ip = int(handler._headers.get("Content-Length", 0)), request.remote_ip
+        self.access_log.record(request.method, self.metrics.route(handler.__class__), request.path,
+                               handler.get_status(), size, request.request_time(), ip)
+
+    def reseed(self):
+        """Rebuild endpoints table with new example values
+        and drop already rendered pages
+        """
+        self.endpoints = build_endpoints(self.dirty_handlers)
+        self.seeded_at = time.time()
+        self.pages.clear()
+
+    def check_seed(self):
+        """Reseed endpoints if `index_reseed_interval` elapsed
+        """
+        interval = self.settings.get('index_reseed_interval')
+        if interval and time.time() - self.seeded_at >= interval:
+            self.reseed()
 
 
 class CustomHandler(tornado.web.RequestHandler):
     """Custom handler with good methods
     """
 
+    _closed = False
+    # Response body bytes passed to connection
+    _bytes_sent = 0
+
     def __init__(self, *args, **kwargs):
         super(CustomHandler, self).__init__(*args, **kwargs)
         self.set_header("Server", "LightBeer/0.568")
 
     def json_response(self, data, finish=True):
-        output_json = utf8(tornado.escape.json_encode(data))
-        # self.set_header("Content-Type", "application/json")
-        if finish is True:
-            self.finish(output_json)
+        """Finish request with `data` in format negotiated by `Accept` header
+
+        MessagePack or CBOR are used when client prefers them,
+        JSON otherwise. Not finished responses are always JSON.
+        """
+        if finish is not True:
+            return self.application.json_dumps(data)
+
+        self.set_header("Vary", "Accept")
+        media_type = choose_media_type(self.request.headers.get("Accept"), RESPONSE_FORMATS)
+        if media_type in BINARY_ENCODERS:
+            self.set_header("Content-Type", media_type)
+            self.finish(BINARY_ENCODERS[media_type](data))
         else:
-            return output_json
+            # self.set_header("Content-Type", "application/json")
+            self.finish(self.application.json_dumps(data))
 
-    def get_data(self):
-        data = {}
-        data['args'] = dict([(k, v) for k, v in self.request.arguments.items()])
-        data['headers'] = dict([(k, v) for k, v in self.request.headers.items()])
-        data['ip'] = self.request.headers.get(
+    def render_cached(self, template_name, **kwargs):
+        """Render template once per host and serve it from application cache
+
+        Supports conditional requests with `If-None-Match` header.
+        """
+        # Host names are case insensitive and default port is optional
+        host = self.request.host.lower()
+        if host.endswith(":80"):
+            host = host[:-3]
+        key = (template_name, host)
+        page = self.application.pages.get(key)
+        if page is None:
+            page = self.application.pages.set(key, self.render_string(template_name, **kwargs))
+
+        body, etag = page
+        self.set_header("Etag", etag)
+        if etag_matches(self.request.headers.get("If-None-Match"), etag):
+            self.set_status(304)
+            self.finish()
+        else:
+            self.finish(body)
+
+    def write_chunks(self, chunks):
+        """Write chunks one by one and finish response
+
+        Next chunk is written only when previous is flushed,
+        so other requests are served between chunks.
+        """
+        if self._closed:
+            return
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            self.finish()
+        else:
+            self.write(chunk)
+            flush(self, lambda: self.write_chunks(chunks))
+
+    def flush(self, *args, **kwargs):
+        self._bytes_sent += sum(len(x) for x in self._write_buffer)
+        return super(CustomHandler, self).flush(*args, **kwargs)
+
+    def on_connection_close(self):
+        self._closed = True
+        self.application.admission.release(self.request.connection)
+
+    def prepare(self):
+        self.check_rate_limit()
+
+    def on_finish(self):
+        self.application.metrics.observe(self.__class__, self.request.method,
+                                         self.get_status(), self.request.request_time())
+
+    def get_ip(self):
+        """Client IP from proxy headers or connection
+        """
+        return self.request.headers.get(
             "X-Real-Ip", self.request.headers.get(
                 "X-RealI-IP",
                 self.request.headers.get("X-Forwarded-For", self.request.remote_ip)))
+
+    def rate_limit_key(self):
+        """Client API key or IP
+        """
+        key = self.request.headers.get(self.settings['rate_limit_key_header'])
+        return ("key", key) if key else ("ip", self.get_ip())
+
+    def check_rate_limit(self):
+        """Take token from route and global buckets of client
+        """
+        limits = []
+        route_limit = self.application.route_rate_limits.get(self.__class__)
+        if route_limit is not None:
+            limits.append((self.application.metrics.route(self.__class__), route_limit))
+        if self.settings['rate_limit'] is not None:
+            limits.append(("*", self.settings['rate_limit']))
+        if not limits:
+            return True
+
+        key = self.rate_limit_key()
+        decision = None
+        for scope, (rate, burst) in limits:
+            current = self.application.rate_limiter.hit((scope,) + key, rate, burst)
+            if decision is None or not current.allowed or current.remaining < decision.remaining:
+                decision = current
+            if not current.allowed:
+                break
+        return self.send_rate_limit(decision)
+
+    def send_rate_limit(self, decision):
+        """Set `RateLimit-*` headers, finish request with 429 if it isn't allowed
+
+        :return: True if request is allowed
+        """
+        for name, value in decision.headers():
+            self.set_header(name, value)
+        if not decision.allowed:
+            self.set_status(429)
+            self.json_response(decision.to_dict())
+        return decision.allowed
+
+    def get_data(self):
+        data = {}
+        data['args'] = dict([(k, self.get_arguments(k, strip=False)) for k in self.request.arguments])
+        data['headers'] = dict([(k, v) for k, v in self.request.headers.items()])
+        data['ip'] = self.get_ip()
         data['url'] = self.request.full_url()
         data['request_time'] = self.request.request_time()
         data['start_time'] = self.request._start_time
@@ -178,55 +628,10 @@ class HomeHandler(CustomHandler):
     """
 
     def get(self):
-        endpoints = []
-
-        replace_map = (
-            ("(?P<status_code>\d{3})", "{status_code: int}", str(choice(list(responses.keys())))),
-            ("(?P<name>.+)", "{name: str}", "test_name"),
-            ("(?P<value>.+)", "{value: str}", "test_value"),
-            ("(?P<num>\d{1,2})", "{redirects_num: int}", '4'),
-            ("(?P<username>.+)", "{username: str}", "test_username"),
-            ("(?P<password>.+)", "{password: str}", "test_password"),
-            ("(?P<qop>.+)", "{quality of protection: auth | auth-int}", "auth"),
-            ("(?P<version>.+)", "{version: float}", "1.0"),
-            ("(?P<consumer_key>.+)", "{consumer_key: str}", random_string(15)),
-            ("(?P<consumer_secret>.+)", "{consumer_secret: str}", random_string(15)),
-            ("(?P<pin>.+)", "{pin: str}", random_string(10)),
-            ("(?P<verifier>.+)", "{pin: str}", random_string(10)),
-            ("(?P<token_key>.+)", "{token_key: str}", random_string(10)),
-            ("(?P<token_secret>.+)", "{token_secret: str}", random_string(10)),
-            ("(?P<tmp_token_key>.+)", "{tmp_token_key: str}", random_string(10)),
-            ("(?P<tmp_token_secret>.+)", "{tmp_token_secret: str}", random_string(10)),
-#            ("(?<consumer_secret>.+)", "{consumer_secret: str}", random_string(15)),
-            )
-
-        for point in self.application.dirty_handlers:
-            default_url = point[0]
-            api_format = point[0]
-            for r in replace_map:
-                default_url = default_url.replace(r[0], r[2])
-                api_format = api_format.replace(r[0], r[1])
-
-            description = point[2] if len(point) >= 3 else point[1].__doc__.strip()
-            endpoint = {"default_url": default_url,
-                        "api_format": api_format,
-                        "description": description}
-            endpoints.append(endpoint)
-
-        responses_groups = (
-            (100, 200, "1xx Informational", []),
-            (200, 300, "2xx Success", []),
-            (300, 400, "3xx Redirection", []),
-            (400, 500, "4xx Client Error", []),
-            (500, 600, "5xx Server Error", []))
-
-        groups = []
-        for i, group in enumerate(responses_groups):
-            groups.append([group[0], group[1], group[2],
-                           [(k, v, get_status_extdescription(k)) for k, v in responses.items()
-                            if group[0] <= k < group[1]]])
-
-        self.render("index.html", endpoints=endpoints, groups=groups)
+        self.application.check_seed()
+        self.render_cached("index.html",
+                           endpoints=self.application.endpoints,
+                           groups=self.application.status_groups)
 
 
 class HurlHandler(CustomHandler):
@@ -234,7 +639,7 @@ class HurlHandler(CustomHandler):
     """
 
     def get(self):
-        self.render("human_curl.html")
+        self.render_cached("human_curl.html")
 
 
 class RobotsResourceHandler(CustomHandler):
@@ -243,14 +648,93 @@ class RobotsResourceHandler(CustomHandler):
 
     def get(self):
         self.set_header("Content-Type", "text/plain")
-        self.render("robots.txt")
+        self.render_cached("robots.txt")
 
 class HumansResourceHandler(CustomHandler):
     """Humans.txt file
     """
     def get(self):
         self.set_header("Content-Type", "text/plain")
-        self.render("humans.txt")
+        self.render_cached("humans.txt")
+
+
+class MetricsHandler(CustomHandler):
+    """Requests counters and latency histograms in Prometheus text format
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        output = self.application.metrics.render()
+        if self.application.access_log is not None:
+            output += self.application.access_log.render(self.application.metrics.worker_id)
+        output += self.application.admission.render(self.application.metrics.worker_id)
+        output += self.application.rate_limiter.render(self.application.metrics.worker_id)
+        output += self.application.faults.render(self.application.metrics.worker_id)
+        output += self.application.network.render(self.application.metrics.worker_id)
+        self.finish(output)
+
+
+class BinsHandler(CustomHandler):
+    """Create request bin with POST, list bins with GET
+    """
+
+    def get(self):
+        self.json_response({"bins": [x.to_dict() for x in self.application.bins],
+                            "size": self.application.bins.size,
+                            "max_size": self.application.bins.max_size,
+                            "max_bins": self.application.bins.max_bins,
+                            "evicted": self.application.bins.evicted})
+
+    def post(self):
+        capacity = self.get_argument("capacity", None)
+        try:
+            capacity = int(capacity) if capacity is not None else None
+        except ValueError:
+            raise HTTPError(400)
+
+        if capacity is not None and capacity < 1:
+            raise HTTPError(400)
+
+        bin = self.application.bins.create(capacity)
+        self.set_status(201)
+        data = bin.to_dict()
+        data['url'] = "%s://%s/bin/%s" % (self.request.protocol, self.request.host, bin.id)
+        data['inspect_url'] = "%s://%s/bins/%s" % (self.request.protocol, self.request.host, bin.id)
+        self.json_response(data)
+
+
+class BinHandler(CustomHandler):
+    """List requests captured by bin, newest first
+    """
+
+    def get(self, bin_id):
+        bin = self.application.bins.get(bin_id)
+        if bin is None:
+            raise HTTPError(404)
+
+        data = bin.to_dict()
+        data['requests'] = [x.to_dict() for x in bin]
+        self.json_response(data)
+
+    def delete(self, bin_id):
+        if self.application.bins.delete(bin_id) is None:
+            raise HTTPError(404)
+        self.json_response({"id": bin_id, "deleted": True})
+
+
+class BinRecordHandler(CustomHandler):
+    """Capture request into bin
+    """
+
+    SUPPORTED_METHODS = ("GET", "HEAD", "POST", "DELETE", "PATCH", "PUT", "OPTIONS")
+
+    def get(self, bin_id):
+        record = Record(self.request.method, self.get_data())
+        if self.application.bins.record(bin_id, record) is None:
+            raise HTTPError(404)
+        self.json_response({"bin": bin_id, "recorded": True})
+
+    head = post = delete = patch = put = options = get
 
 
 class StatusHandler(CustomHandler):
@@ -346,6 +830,343 @@ class RedirectEndHandler(CustomHandler):
                             "finish": True})
 
 
+class DelayHandler(CustomHandler):
+    """Returns request data after given delay
+    """
+
+    _timeout = None
+
+    @asynchronous
+    def get(self, seconds):
+        seconds = min(float(seconds), self.settings.get('max_delay', 10))
+
+        # Park request on ioloop, no thread or loop blocking
+        self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+            timedelta(seconds=seconds), lambda: self._respond(seconds))
+
+    post = put = delete = get
+
+    def _respond(self, seconds):
+        self._timeout = None
+        data = self.get_data()
+        data['delay'] = seconds
+        self.json_response(data)
+
+    def on_connection_close(self):
+        super(DelayHandler, self).on_connection_close()
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+
+
+class StreamHandler(CustomHandler):
+    """Streams given number of JSON lines with chunked encoding
+    """
+
+    @asynchronous
+    def get(self, lines):
+        self.set_header("Content-Type", "application/x-ndjson")
+        self.write_chunks(self._lines(int(lines)))
+
+    def _lines(self, lines):
+        for i in range(lines):
+            data = self.get_data()
+            data['id'] = i
+            yield self.json_response(data, finish=False) + b"\n"
+
+
+class BytesHandler(CustomHandler):
+    """Returns given number of random bytes, `seed` argument makes them reproducible
+    """
+
+    chunked = False
+    default_chunk_size = None
+
+    @asynchronous
+    def get(self, size):
+        try:
+            seed = self.get_argument("seed", None)
+            seed = int(seed) if seed is not None else None
+            chunk_size = int(self.get_argument("chunk_size", 0)) or self.default_chunk_size
+        except ValueError:
+            raise HTTPError(400)
+
+        if chunk_size is not None and chunk_size < 0:
+            raise HTTPError(400)
+
+        self.set_header("Content-Type", "application/octet-stream")
+        if not self.chunked:
+            self.set_header("Content-Length", size)
+
+        self.write_chunks(self.application.bytes_pool.chunks(int(size), chunk_size, seed))
+
+
+class StreamBytesHandler(BytesHandler):
+    """Streams given number of random bytes with chunked encoding by `chunk_size` parts
+    """
+
+    chunked = True
+    default_chunk_size = 10240
+
+
+class RangeHandler(CustomHandler):
+    """Returns deterministic content of given size with Range requests support
+    """
+
+    def _chunks(self, ranges, size, boundary):
+        """Iterate over multipart/byteranges body parts
+        """
+        for start, end in ranges:
+            yield self._part_header(start, end, size, boundary)
+            for chunk in pattern_chunks(start, end + 1):
+                yield chunk
+        yield utf8("\r\n--%s--\r\n" % boundary)
+
+    def _part_header(self, start, end, size, boundary):
+        return utf8("\r\n--%s\r\nContent-Type: application/octet-stream\r\n"
+                    "Content-Range: bytes %d-%d/%d\r\n\r\n" % (boundary, start, end, size))
+
+    @asynchronous
+    def get(self, size):
+        size = int(size)
+        etag = '"range-%d"' % size
+
+        self.set_header("Accept-Ranges", "bytes")
+        self.set_header("Etag", etag)
+
+        ranges = parse_range_header(self.request.headers.get("Range"), size)
+
+        # Range is ignored if representation has changed
+        if_range = self.request.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            ranges = None
+
+        if ranges is None:
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Length", size)
+            chunks = pattern_chunks(0, size)
+        elif not ranges:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            self.finish()
+            return
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_status(206)
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+            self.set_header("Content-Length", end - start + 1)
+            chunks = pattern_chunks(start, end + 1)
+        else:
+            boundary = binascii.hexlify(os.urandom(12)).decode('ascii')
+            length = len("\r\n--%s--\r\n" % boundary) + sum(
+                len(self._part_header(start, end, size, boundary)) + end - start + 1
+                for start, end in ranges)
+            self.set_status(206)
+            self.set_header("Content-Type", "multipart/byteranges; boundary=%s" % boundary)
+            self.set_header("Content-Length", length)
+            chunks = self._chunks(ranges, size, boundary)
+
+        if self.request.method == "HEAD":
+            self.finish()
+        else:
+            self.write_chunks(chunks)
+
+    head = get
+
+
+class RateLimitHandler(CustomHandler):
+    """Token bucket with given refill rate per second and burst, answers 429 when it is empty,
+    `cost` argument sets tokens taken by request
+    """
+
+    def get(self, rate, burst):
+        rate, burst = float(rate), int(burst)
+        try:
+            cost = int(self.get_argument("cost", 1))
+        except ValueError:
+            raise HTTPError(400)
+        if rate <= 0 or not 1 <= cost <= burst:
+            raise HTTPError(400)
+
+        decision = self.application.rate_limiter.hit(
+            ("/ratelimit", rate, burst) + self.rate_limit_key(), rate, burst, cost)
+        if self.send_rate_limit(decision):
+            self.json_response(decision.to_dict())
+
+
+class DripHandler(CustomHandler):
+    """Drips `numbytes` bytes evenly over `duration` seconds after `delay` with status `code`
+    """
+
+    _timeout = None
+    # Max bytes written between flushes
+    max_slice = 64 * 1024
+
+    @asynchronous
+    def get(self):
+        try:
+            self._numbytes = int(self.get_argument("numbytes", 10))
+            self._duration = min(finite_float(self.get_argument("duration", 2)),
+                                 self.settings.get('max_drip_duration', 60))
+            delay = min(finite_float(self.get_argument("delay", 0)),
+                        self.settings.get('max_delay', 10))
+            code = int(self.get_argument("code", 200))
+        except ValueError:
+            raise HTTPError(400)
+
+        # 1xx is interim response, it can't be the final one
+        if code not in responses or code < 200 or \
+               not 0 <= self._numbytes <= self.settings['max_drip_size']:
+            raise HTTPError(400)
+
+        if code in STATUSES_WITHOUT_BODY:
+            self._numbytes = 0
+
+        self.set_status(code)
+        self.set_header("Content-Type", "application/octet-stream")
+        self.set_header("Content-Length", self._numbytes)
+
+        if delay > 0:
+            self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(
+                timedelta(seconds=delay), self._start)
+        else:
+            self._start()
+
+    def _start(self):
+        self._timeout = None
+        self._started = time.time()
+        self._sent = 0
+        self._flushing = False
+        self.application.ticker.add(self._drip)
+        self._drip()
+
+    def _due(self):
+        elapsed = time.time() - self._started
+        if self._duration <= 0 or elapsed >= self._duration:
+            return self._numbytes
+        return int(self._numbytes * elapsed / self._duration)
+
+    def _drip(self):
+        if self._closed:
+            self.application.ticker.remove(self._drip)
+            return
+        # Next slice is written only when previous one is flushed
+        if self._flushing:
+            return
+
+        due = self._due()
+        if due > self._sent:
+            end = min(due, self._sent + self.max_slice)
+            for chunk in pattern_chunks(self._sent, end):
+                self.write(chunk)
+            self._sent = end
+            if self._sent < self._numbytes:
+                self._flushing = True
+                flush(self, self._flushed)
+                return
+
+        if self._sent >= self._numbytes:
+            self.application.ticker.remove(self._drip)
+            self.finish()
+
+    def _flushed(self):
+        self._flushing = False
+        # Slow reader is behind schedule, don't wait for next tick
+        if self._due() > self._sent:
+            self._drip()
+
+    def on_connection_close(self):
+        super(DripHandler, self).on_connection_close()
+        self.application.ticker.remove(self._drip)
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+
+
+class WebSocketBaseHandler(tornado.websocket.WebSocketHandler, CustomHandler):
+    """WebSocket handler with rate limits and metrics of `CustomHandler`
+
+    Messages aren't compressed: deflate context takes hundreds
+    of kilobytes, without it idle connection costs a few.
+    """
+
+    def check_origin(self, origin):
+        return True
+
+
+class WebSocketEchoHandler(WebSocketBaseHandler):
+    """Echoes WebSocket text and binary messages, fragmented messages are echoed whole
+    """
+
+    def on_message(self, message):
+        try:
+            self.write_message(message, binary=isinstance(message, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+
+class WebSocketStreamHandler(WebSocketBaseHandler):
+    """Pushes `n` binary WebSocket messages of `size` bytes every `interval` seconds
+    """
+
+    _timeout = None
+
+    def get(self, n):
+        try:
+            self._count = int(n)
+            size = int(self.get_argument("size", 1024))
+            self._interval = min(finite_float(self.get_argument("interval", 0)),
+                                 self.settings.get('max_delay', 10))
+            seed = self.get_argument("seed", None)
+            seed = int(seed) if seed is not None else None
+        except ValueError:
+            raise HTTPError(400)
+
+        if not 0 <= size <= self.settings['websocket_max_message_size'] or self._interval < 0:
+            raise HTTPError(400)
+
+        # Every message and connection sends the same payload object
+        key = (size, seed)
+        self._payload = self.application.payloads.get(key)
+        if self._payload is None:
+            self._payload = self.application.payloads.set(
+                key, b"".join(self.application.bytes_pool.chunks(size, seed=seed)))
+        return super(WebSocketStreamHandler, self).get(n)
+
+    def open(self, n):
+        self._next_at = tornado.ioloop.IOLoop.instance().time()
+        self._push()
+
+    def _push(self):
+        self._timeout = None
+        if self._count <= 0:
+            self.close(1000)
+            return
+
+        self._count -= 1
+        try:
+            future = self.write_message(self._payload, binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        tornado.ioloop.IOLoop.instance().add_future(future, self._on_write)
+
+    def _on_write(self, future):
+        # Next message is sent when previous one is written to socket
+        if future.exception() is not None:
+            return
+        if self._interval:
+            self._next_at += self._interval
+            self._timeout = tornado.ioloop.IOLoop.instance().add_timeout(self._next_at, self._push)
+        else:
+            self._push()
+
+    def on_close(self):
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.instance().remove_timeout(self._timeout)
+            self._timeout = None
+
+
 class BasicAuthHandler(CustomHandler):
     """HTTP Basic access
     """
@@ -395,32 +1216,38 @@ class DigestAuthHandler(BasicAuthHandler):
 
     Digest authentication by RFC 2617
     with support qop auth and auth-int
+    and RFC 7616 algorithms
     """
 
-    def _request_auth(self, qop=None):
+    def _request_auth(self, qop=None, stale=False, algorithm="MD5"):
         """Build challenge header for request without Authorization header
-        """
 
-        # Generating server nonce, format propsed by RFC 2069 is
-        # H(client-IP:time-stamp:private-key).
-        nonce = H("%s:%d:%s" % (self.request.remote_ip,
-                                  time.time(),
-                                  os.urandom(10)))
+        :param stale: previous nonce expired, client can retry with new one
+                      without asking user for credentials
+        """
 
         # A string of data, specified by the server, which should be
         # returned by the client unchanged.
         opaque = H(os.urandom(10))
+
+        # Server nonce with issue time and signature, tracked by
+        # application nonces store
+        nonce = self.application.nonces.issue(opaque)
+
+        challenge = {'realm': "Fake Realm",
+                     'nonce': nonce,
+                     'qop': 'auth,auth-int,auth-ints' if qop is None else qop,
+                     'opaque': opaque,
+                     'algorithm': algorithm}
+        if stale:
+            challenge['stale'] = 'true'
         self.set_header("WWW-Authenticate",
-                        WWWAuthentication('Digest',
-                                          {'realm': "Fake Realm",
-                                           'nonce': nonce,
-                                           'qop': 'auth,auth-int,auth-ints' if qop is None else qop,
-                                           'opaque': opaque}).to_header())
+                        WWWAuthentication('Digest', challenge).to_header())
         self.set_status(401)
         self.finish()
         return False
 
-    def get(self, username, password, qop=None):
+    def get(self, username, password, qop=None, algorithm="MD5"):
         if qop not in ('auth', 'auth-int'):
             qop = None
         ## Response no authenticated header
@@ -443,30 +1270,44 @@ class DigestAuthHandler(BasicAuthHandler):
         try:
             auth = self.request.headers.get("Authorization")
             if auth is None:
-                return self._request_auth(qop)
+                self._request_auth(qop, algorithm=algorithm)
             else:
                 try:
                     authorization_info = Authorization.from_string(auth)
                 except Exception:
-                    self._request_auth(qop)
+                    self._request_auth(qop, algorithm=algorithm)
                 else:
+                    if (authorization_info.algorithm or "MD5") != algorithm:
+                        self._request_auth(qop, algorithm=algorithm)
+                        return
+
                     request_info = dict()
                     request_info['uri'] = self.request.uri
                     request_info['body'] = self.request.body
                     request_info['method'] = self.request.method
                     response_hash = response(authorization_info, password, request_info)
-                    if response_hash == authorization_info['response']:
+                    if response_hash != authorization_info['response']:
+                        self.set_status(403)
+                        self.finish()
+                        return
+
+                    state = self.application.nonces.check(
+                        authorization_info.get('nonce') or '',
+                        authorization_info.get('nc') if authorization_info.get('qop') else None,
+                        authorization_info.get('opaque'))
+
+                    if state == nonces.VALID:
                         self.json_response({"authenticated": True,
                                             'password': password,
                                             'username': username,
                                             'auth-type': 'digest'})
                     else:
-                        self.set_status(403)
-                        self.finish()
+                        # Credentials are valid, so only expired nonce needs new challenge
+                        self._request_auth(qop, stale=state == nonces.STALE, algorithm=algorithm)
 
         except Exception:
             print(sys.exc_info()[1])
-            self._request_auth(qop)
+            self._request_auth(qop, algorithm=algorithm)
 
 
 def normalize_url(url):
@@ -487,35 +1328,49 @@ def normalize_url(url):
         return None
 
 
-def normalize_parameters(url):
-    """Normalize url parameters
+def normalize_parameters(items):
+    """Normalize request parameters
 
     The parameters collected in Section 3.4.1.3 are normalized into a
     single string as follow: http://tools.ietf.org/html/rfc5849#section-3.4.1.3.2
+
+    :param items: list of (name, value) pairs
     """
-    items = []
-    # Include any query string parameters from the provided URL
-    query = urlparse.urlparse(url)[4]
-    parameters = parse_qs(utf8(query), keep_blank_values=True)
-    for k, v in parameters.iteritems():
-        parameters[k] = unquote(v[0])
-    url_items = parameters.items()
-    url_items = [(utf8(k), utf8(v)) for k, v in url_items if k != 'oauth_signature']
-    items.extend(url_items)
-
-    items.sort()
-    encoded_str = urlencode(items)
-    # Encode signature parameters per Oauth Core 1.0 protocol
-    # spec draft 7, section 3.6
-    # (http://tools.ietf.org/html/draft-hammer-oauth-07#section-3.6)
-    # Spaces must be encoded with "%20" instead of "+"
-    return encoded_str.replace('+', '%20').replace('%7E', '~')
+    # Names and values are encoded first, then sorted
+    # by name and value using ascending byte value ordering
+    encoded = sorted((url_escape(k), url_escape(v)) for k, v in items if k != 'oauth_signature')
+    return "&".join("%s=%s" % x for x in encoded)
+
+
+def normalize_request(request, authorization=None):
+    """Collect signature base string parts of request
+
+    Query, form encoded body and Authorization header parameters
+    are collected once per request, see
+    http://tools.ietf.org/html/rfc5849#section-3.4.1.3.1
+
+    :param request: tornado request
+    :param authorization: OAuth parameters from Authorization header
+    """
+    items = urlparse.parse_qsl(request.query, keep_blank_values=True)
+
+    if request.headers.get("Content-Type", "").split(";")[0].strip() == \
+           "application/x-www-form-urlencoded" and request.body:
+        items.extend(urlparse.parse_qsl(request.body.decode('utf-8', 'replace'), keep_blank_values=True))
+
+    if authorization:
+        items.extend((k, v) for k, v in authorization.items() if k != 'realm')
+
+    return {
+        'method': request.method,
+        'normalized_url': normalize_url("%s://%s%s" % (request.protocol, request.host.lower(), request.path)),
+        'normalized_parameters': normalize_parameters(items)}
 
 
 def url_escape(value):
     """Returns a valid URL-encoded version of the given value."""
     """Escape a URL including any /."""
-    return quote(value.encode('utf-8'), safe='~')
+    return quote(utf8(value), safe='~')
 
 
 class SignatureMethod(object):
@@ -525,8 +1380,31 @@ class SignatureMethod(object):
     requests. This interface shows the methods expected by the other `oauth`
     modules for signing requests. Subclass it and implement its methods to
     provide a new way to sign requests.
+
+    Signing keys are built once for every (consumer_secret, token_secret) pair
+    and cached, because clients sign many requests with the same secrets.
     """
 
+    name = None
+
+    # Signing keys of (name, consumer_secret, token_secret)
+    keys = LRUCache(1024)
+
+    def build_key(self, consumer_secret, token_secret):
+        """Build signing key from secrets
+        """
+        key = '%s&' % url_escape(consumer_secret)
+        if token_secret:
+            key += url_escape(token_secret)
+        return key
+
+    def signing_key(self, consumer_secret, token_secret):
+        cache_key = (self.name, consumer_secret, token_secret)
+        key = self.keys.get(cache_key)
+        if key is None:
+            key = self.keys.set(cache_key, self.build_key(consumer_secret, token_secret))
+        return key
+
     def signing_base(self, request, consumer_secret, token_secret):
         """Calculates the string that needs to be signed.
 
@@ -534,6 +1412,20 @@ class SignatureMethod(object):
         signing and the message to be signed. The latter may be used in error
         messages to help clients debug their software.
 
+        """
+        if not request.get('normalized_url') or request.get('method') is None:
+            raise ValueError("Base URL for request is not set.")
+
+        sig = (
+            url_escape(request['method']),
+            url_escape(request['normalized_url']),
+            url_escape(request['normalized_parameters']),
+        )
+
+        return self.signing_key(consumer_secret, token_secret), '&'.join(sig)
+
+    def build(self, key, raw):
+        """Returns the signature of signing base string `raw`
         """
         raise NotImplementedError
 
@@ -545,44 +1437,73 @@ class SignatureMethod(object):
         message to sign. Otherwise it may be less useful for debugging.
 
         """
-        raise NotImplementedError
+        return self.build(*self.signing_base(request, consumer_secret, token_secret))
+
+    def verify(self, key, raw, signature):
+        """Compare signature of `raw` with given one in constant time
+        """
+        return hmac.compare_digest(utf8(self.build(key, raw)), utf8(signature))
 
     def check(self, request, consumer_secret, token_secret, signature):
         """Returns whether the given signature is the correct signature for
         the given consumer and token signing the given request."""
-        built = self.sign(request, consumer_secret, token_secret)
-        return built == signature
+        key, raw = self.signing_base(request, consumer_secret, token_secret)
+        return self.verify(key, raw, signature)
 
 
 class SignatureMethod_HMAC_SHA1(SignatureMethod):
     name = 'HMAC-SHA1'
+    digestmod = sha
 
-    def signing_base(self, request, consumer_secret, token_secret=None):
-        if not request.get('normalized_url') or request.get('method') is None:
-            raise ValueError("Base URL for request is not set.")
+    def build_key(self, consumer_secret, token_secret):
+        # Keyed HMAC object is copied for every request,
+        # so key padding is hashed once
+        key = super(SignatureMethod_HMAC_SHA1, self).build_key(consumer_secret, token_secret)
+        return hmac.new(utf8(key), digestmod=self.digestmod)
 
-        sig = (
-            url_escape(request['method']),
-            url_escape(request['normalized_url']),
-            url_escape(request['normalized_parameters']),
-        )
+    def build(self, key, raw):
+        """Builds the base signature string.
+        """
+        hashed = key.copy()
+        hashed.update(utf8(raw))
 
-        key = '%s&' % url_escape(consumer_secret)
-        if token_secret:
-            key += url_escape(token_secret)
+        # Calculate the digest base 64.
+        return binascii.b2a_base64(hashed.digest())[:-1].decode('ascii')
 
-        raw = '&'.join(sig)
-        return key, raw
 
-    def sign(self, request, consumer_secret, token_secret=None):
-        """Builds the base signature string.
-        """
-        key, raw = self.signing_base(request, consumer_secret, token_secret)
+class SignatureMethod_HMAC_SHA256(SignatureMethod_HMAC_SHA1):
+    name = 'HMAC-SHA256'
+    digestmod = sha256
 
-        hashed = hmac.new(key, raw, sha)
 
-        # Calculate the digest base 64.
-        return binascii.b2a_base64(hashed.digest())[:-1]
+class SignatureMethod_RSA_SHA1(SignatureMethod):
+    """OAuth RSA-SHA1 signature
+
+    Requests are signed with test private key, it's available
+    on /oauth/rsa_key endpoint. Consumer and token secrets aren't used.
+    """
+
+    name = 'RSA-SHA1'
+
+    def __init__(self, key_file):
+        self.key_file = key_file
+        self._key = None
+
+    def signing_key(self, consumer_secret, token_secret):
+        if self._key is None:
+            with open(self.key_file) as f:
+                self._key = load_rsa_key(f.read())
+        return self._key
+
+    def build(self, key, raw):
+        return binascii.b2a_base64(rsa_sign_sha1(key, raw))[:-1].decode('ascii')
+
+    def verify(self, key, raw, signature):
+        try:
+            signature = binascii.a2b_base64(utf8(signature))
+        except (binascii.Error, TypeError):
+            return False
+        return rsa_verify_sha1(key, raw, signature)
 
 
 class SignatureMethod_PLAINTEXT(SignatureMethod):
@@ -598,21 +1519,18 @@ class SignatureMethod_PLAINTEXT(SignatureMethod):
     def signing_base(self, request, consumer_secret, token_secret):
         """Concatenates the consumer key and secret with the token's secret.
         """
-
-        sig = '%s&' % url_escape(consumer_secret)
-        if token_secret:
-            sig = sig + url_escape(token_secret)
+        sig = self.signing_key(consumer_secret, token_secret)
         return sig, sig
 
-    def sign(self, request, consumer_secret, token_secret):
-        key, raw = self.signing_base(request, consumer_secret, token_secret)
-        return url_escape(raw)
+    def build(self, key, raw):
+        return raw
 
 
 SIGNATURES_METHODS = {
-    # 'RSA-SHA1': SignatureMethod_RSA_SHA1
-    'HMAC-SHA1': SignatureMethod_HMAC_SHA1,
-    'PLAINTEXT': SignatureMethod_PLAINTEXT}
+    'RSA-SHA1': SignatureMethod_RSA_SHA1(rel("templates", "oauth_rsa.pem")),
+    'HMAC-SHA1': SignatureMethod_HMAC_SHA1(),
+    'HMAC-SHA256': SignatureMethod_HMAC_SHA256(),
+    'PLAINTEXT': SignatureMethod_PLAINTEXT()}
 
 
 class OAuthBaseHandler(CustomHandler):
@@ -629,7 +1547,9 @@ class OAuthBaseHandler(CustomHandler):
         timestamp = int(timestamp)
         now = int(time.time())
         lapsed = now - timestamp
-        if lapsed > self.TIMESTAMP_TRESHOLD:
+        # Timestamps from future are limited too, so nonces
+        # are remembered only within threshold window
+        if abs(lapsed) > self.TIMESTAMP_TRESHOLD:
             self.set_status(401)
             self.finish('Expired timestamp: given %d and now %s has a ' \
                         'greater difference than threshold %d' % (timestamp, int(time.time()),
@@ -637,6 +1557,33 @@ class OAuthBaseHandler(CustomHandler):
             return False
         return True
 
+    def _check_nonce(self, authorization):
+        """Reject request with nonce already used with the same
+        consumer, token and timestamp
+        """
+        if self.application.oauth_nonces.add(int(authorization['oauth_timestamp']),
+                                             authorization['oauth_consumer_key'],
+                                             authorization.get('oauth_token'),
+                                             authorization['oauth_nonce']):
+            return True
+
+        self.set_header("WWW-Authenticate", WWWAuthentication('OAuth',
+                                                              {'realm': 'Fake Realm',
+                                                               'oauth_problem': 'nonce_used'}).to_header())
+        self.set_status(401)
+        self.finish({"success": False,
+                     'tagline': str(choice(taglines)),
+                     'oauth_problem': 'nonce_used',
+                     'oauth_nonce': authorization['oauth_nonce']})
+        return False
+
+    def _check_request(self, authorization, consumer_secret, token_secret=None):
+        """Check timestamp, signature and nonce of request
+        """
+        return self._check_timestamp(authorization.get('oauth_timestamp')) and \
+               self._check_signature(authorization, consumer_secret, token_secret) and \
+               self._check_nonce(authorization)
+
     def _request_auth(self):
         """Response no authentication header
 
@@ -656,39 +1603,53 @@ class OAuthBaseHandler(CustomHandler):
                 if k not in authorization.keys():
                     self._request_auth()
                     self.finish()
+            # Header parameters are percent encoded
+            for k, v in authorization.items():
+                authorization[k] = unquote(v)
         else:
             d = {}
             for k in self.REQUIRED_FIELDS:
                 if k not in self.request.arguments.keys():
                     self._request_auth()
                     self.finish()
-                d[k] = self.request.arguments.get(k)[0]
+                d[k] = self.get_argument(k, strip=False)
             authorization = Authorization('OAuth', d)
 
         return authorization
 
     def _check_signature(self, authorization, consumer_secret, token_secret=None):
-        signature_method = SIGNATURES_METHODS.get(authorization['oauth_signature_method'], 'PLAINTEXT')
+        signature_method = SIGNATURES_METHODS.get(authorization['oauth_signature_method'])
         if not signature_method:
             self.set_status(404)
             self.finish()
+            return False
 
-        request_info = {
-            'method': self.request.method,
-            'normalized_url': normalize_url(self.request.full_url()),
-            'normalized_parameters': normalize_parameters(self.request.full_url()),
-            }
+        # Parameters from header are part of signature base,
+        # query parameters are already collected from query string
+        request_info = normalize_request(
+            self.request, authorization if self.request.headers.get("Authorization") else None)
 
-        if not signature_method().check(request_info, consumer_secret, token_secret, authorization['oauth_signature']):
+        key, raw = signature_method.signing_base(request_info, consumer_secret, token_secret)
+        if not signature_method.verify(key, raw, authorization['oauth_signature']):
             self.set_status(403)
             self.finish({"success": False,
-                     'tagline': str(choice(taglines)),
-                     'signature_string': signature_method().signing_base(request_info, consumer_secret, token_secret)[1],
-                         'signature_hash': signature_method().sign(request_info, consumer_secret, token_secret)})
+                         'tagline': str(choice(taglines)),
+                         'signature_string': raw,
+                         'signature_hash': signature_method.build(key, raw)})
             return False
         return True
 
 
+class OAuthRSAKeyHandler(CustomHandler):
+    """Test private key for RSA-SHA1 signatures
+    """
+
+    def get(self):
+        self.set_header("Content-Type", "application/x-pem-file")
+        with open(SIGNATURES_METHODS['RSA-SHA1'].key_file, "rb") as f:
+            self.finish(f.read())
+
+
 class OAuthRequestTokenHandler(OAuthBaseHandler):
     """OAuth request token
     """
@@ -701,8 +1662,7 @@ class OAuthRequestTokenHandler(OAuthBaseHandler):
         if not authorization:
             raise HTTPError(400)
 
-        self._check_timestamp(authorization.get('oauth_timestamp'))
-        if self._check_signature(authorization, consumer_secret):
+        if self._check_request(authorization, consumer_secret):
             self.finish(urlencode({
                 "oauth_token": token_key,
                 "oauth_token_secret": token_secret}))
@@ -735,9 +1695,7 @@ class OAuthAccessTokenHandler(OAuthBaseHandler):
             raise HTTPError(400)
 
         authorization = self.get_authorization()
-        self._check_timestamp(authorization.get('oauth_timestamp'))
-
-        if self._check_signature(authorization, str(consumer_secret), str(tmp_token_secret)):
+        if self._check_request(authorization, str(consumer_secret), str(tmp_token_secret)):
             # token and token_secret for protected sources
             self.finish(urlencode({
                 "oauth_token": token_key,
@@ -758,8 +1716,7 @@ class OAuthProtectedResourceHandler(OAuthBaseHandler):
             raise HTTPError(400)
         authorization = self.get_authorization()
 
-        self._check_timestamp(authorization.get('oauth_timestamp'))
-        if self._check_signature(authorization, consumer_secret, token_secret):
+        if self._check_request(authorization, consumer_secret, token_secret):
             # token and token_secret for protected sources
             data = self.get_data()
             data['success'] = True
@@ -769,6 +1726,122 @@ class OAuthProtectedResourceHandler(OAuthBaseHandler):
         return self.get()
 
 
+class OAuth2TokenHandler(CustomHandler):
+    """OAuth 2.0 token endpoint
+
+    Supports client_credentials, password and refresh_token grants,
+    client authenticates with HTTP Basic or client_id and client_secret parameters
+    """
+
+    GRANT_TYPES = ('client_credentials', 'password', 'refresh_token')
+
+    def error(self, status, error, description=None):
+        if status == 401:
+            self.set_header("WWW-Authenticate", WWWAuthentication('Basic',
+                                                                  {'realm': 'Fake Realm'}).to_header())
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        data = {"error": error}
+        if description:
+            data["error_description"] = description
+        self.json_response(data)
+
+    def get_client(self):
+        auth = self.request.headers.get("Authorization")
+        if auth and auth.startswith("Basic "):
+            authorization = Authorization.from_string(auth)
+            if authorization:
+                return authorization['username'], authorization['password']
+        return self.get_argument("client_id", None), self.get_argument("client_secret", None)
+
+    def post(self, client_id, client_secret):
+        if self.get_client() != (client_id, client_secret):
+            return self.error(401, "invalid_client")
+
+        grant_type = self.get_argument("grant_type", None)
+        if grant_type not in self.GRANT_TYPES:
+            return self.error(400, "unsupported_grant_type")
+
+        try:
+            expires_in = int(self.get_argument("expires_in", self.settings['oauth2_token_ttl']))
+        except ValueError:
+            return self.error(400, "invalid_request", "expires_in must be integer")
+        if not 0 < expires_in <= 86400:
+            return self.error(400, "invalid_request", "expires_in must be in 1..86400")
+
+        tokens = self.application.tokens
+        claims = {"client_id": client_id,
+                  "scope": self.get_argument("scope", "")}
+
+        if grant_type == "password":
+            username = self.get_argument("username", None)
+            if not username or not self.get_argument("password", None):
+                return self.error(400, "invalid_request", "username and password required")
+            claims["sub"] = username
+
+        elif grant_type == "refresh_token":
+            try:
+                refresh = tokens.verify(self.get_argument("refresh_token", ""))
+            except ValueError:
+                return self.error(400, "invalid_grant", str(sys.exc_info()[1]))
+            if refresh.get("token_use") != "refresh" or refresh.get("client_id") != client_id:
+                return self.error(400, "invalid_grant", "refresh token of other client")
+            claims["sub"] = refresh.get("sub")
+            claims["scope"] = refresh.get("scope", "")
+
+        data = {"access_token": tokens.issue(dict(claims, token_use="access"), expires_in),
+                "token_type": "Bearer",
+                "expires_in": expires_in,
+                "scope": claims["scope"]}
+
+        # Client credentials grant shouldn't return refresh token
+        if grant_type != "client_credentials":
+            data["refresh_token"] = tokens.issue(dict(claims, token_use="refresh"),
+                                                 expires_in * 24)
+
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-store")
+        self.set_header("Pragma", "no-cache")
+        self.json_response(data)
+
+
+class OAuth2ProtectedResourceHandler(CustomHandler):
+    """OAuth 2.0 protected resource
+
+    Requires Authorization: Bearer header with access token
+    """
+
+    def _request_auth(self, error=None, description=None):
+        challenge = {'realm': 'Fake Realm'}
+        if error:
+            challenge['error'] = error
+        if description:
+            challenge['error_description'] = description
+        self.set_header("WWW-Authenticate", WWWAuthentication('Bearer', challenge).to_header())
+        self.set_status(401)
+        self.finish()
+
+    def get(self):
+        auth = self.request.headers.get("Authorization", "")
+        if not auth.lower().startswith("bearer "):
+            return self._request_auth()
+
+        try:
+            claims = self.application.tokens.verify(auth[7:].strip())
+        except ValueError:
+            return self._request_auth("invalid_token", str(sys.exc_info()[1]))
+
+        if claims.get("token_use") != "access":
+            return self._request_auth("invalid_token", "Access token required")
+
+        data = self.get_data()
+        data['success'] = True
+        data['claims'] = claims
+        self.json_response(data)
+
+    post = get
+
+
 class METHODHandler(CustomHandler):
     """Base class for methods handlers
     """
@@ -776,33 +1849,68 @@ class METHODHandler(CustomHandler):
 
 
 class GZipHandler(METHODHandler):
-    """Returns Gziped response
+    """Returns gzipped response, `size` argument adds padding, `level` sets compression level
     """
 
+    encoding = "gzip"
+    data_key = "gzipped"
+
+    @asynchronous
     def get(self):
-        from gzip import GzipFile
+        try:
+            level = int(self.get_argument("level", 7))
+            size = int(self.get_argument("size", 0))
+        except ValueError:
+            raise HTTPError(400)
 
-        data = self.get_data()
-        data['gzipped'] = True
-        json_response = self.json_response(data, finish=False)
+        if not 0 <= level <= 9 or not 0 <= size <= self.settings['max_compress_size']:
+            raise HTTPError(400)
 
-        tmp_buffer = BytesIO()
+        data = self.get_data()
+        data[self.data_key] = True
+
+        # Static padding goes first, so it can be compressed once
+        # and response is still valid JSON
+        opening = b'{"padding": "'
+        closing = b'", '
+        dynamic = self.json_response(data, finish=False)[1:]
+
+        self.set_header("Content-Encoding", self.encoding)
+
+        if size > self.settings.get('compress_cache_max_size', 1024 * 1024):
+            self.write_chunks(compress_chunks(
+                self._padding(opening, closing, size, dynamic), level, self.encoding))
+            return
+
+        static = None
+        if size:
+            key = (level, size)
+            static = self.application.compressed.get(key)
+            if static is None:
+                static = self.application.compressed.set(key, deflate_static(
+                    self._padding(opening, closing, size), level))
+        else:
+            dynamic = b"{" + dynamic
 
-        gziped_buffer = GzipFile(
-            fileobj=tmp_buffer,
-            mode="wb",
-            compresslevel=7)
+        body = b"".join(compress_chunks([dynamic], level, self.encoding, static))
+        self.set_header("Content-Length", len(body))
+        self.finish(body)
 
-        gziped_buffer.write(json_response)
-        gziped_buffer.close()
+    def _padding(self, opening, closing, size, dynamic=None):
+        yield opening
+        for chunk in pattern_chunks(0, size):
+            yield chunk
+        yield closing
+        if dynamic is not None:
+            yield dynamic
 
-        gzipped_data = tmp_buffer.getvalue()
 
-        self.set_header("Content-Encoding", 'gzip')
-        self.set_header("Content-Length", str(len(gzipped_data)))
+class DeflateHandler(GZipHandler):
+    """Returns deflated response, `size` argument adds padding, `level` sets compression level
+    """
 
-        tmp_buffer.close()
-        self.finish(gzipped_data)
+    encoding = "deflate"
+    data_key = "deflated"
 
 
 class GETHandler(METHODHandler):
@@ -856,7 +1964,10 @@ class OPTIONSHandler(METHODHandler):
         self.json_response(self.get_data())
 
 
-class Middleware(object):
+class Middleware(httputil.HTTPServerConnectionDelegate):
+    """Application wrapper for HTTP server,
+    other attributes are taken from application
+    """
 
     def __init__(self, application):
         self.application = application
@@ -864,24 +1975,59 @@ class Middleware(object):
     def __call__(self, request, *args, **kwargs):
         return self.application(request, *args, **kwargs)
 
+    def __getattr__(self, name):
+        return getattr(self.application, name)
+
+    def start_request(self, server_conn, request_conn):
+        return self.application.start_request(server_conn, request_conn)
+
+    def on_close(self, server_conn):
+        self.application.on_close(server_conn)
+
+
+class FaultInjectionMiddleware(Middleware):
+    """Inject faults selected by application `faults` into responses
+    """
+
+    def start_request(self, server_conn, request_conn):
+        connection = FaultyConnection(request_conn)
+        return FaultDelegate(self.application.faults, connection,
+                             self.application.start_request(server_conn, connection))
+
+
+class NetworkProfileMiddleware(Middleware):
+    """Shape responses by network profile selected by application `network`
+    """
+
+    def start_request(self, server_conn, request_conn):
+        connection = ShapedConnection(request_conn, self.application.shaping_ticker)
+        return ShapingDelegate(self.application.network, connection,
+                               self.application.start_request(server_conn, connection))
+
+
+def wrap_application(application):
+    """Wrap application with network shaping and fault injection for HTTP server
+    """
+    return NetworkProfileMiddleware(FaultInjectionMiddleware(application))
+
 
 application = HTTPApplication()
 
 
 if __name__ == "__main__":
     tornado.options.parse_command_line()
-    http_server = httpserver.HTTPServer(application)
+    http_server = HTTPServer(wrap_application(application))
 
     certfile = rel("server.crt")
     keyfile = rel("server.key")
 
     if os.path.exists(certfile) and os.path.exists(keyfile):
-        https_server = httpserver.HTTPServer(application, ssl_options={
+        https_server = HTTPServer(wrap_application(application), ssl_options={
             "certfile": certfile,
             "keyfile": keyfile})
         https_server.listen(options.ssl_port)
 
     http_server.listen(options.port)
     ioloop = tornado.ioloop.IOLoop.instance()
-    autoreload.start(io_loop=ioloop, check_time=100)
+    autoreload.start(check_time=100)
     ioloop.start()
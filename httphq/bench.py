@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.bench
+~~~~~~~~~~~~
+
+HTTP load generator
+
+Raw non-blocking sockets driven by tornado IOLoop handlers,
+with keep-alive, weighted requests mix and multi-process mode.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import json
+import math
+import time
+import errno
+import socket
+import random
+from bisect import bisect
+from datetime import timedelta
+from multiprocessing import Pool
+
+try:
+    import urlparse
+except ImportError:
+    # Python3
+    from urllib import parse as urlparse
+
+import tornado.ioloop
+import tornado.web
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+METHODS = ("get", "post", "put", "delete", "head", "options")
+
+# Reconnect delay after failed request, doubled on every failure in a row
+RETRY_DELAY = 0.01
+MAX_RETRY_DELAY = 1.0
+
+# Latency histogram buckets grow by 1% starting from 1 microsecond,
+# so percentiles are within 1% of exact values
+HISTOGRAM_MIN = 0.000001
+HISTOGRAM_GROWTH = math.log(1.01)
+
+
+def parse_mix(value, handlers=None):
+    """Parse requests mix
+
+    Mix is a comma separated list of `[METHOD ]path[:weight]` items.
+    `all` uses example urls of all registered `handlers`.
+
+    :return: list of (method, path, weight) tuples
+    """
+    if value.strip() == "all":
+        if handlers is None:
+            raise ValueError("Registered routes required for `all` mix")
+        mix = []
+        for endpoint, handler in handlers:
+            for method in METHODS:
+                if getattr(handler, method) is not getattr(tornado.web.RequestHandler, method):
+                    mix.append((method.upper(), endpoint['default_url'], 1))
+                    break
+        return mix
+
+    mix = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        method = "GET"
+        if " " in item:
+            method, item = item.split(None, 1)
+        weight = 1
+        if ":" in item:
+            item, weight = item.rsplit(":", 1)
+            weight = int(weight)
+        if weight <= 0:
+            raise ValueError("Weight must be positive: {0}".format(item))
+        mix.append((method.upper(), item, weight))
+
+    if not mix:
+        raise ValueError("Empty requests mix")
+    return mix
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets
+
+    Memory depends on latencies range only, not on number of requests.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        index = int(math.log(max(value, HISTOGRAM_MIN) / HISTOGRAM_MIN) / HISTOGRAM_GROWTH)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """Nearest-rank percentile, upper bound of the bucket
+        """
+        if not self.count:
+            return None
+        rank = min(max(int(self.count * p / 100.0 + 0.999999), 1), self.count)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                value = HISTOGRAM_MIN * math.exp((index + 1) * HISTOGRAM_GROWTH)
+                return min(max(value, self.min), self.max)
+
+
+class ResponseParser(object):
+    """Incremental HTTP/1.1 response parser
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.reset()
+
+    def reset(self):
+        self.status = None
+        self.close = False
+        self.headers_done = False
+        self.length = None
+        self.chunked = False
+        self.until_close = False
+
+    def parse_headers(self, data):
+        lines = data.split(b"\r\n")
+        self.status = int(lines[0].split(None, 2)[1])
+        version = lines[0].split(None, 1)[0]
+        self.close = version == b"HTTP/1.0"
+
+        for line in lines[1:]:
+            if b":" not in line:
+                continue
+            name, value = line.split(b":", 1)
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b"content-length":
+                self.length = int(value)
+            elif name == b"transfer-encoding" and b"chunked" in value:
+                self.chunked = True
+            elif name == b"connection":
+                self.close = value == b"close"
+
+        if self.method == "HEAD" or self.status in (204, 304) or 100 <= self.status < 200:
+            self.length = 0
+            self.chunked = False
+        elif self.length is None and not self.chunked:
+            self.until_close = True
+            self.close = True
+        self.headers_done = True
+
+    def feed(self, buffer):
+        """Try to parse complete response from the buffer start
+
+        :return: size of parsed response or None if more data required
+        """
+        if not self.headers_done:
+            end = buffer.find(b"\r\n\r\n")
+            if end == -1:
+                return None
+            self.parse_headers(bytes(buffer[:end]))
+            self.body_start = end + 4
+
+        if self.until_close:
+            return None
+
+        if not self.chunked:
+            end = self.body_start + self.length
+            return end if len(buffer) >= end else None
+
+        position = self.body_start
+        while True:
+            line_end = buffer.find(b"\r\n", position)
+            if line_end == -1:
+                return None
+            size = int(bytes(buffer[position:line_end]).split(b";", 1)[0], 16)
+            if size == 0:
+                trailer_end = buffer.find(b"\r\n\r\n", line_end)
+                if buffer[line_end:line_end + 4] == b"\r\n\r\n":
+                    return line_end + 4
+                return trailer_end + 4 if trailer_end != -1 else None
+            position = line_end + 2 + size + 2
+            if len(buffer) < position:
+                return None
+
+
+class Connection(object):
+    """Single client connection, sends requests one by one
+    """
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.io_loop = bench.io_loop
+        self.socket = None
+        self.buffer = bytearray()
+        # Failed requests in a row
+        self.failures = 0
+
+    def connect(self):
+        self.socket = socket.socket(self.bench.family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(0)
+        self.connected = False
+        self.io_loop.add_handler(self.socket.fileno(), self.handle_events,
+                                 tornado.ioloop.IOLoop.WRITE | tornado.ioloop.IOLoop.ERROR)
+        self.start_request()
+        err = self.socket.connect_ex(self.bench.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail()
+
+    def start_request(self):
+        self.method, self.request = self.bench.next_request()
+        self.parser = ResponseParser(self.method)
+        self.sent = 0
+        self.started = time.time()
+
+    def close(self):
+        if self.socket is not None:
+            self.io_loop.remove_handler(self.socket.fileno())
+            self.socket.close()
+            self.socket = None
+        self.buffer = bytearray()
+
+    def fail(self):
+        self.bench.errors += 1
+        self.failures += 1
+        self.close()
+        if self.failures >= self.bench.max_failures:
+            # Target is down, give up instead of reconnecting in a loop
+            self.bench.connection_done(self)
+        elif not self.bench.running:
+            self.next()
+        else:
+            delay = min(RETRY_DELAY * 2 ** (self.failures - 1), MAX_RETRY_DELAY)
+            self.io_loop.add_timeout(timedelta(seconds=delay), self.next)
+
+    def next(self):
+        if not self.bench.running:
+            self.close()
+            self.bench.connection_done(self)
+        elif self.socket is None:
+            self.connect()
+        else:
+            self.start_request()
+            self.io_loop.update_handler(self.socket.fileno(),
+                                        tornado.ioloop.IOLoop.WRITE | tornado.ioloop.IOLoop.ERROR)
+
+    def handle_events(self, fd, events):
+        if events & tornado.ioloop.IOLoop.ERROR:
+            return self.fail()
+        try:
+            if events & tornado.ioloop.IOLoop.WRITE:
+                self.handle_write()
+            elif events & tornado.ioloop.IOLoop.READ:
+                self.handle_read()
+        except socket.error:
+            self.fail()
+
+    def handle_write(self):
+        if not self.connected:
+            err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                return self.fail()
+            self.connected = True
+
+        self.sent += self.socket.send(self.request[self.sent:])
+        if self.sent >= len(self.request):
+            self.io_loop.update_handler(self.socket.fileno(),
+                                        tornado.ioloop.IOLoop.READ | tornado.ioloop.IOLoop.ERROR)
+
+    def handle_read(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+
+        if not data:
+            # Connection closed by server
+            if self.parser.until_close:
+                return self.done(len(self.buffer))
+            return self.fail()
+
+        self.buffer.extend(data)
+        size = self.parser.feed(self.buffer)
+        if size is not None:
+            self.done(size)
+
+    def done(self, size):
+        self.failures = 0
+        self.bench.record(self.parser.status, size, time.time() - self.started)
+        del self.buffer[:size]
+        if self.parser.close or not self.bench.keep_alive:
+            self.close()
+        self.next()
+
+
+class Bench(object):
+    """HTTP load generator
+
+    :param url: target base url
+    :param mix: list of (method, path, weight) tuples
+    :param concurrency: number of parallel connections
+    :param duration: test duration in seconds
+    :param keep_alive: reuse connections between requests
+    :param max_failures: connection stops after so many failed requests in a row
+    """
+
+    def __init__(self, url, mix, concurrency=10, duration=10, keep_alive=True, max_failures=10):
+        scheme, netloc, path = urlparse.urlparse(url)[:3]
+        if scheme != "http":
+            raise ValueError("Only http urls are supported")
+
+        host, _, port = netloc.partition(":")
+        port = int(port or 80)
+        info = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+        self.family, self.address = info[0], info[4]
+
+        self.mix = []
+        self.weights = []
+        total = 0
+        prefix = path.rstrip("/")
+        for method, request_path, weight in mix:
+            headers = ["{0} {1}{2} HTTP/1.1".format(method, prefix, request_path),
+                       "Host: {0}".format(netloc),
+                       "User-Agent: httphq-bench"]
+            if method in ("POST", "PUT"):
+                headers.append("Content-Length: 0")
+            if not keep_alive:
+                headers.append("Connection: close")
+            total += weight
+            self.weights.append(total)
+            self.mix.append((method, ("\r\n".join(headers) + "\r\n\r\n").encode("ascii")))
+
+        self.total_weight = total
+        self.concurrency = concurrency
+        self.duration = duration
+        self.keep_alive = keep_alive
+        self.max_failures = max_failures
+
+        self.latencies = Histogram()
+        self.connections = set()
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+        self.running = False
+
+    def next_request(self):
+        if len(self.mix) == 1:
+            return self.mix[0]
+        return self.mix[bisect(self.weights, random.random() * self.total_weight)]
+
+    def record(self, status, size, latency):
+        self.latencies.add(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+
+    def connection_done(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+            if not self.connections:
+                self.io_loop.stop()
+
+    def stop(self):
+        """Stop load test, requests in progress are aborted
+        """
+        self.running = False
+        for connection in list(self.connections):
+            connection.close()
+            self.connection_done(connection)
+
+    def run(self):
+        """Run load test and return raw results
+        """
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.running = True
+        self.started = time.time()
+
+        for x in range(self.concurrency):
+            connection = Connection(self)
+            self.connections.add(connection)
+            connection.connect()
+
+        self.io_loop.add_timeout(timedelta(seconds=self.duration), self.stop)
+        self.io_loop.start()
+        self.io_loop.close(all_fds=True)
+
+        return {"requests": self.latencies.count,
+                "errors": self.errors,
+                "bytes": self.bytes,
+                "elapsed": time.time() - self.started,
+                "statuses": self.statuses,
+                "latencies": self.latencies}
+
+
+def run_worker(options):
+    """Run single bench process
+    """
+    return Bench(**options).run()
+
+
+def merge_results(results):
+    """Merge raw results of bench processes into report
+    """
+    latencies = Histogram()
+    for result in results:
+        latencies.merge(result["latencies"])
+    requests = sum(x["requests"] for x in results)
+    elapsed = max(x["elapsed"] for x in results)
+
+    statuses = {}
+    for result in results:
+        for status, count in result["statuses"].items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    report = {
+        "requests": requests,
+        "errors": sum(x["errors"] for x in results),
+        "elapsed": elapsed,
+        "rps": requests / elapsed if elapsed else 0,
+        "throughput": sum(x["bytes"] for x in results) / elapsed if elapsed else 0,
+        "statuses": statuses,
+        "latency": {
+            "min": latencies.min,
+            "max": latencies.max,
+            "mean": latencies.mean()}}
+
+    for p in PERCENTILES:
+        report["latency"]["p{0}".format(str(p).replace(".", ""))] = latencies.percentile(p)
+    return report
+
+
+def run(url, mix, concurrency=10, duration=10, keep_alive=True, processes=1):
+    """Run load test, optionally spread over several processes
+
+    :return: report dict
+    """
+    processes = max(min(processes, concurrency), 1)
+    options = []
+    for i in range(processes):
+        # Spread connections evenly between processes
+        options.append({"url": url,
+                        "mix": mix,
+                        "concurrency": concurrency // processes + (1 if i < concurrency % processes else 0),
+                        "duration": duration,
+                        "keep_alive": keep_alive})
+
+    if processes == 1:
+        results = [run_worker(options[0])]
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(run_worker, options)
+        finally:
+            pool.close()
+
+    report = merge_results(results)
+    report.update({"url": url,
+                   "concurrency": concurrency,
+                   "processes": processes,
+                   "keep_alive": keep_alive,
+                   "mix": [list(x) for x in mix]})
+    return report
+
+
+def format_report(report):
+    """Human readable report
+    """
+    def ms(value):
+        return "{0:.3f} ms".format(value * 1000) if value is not None else "-"
+
+    lines = ["Requests:    {0} ({1} errors) in {2:.2f}s".format(
+                 report["requests"], report["errors"], report["elapsed"]),
+             "RPS:         {0:.2f}".format(report["rps"]),
+             "Throughput:  {0:.2f} KB/s".format(report["throughput"] / 1024.0),
+             "Statuses:    {0}".format(", ".join("{0}: {1}".format(k, v)
+                                                  for k, v in sorted(report["statuses"].items()))),
+             "Latency:     min {0}, mean {1}, max {2}".format(
+                 ms(report["latency"]["min"]), ms(report["latency"]["mean"]), ms(report["latency"]["max"]))]
+
+    for p in PERCENTILES:
+        key = "p{0}".format(str(p).replace(".", ""))
+        lines.append("  {0:<10} {1}".format(key, ms(report["latency"][key])))
+    return "\n".join(lines)
+
+
+def dump_report(report, filename):
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.bins
+~~~~~~~~~~~
+
+Requests inspection bins
+
+Every bin keeps last requests in fixed size ring buffer,
+all bins share global memory budget and idle bins are evicted first,
+then the oldest records of the bin being written.
+Bins live in worker memory, so use single worker to inspect them.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import time
+import binascii
+from collections import OrderedDict
+
+# Approximate size of record object itself
+RECORD_OVERHEAD = 512
+
+# Approximate size of empty bin, its buffer takes a pointer per record
+BIN_OVERHEAD = 256
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _truncate(values, budget):
+    """Cut list of strings to `budget` total length
+
+    :return: (kept values, budget left)
+    """
+    kept = []
+    for value in values:
+        if budget <= 0:
+            break
+        kept.append(value[:budget])
+        budget -= len(kept[-1])
+    return kept, budget
+
+
+class Record(object):
+    """Captured request
+
+    Body, arguments and files share `max_body_size` budget.
+    """
+
+    __slots__ = ("method", "url", "ip", "headers", "args", "body", "files", "time", "size")
+
+    def __init__(self, method, data, max_body_size=64 * 1024):
+        self.method = method
+        self.url = data['url']
+        self.ip = data['ip']
+        self.headers = data['headers']
+        self.body = data.get('body', b"")[:max_body_size]
+        self.time = data['start_time']
+
+        budget = max_body_size - len(self.body)
+        self.args = {}
+        for name, values in data['args'].items():
+            if budget <= 0:
+                break
+            budget -= len(name)
+            self.args[name], budget = _truncate(values, budget)
+
+        self.files = None
+        if data.get('files'):
+            self.files = {}
+            for name, files in data['files'].items():
+                if budget <= 0:
+                    break
+                self.files[name] = []
+                for x in files:
+                    body, budget = _truncate([x['body']], budget)
+                    if not body:
+                        break
+                    self.files[name].append(dict(x, body=body[0]))
+
+        self.size = RECORD_OVERHEAD + len(self.url) + len(self.body) + \
+                    sum(len(k) + len(v) for k, v in self.headers.items()) + \
+                    sum(len(k) + sum(len(x) for x in v) for k, v in self.args.items())
+        if self.files:
+            self.size += sum(len(x['body']) for v in self.files.values() for x in v)
+
+    def to_dict(self):
+        result = {"method": self.method,
+                  "url": self.url,
+                  "ip": self.ip,
+                  "headers": self.headers,
+                  "args": self.args,
+                  "body": _text(self.body),
+                  "time": self.time}
+        if self.files:
+            result["files"] = dict((k, [dict(x, body=_text(x['body'])) for x in v])
+                                   for k, v in self.files.items())
+        return result
+
+
+class Bin(object):
+    """Fixed size ring buffer of records
+    """
+
+    __slots__ = ("id", "records", "position", "count", "size", "created", "last_access")
+
+    def __init__(self, bin_id, capacity):
+        self.id = bin_id
+        self.records = [None] * capacity
+        self.position = 0
+        self.count = 0
+        self.size = BIN_OVERHEAD + 8 * capacity
+        self.created = self.last_access = time.time()
+
+    @property
+    def capacity(self):
+        return len(self.records)
+
+    def push(self, record):
+        """Add record, overwriting the oldest one when buffer is full
+
+        :return: change of bin size in bytes
+        """
+        old = self.records[self.position]
+        self.records[self.position] = record
+        self.position = (self.position + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+        delta = record.size - (old.size if old is not None else 0)
+        self.size += delta
+        return delta
+
+    def drop_oldest(self):
+        """Remove the oldest record
+
+        :return: change of bin size in bytes
+        """
+        index = (self.position - self.count) % self.capacity
+        record = self.records[index]
+        self.records[index] = None
+        self.count -= 1
+        self.size -= record.size
+        return -record.size
+
+    def __iter__(self):
+        """Iterate over records from newest to oldest
+        """
+        for i in range(1, self.count + 1):
+            yield self.records[(self.position - i) % self.capacity]
+
+    def __len__(self):
+        return self.count
+
+    def to_dict(self):
+        return {"id": self.id,
+                "capacity": self.capacity,
+                "count": self.count,
+                "size": self.size,
+                "created": self.created,
+                "last_access": self.last_access}
+
+
+class BinsStorage(object):
+    """Bins with global memory budget
+
+    :param max_size: memory budget for all bins in bytes
+    :param max_capacity: max records in one bin
+    :param max_bins: max number of bins, least recently used are evicted
+    """
+
+    def __init__(self, max_size=32 * 1024 * 1024, max_capacity=200, default_capacity=50,
+                 max_bins=10000):
+        self.max_size = max_size
+        self.max_bins = max_bins
+        self.max_capacity = max_capacity
+        self.default_capacity = default_capacity
+        self.size = 0
+        self.evicted = 0
+        self._bins = OrderedDict()
+
+    def create(self, capacity=None):
+        capacity = min(max(capacity or self.default_capacity, 1), self.max_capacity)
+        bin_id = binascii.hexlify(os.urandom(8)).decode('ascii')
+        bin = self._bins[bin_id] = Bin(bin_id, capacity)
+        self.size += bin.size
+        self._evict(bin)
+        return bin
+
+    def get(self, bin_id):
+        """Get bin by id and mark it as recently used
+        """
+        bin = self._bins.pop(bin_id, None)
+        if bin is not None:
+            bin.last_access = time.time()
+            self._bins[bin_id] = bin
+        return bin
+
+    def delete(self, bin_id):
+        bin = self._bins.pop(bin_id, None)
+        if bin is not None:
+            self.size -= bin.size
+        return bin
+
+    def record(self, bin_id, record):
+        """Add record to bin, evict idle bins over memory budget
+
+        :return: bin or None if it doesn't exist
+        """
+        bin = self.get(bin_id)
+        if bin is None:
+            return None
+
+        self.size += bin.push(record)
+        self._evict(bin)
+        return bin
+
+    def _evict(self, bin):
+        """Drop least recently used bins, then the oldest records of
+        recently used `bin` until storage fits limits
+        """
+        while self.size > self.max_size or len(self._bins) > self.max_bins:
+            oldest = next(iter(self._bins))
+            if oldest != bin.id:
+                self.delete(oldest)
+                self.evicted += 1
+            elif len(bin) > 1:
+                self.size += bin.drop_oldest()
+            else:
+                break
+
+    def __iter__(self):
+        return iter(self._bins.values())
+
+    def __len__(self):
+        return len(self._bins)
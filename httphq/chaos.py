@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.chaos
+~~~~~~~~~~~~
+
+Fault injection into HTTP responses
+
+Faults are configured globally or per request with `X-Chaos` header
+or `chaos` query argument: ``X-Chaos: error=0.1, error_status=503, seed=42``
+or ``?chaos=reset:0.5,reset_after:100``. Probabilities are drawn once when
+request headers are received from seedable random generator.
+
+- `error`: probability to answer `error_status` without calling handler
+- `reset`: probability to reset connection after `reset_after` body bytes
+- `content_length`: probability to send `Content-Length` wrong by `content_length_delta`
+- `truncate`: probability to cut chunked body in the middle of chunk
+- `bad_status`: probability to send malformed status line
+
+Wire faults write raw response as it is written by handler and close
+connection, they aren't drawn for upgrade requests, as upgraded
+connection is detached.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import socket
+import struct
+import random
+
+from tornado import httputil, iostream
+from tornado.concurrent import Future
+from tornado.escape import utf8, native_str
+
+from httphq.settings import responses
+
+# Option name -> (type, default value)
+OPTIONS = {
+    "seed": (int, None),
+    "error": (float, 0.0),
+    "error_status": (int, 500),
+    "reset": (float, 0.0),
+    "reset_after": (int, 0),
+    "content_length": (float, 0.0),
+    "content_length_delta": (int, 10),
+    "truncate": (float, 0.0),
+    "bad_status": (float, 0.0)}
+
+# Faults changing response on the wire, in draw order
+WIRE_FAULTS = ("reset", "content_length", "truncate", "bad_status")
+
+MALFORMED_STATUS_LINES = (
+    b"HTTP/1.1 2OO OK\r\n",
+    b"HTTP/1.1\r\n",
+    b"HTPT/1.1 200 OK\r\n",
+    b"HTTP/1.1 200 OK\n\r",
+    b"HTTP/9.9 999 \xff\xfe\r\n")
+
+
+def parse_options(value, options=None):
+    """Parse ``name=value, name:value`` string, unknown names
+    and invalid values are ignored
+    """
+    options = dict(options or {})
+    for item in value.split(","):
+        item = item.strip()
+        separator = "=" if "=" in item else ":"
+        name, _, item_value = item.partition(separator)
+        name = name.strip().replace("-", "_")
+        if name not in OPTIONS:
+            continue
+        try:
+            options[name] = OPTIONS[name][0](item_value.strip())
+        except ValueError:
+            continue
+    return options
+
+
+class Plan(object):
+    """Faults selected for one request
+
+    :param faults: set of fault names
+    :param options: request options
+    :param random: generator for fault details
+    :param method: request method
+    """
+
+    def __init__(self, faults, options, random, method):
+        self.faults = faults
+        self.options = options
+        self.random = random
+        self.method = method
+
+    def option(self, name):
+        return self.options.get(name, OPTIONS[name][1])
+
+    @property
+    def wire(self):
+        return not self.faults.isdisjoint(WIRE_FAULTS)
+
+
+class FaultInjector(object):
+    """Select faults for requests
+
+    :param defaults: options applied to every request
+    :param seed: seed of shared random generator
+    :param per_request: allow requests to set their own options
+    """
+
+    def __init__(self, defaults=None, seed=None, per_request=True):
+        self.defaults = defaults or {}
+        self.per_request = per_request
+        self.random = random.Random(seed)
+        self.injected = dict((name, 0) for name in ("error",) + WIRE_FAULTS)
+
+    def plan(self, start_line, headers):
+        """Draw faults for request
+
+        :return: `Plan` or None if request isn't affected
+        """
+        options = self.defaults
+        if self.per_request:
+            value = headers.get("X-Chaos")
+            if value is not None:
+                options = parse_options(value, options)
+            if "chaos=" in start_line.path:
+                for value in httputil.parse_qs_bytes(
+                        start_line.path.partition("?")[2]).get("chaos", []):
+                    options = parse_options(native_str(value), options)
+        if not options:
+            return None
+
+        generator = self.random if options.get("seed") is None else random.Random(options["seed"])
+        names = ("error",) if "Upgrade" in headers else ("error",) + WIRE_FAULTS
+        faults = set()
+        for name in names:
+            probability = options.get(name)
+            if probability and generator.random() < probability:
+                faults.add(name)
+                self.injected[name] += 1
+        if not faults:
+            return None
+        return Plan(faults, options, generator, start_line.method)
+
+    def render(self, worker_id=0):
+        """Render counters in Prometheus text format
+        """
+        lines = ["# HELP httphq_faults_injected_total Injected faults",
+                 "# TYPE httphq_faults_injected_total counter"]
+        for name in ("error",) + WIRE_FAULTS:
+            lines.append('httphq_faults_injected_total{worker="%d",fault="%s"} %d' % (
+                worker_id, name, self.injected[name]))
+        return "\n".join(lines) + "\n"
+
+
+
+def done_future(exception=None):
+    future = Future()
+    if exception is None:
+        future.set_result(None)
+    else:
+        future.set_exception(exception)
+        # Mark exception as retrieved, as tornado does for closed streams
+        future.exception()
+    return future
+
+
+def reset_stream(stream):
+    """Close stream with TCP RST instead of FIN
+    """
+    try:
+        stream.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    except (AttributeError, socket.error):
+        pass
+    stream.close()
+
+
+def serialize(plan, start_line, headers, length):
+    """Build raw response head with wire faults of `plan`
+
+    :param length: body length, None if body is sent with chunked encoding
+    """
+    if "bad_status" in plan.faults:
+        lines = [plan.random.choice(MALFORMED_STATUS_LINES)]
+    else:
+        lines = [utf8("HTTP/1.1 %d %s\r\n" % (start_line.code, start_line.reason))]
+
+    for name, value in headers.get_all():
+        if name not in ("Content-Length", "Transfer-Encoding", "Connection"):
+            lines.append(utf8("%s: %s\r\n" % (name, value)))
+    lines.append(utf8("X-Chaos-Fault: %s\r\n" % ",".join(sorted(plan.faults))))
+    lines.append(b"Connection: close\r\n")
+
+    if length is None or "truncate" in plan.faults:
+        lines.append(b"Transfer-Encoding: chunked\r\n\r\n")
+    else:
+        if "content_length" in plan.faults:
+            length = max(0, length + plan.option("content_length_delta"))
+        lines.append(utf8("Content-Length: %d\r\n\r\n" % length))
+    return b"".join(lines)
+
+
+class FaultyConnection(object):
+    """Request connection wrapper
+
+    Responses with wire faults are written to the stream directly as
+    they are written by handler, other calls go to wrapped connection.
+    Body is cut after `reset_after` bytes or in the middle of truncated
+    chunk, wrong `Content-Length` of streamed response is relative
+    to its first part.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.plan = None
+        # Body is framed with chunked encoding
+        self._chunked = False
+        self._no_body = False
+        # Truncated chunk is the first part of body with unknown length
+        self._truncate_next = False
+        # Body bytes written and offset where stream is cut
+        self._sent = 0
+        self._limit = None
+        self._closed = False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def _cut_at(self, offset):
+        self._limit = offset if self._limit is None else min(self._limit, offset)
+
+    def write_headers(self, start_line, headers, chunk=None):
+        if self.plan is None or not self.plan.wire:
+            return self.connection.write_headers(start_line, headers, chunk)
+
+        plan = self.plan
+        self._no_body = plan.method == "HEAD" or start_line.code in (204, 304) or \
+            100 <= start_line.code < 200
+        if self._no_body:
+            length = 0
+        elif "Content-Length" in headers:
+            length = int(headers["Content-Length"])
+        elif "content_length" in plan.faults:
+            length = len(chunk or b"")
+        else:
+            length = None
+
+        head = serialize(plan, start_line, headers, length)
+        if "reset" in plan.faults:
+            self._cut_at(plan.option("reset_after"))
+        if "truncate" in plan.faults:
+            if length is None:
+                self._truncate_next = True
+            else:
+                # Chunk header promises whole body, but only part of it is sent
+                head += utf8("%x\r\n" % max(length, 1))
+                self._cut_at(plan.random.randint(0, length // 2))
+        else:
+            self._chunked = length is None
+
+        future = self._send(head)
+        if chunk:
+            future = self.write(chunk)
+        return future
+
+    def write(self, chunk):
+        if self.plan is None or not self.plan.wire:
+            return self.connection.write(chunk)
+        if self._closed:
+            return done_future(iostream.StreamClosedError())
+        if self._no_body or not chunk:
+            return done_future()
+
+        prefix = b""
+        if self._chunked or self._truncate_next:
+            prefix = utf8("%x\r\n" % len(chunk))
+        if self._truncate_next:
+            self._truncate_next = False
+            self._cut_at(self._sent + self.plan.random.randint(0, len(chunk) // 2))
+
+        if self._limit is not None and self._sent + len(chunk) >= self._limit:
+            chunk = chunk[:self._limit - self._sent]
+            self._sent = self._limit
+            return self._close(prefix + chunk)
+
+        self._sent += len(chunk)
+        return self._send(prefix + chunk + b"\r\n" if self._chunked else prefix + chunk)
+
+    def finish(self):
+        if self.plan is None or not self.plan.wire:
+            return self.connection.finish()
+        if self._closed:
+            return
+        if self._truncate_next:
+            self._close(b"1\r\n")
+        elif self._chunked and not self._no_body:
+            self._close(b"0\r\n\r\n")
+        else:
+            self._close(b"")
+
+    def _send(self, data):
+        stream = self.connection.stream
+        if stream is None or stream.closed():
+            return done_future(iostream.StreamClosedError())
+        return stream.write(data)
+
+    def _close(self, data):
+        """Write last data and close connection, with TCP RST on reset fault
+        """
+        self._closed = True
+        stream = self.connection.stream
+        connection = self.connection
+        reset = "reset" in self.plan.faults
+
+        def on_write(future):
+            if reset and stream is not None:
+                reset_stream(stream)
+            connection.close()
+
+        future = self._send(data)
+        future.add_done_callback(on_write)
+        return future
+
+
+class FaultDelegate(httputil.HTTPMessageDelegate):
+    """Select faults for request, answer injected errors
+    without passing request to application
+    """
+
+    def __init__(self, injector, connection, delegate):
+        self.injector = injector
+        self.connection = connection
+        self.delegate = delegate
+        self.error = False
+        self.method = None
+
+    def headers_received(self, start_line, headers):
+        self.method = start_line.method
+        plan = self.connection.plan = self.injector.plan(start_line, headers)
+        if plan is not None and "error" in plan.faults:
+            self.error = True
+            return None
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        if not self.error:
+            return self.delegate.data_received(chunk)
+
+    def finish(self):
+        if not self.error:
+            return self.delegate.finish()
+
+        status = self.connection.plan.option("error_status")
+        if status not in responses:
+            status = 500
+        body = utf8("%d %s\n" % (status, responses[status]))
+        headers = httputil.HTTPHeaders({"Content-Type": "text/plain",
+                                        "Content-Length": str(len(body)),
+                                        "X-Chaos-Fault": "error"})
+        self.connection.connection.write_headers(
+            httputil.ResponseStartLine("HTTP/1.1", status, responses[status]), headers,
+            body if self.method != "HEAD" else None)
+        self.connection.connection.finish()
+
+    def on_connection_close(self):
+        if not self.error:
+            self.delegate.on_connection_close()
@@ -13,6 +13,10 @@ Add utilities to support python2 and python3
 
 """
 import sys
+from functools import wraps
+
+import tornado
+import tornado.ioloop
 
 py_ver = sys.version_info
 
@@ -34,3 +38,44 @@ else:
     # Python3
     from urllib.parse import urlencode, unquote, quote
     from io import StringIO, BytesIO
+
+
+try:
+    from tornado.web import asynchronous
+except ImportError:
+    # Tornado >= 6.0 removed decorator,
+    # keep connection open until handler calls finish()
+    def asynchronous(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            self._auto_finish = False
+            return method(self, *args, **kwargs)
+        return wrapper
+
+
+if tornado.version_info < (6, 0):
+    def flush(handler, callback):
+        """Flush handler output and run `callback` when it is written
+        """
+        handler.flush(callback=callback)
+else:
+    def flush(handler, callback):
+        """Flush handler output and run `callback` when it is written
+        """
+        def on_flush(future):
+            # Closed stream, stop writing
+            if future.exception() is None:
+                callback()
+        tornado.ioloop.IOLoop.current().add_future(handler.flush(), on_flush)
+
+
+def add_callback_from_signal(io_loop, callback):
+    """Schedule `callback` from signal handler and wake up `io_loop`
+    """
+    asyncio_loop = getattr(io_loop, "asyncio_loop", None)
+    if asyncio_loop is None:
+        io_loop.add_callback_from_signal(callback)
+    else:
+        # IOLoop.add_callback doesn't wake up selector
+        # when it is called from the loop thread
+        asyncio_loop.call_soon_threadsafe(callback)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.encoders
+~~~~~~~~~~~~~~~
+
+Response body encoders
+
+JSON encoders produce bytes. `stdlib` output is the same as
+`tornado.escape.json_encode`, faster `orjson` and `ujson` backends
+are used when installed and differ only in:
+
+- no spaces after `,` and `:` separators
+- non-ASCII characters are written as UTF-8 instead of `\\uXXXX` escapes
+
+All backends escape `</` as `<\\/` and decode bytes values as UTF-8.
+
+Binary encoders write bytes values as binary strings, without base64
+or UTF-8 decoding. `msgpack` and `cbor2` packages are used when installed,
+pure Python encoders produce the same output otherwise.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import json
+import struct
+from numbers import Integral
+from collections import OrderedDict
+
+from tornado.escape import utf8
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+text_type = type(u"")
+binary_types = (bytes, bytearray, memoryview)
+
+
+def _default(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def stdlib_dumps(data):
+    return utf8(json.dumps(data, default=_default).replace("</", "<\\/"))
+
+
+def orjson_dumps(data):
+    # bytes.replace returns the same object when there is nothing to replace
+    return orjson.dumps(data, default=_default,
+                        option=orjson.OPT_NON_STR_KEYS).replace(b"</", b"<\\/")
+
+
+def ujson_dumps(data):
+    return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False,
+                       default=_default).replace("</", "<\\/").encode('utf-8')
+
+
+# Available JSON encoders, the fastest first
+JSON_ENCODERS = OrderedDict()
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = orjson_dumps
+if ujson is not None:
+    JSON_ENCODERS["ujson"] = ujson_dumps
+JSON_ENCODERS["stdlib"] = stdlib_dumps
+
+
+def get_json_encoder(name="auto"):
+    """Get JSON encoder by name, `auto` selects the fastest available one
+
+    :raises ValueError: if encoder isn't available
+    """
+    if name == "auto":
+        return next(iter(JSON_ENCODERS.values()))
+    try:
+        return JSON_ENCODERS[name]
+    except KeyError:
+        raise ValueError("JSON encoder %s isn't available, choose one of: %s" % (
+            name, ", ".join(["auto"] + list(JSON_ENCODERS))))
+
+
+
+# (fixed format prefix, fixed format max length, [(length limit, struct format, type code)])
+_MSGPACK_STR = (0xa0, 32, ((0x100, ">BB", 0xd9), (0x10000, ">BH", 0xda), (0x100000000, ">BI", 0xdb)))
+_MSGPACK_BIN = (None, 0, ((0x100, ">BB", 0xc4), (0x10000, ">BH", 0xc5), (0x100000000, ">BI", 0xc6)))
+_MSGPACK_ARRAY = (0x90, 16, ((0x10000, ">BH", 0xdc), (0x100000000, ">BI", 0xdd)))
+_MSGPACK_MAP = (0x80, 16, ((0x10000, ">BH", 0xde), (0x100000000, ">BI", 0xdf)))
+
+_MSGPACK_UINT = ((0x100, ">BB", 0xcc), (0x10000, ">BH", 0xcd),
+                 (0x100000000, ">BI", 0xce), (0x10000000000000000, ">BQ", 0xcf))
+_MSGPACK_INT = ((-0x80, ">Bb", 0xd0), (-0x8000, ">Bh", 0xd1),
+                (-0x80000000, ">Bi", 0xd2), (-0x8000000000000000, ">Bq", 0xd3))
+
+
+def _msgpack_head(out, length, kind):
+    fix, fix_limit, sizes = kind
+    if length < fix_limit:
+        out.append(struct.pack(">B", fix | length))
+        return
+    for limit, fmt, code in sizes:
+        if length < limit:
+            out.append(struct.pack(fmt, code, length))
+            return
+    raise ValueError("Object is too large for MessagePack")
+
+
+def _pack_msgpack(value, out):
+    if value is None:
+        out.append(b"\xc0")
+    elif value is True:
+        out.append(b"\xc3")
+    elif value is False:
+        out.append(b"\xc2")
+    elif isinstance(value, Integral):
+        if -0x20 <= value < 0x80:
+            out.append(struct.pack(">b" if value < 0 else ">B", value))
+            return
+        for limit, fmt, code in (_MSGPACK_UINT if value > 0 else _MSGPACK_INT):
+            if (value < limit) if value > 0 else (value >= limit):
+                out.append(struct.pack(fmt, code, value))
+                return
+        raise ValueError("Integer is too large for MessagePack")
+    elif isinstance(value, float):
+        out.append(struct.pack(">Bd", 0xcb, value))
+    elif isinstance(value, text_type):
+        value = value.encode('utf-8')
+        _msgpack_head(out, len(value), _MSGPACK_STR)
+        out.append(value)
+    elif isinstance(value, binary_types):
+        value = bytes(value)
+        _msgpack_head(out, len(value), _MSGPACK_BIN)
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        _msgpack_head(out, len(value), _MSGPACK_ARRAY)
+        for item in value:
+            _pack_msgpack(item, out)
+    elif isinstance(value, dict):
+        _msgpack_head(out, len(value), _MSGPACK_MAP)
+        for key, item in value.items():
+            _pack_msgpack(key, out)
+            _pack_msgpack(item, out)
+    else:
+        raise TypeError("%r is not MessagePack serializable" % (value,))
+
+
+def _cbor_head(out, major, value):
+    major <<= 5
+    if value < 24:
+        out.append(struct.pack(">B", major | value))
+    elif value < 0x100:
+        out.append(struct.pack(">BB", major | 24, value))
+    elif value < 0x10000:
+        out.append(struct.pack(">BH", major | 25, value))
+    elif value < 0x100000000:
+        out.append(struct.pack(">BI", major | 26, value))
+    elif value < 0x10000000000000000:
+        out.append(struct.pack(">BQ", major | 27, value))
+    else:
+        raise ValueError("Integer is too large for CBOR")
+
+
+def _pack_cbor(value, out):
+    if value is None:
+        out.append(b"\xf6")
+    elif value is True:
+        out.append(b"\xf5")
+    elif value is False:
+        out.append(b"\xf4")
+    elif isinstance(value, Integral):
+        if value >= 0:
+            _cbor_head(out, 0, value)
+        else:
+            _cbor_head(out, 1, -1 - value)
+    elif isinstance(value, float):
+        out.append(struct.pack(">Bd", 0xfb, value))
+    elif isinstance(value, text_type):
+        value = value.encode('utf-8')
+        _cbor_head(out, 3, len(value))
+        out.append(value)
+    elif isinstance(value, binary_types):
+        value = bytes(value)
+        _cbor_head(out, 2, len(value))
+        out.append(value)
+    elif isinstance(value, (list, tuple)):
+        _cbor_head(out, 4, len(value))
+        for item in value:
+            _pack_cbor(item, out)
+    elif isinstance(value, dict):
+        _cbor_head(out, 5, len(value))
+        for key, item in value.items():
+            _pack_cbor(key, out)
+            _pack_cbor(item, out)
+    else:
+        raise TypeError("%r is not CBOR serializable" % (value,))
+
+
+def msgpack_dumps(data):
+    if msgpack is not None:
+        return msgpack.packb(data, use_bin_type=True)
+    out = []
+    _pack_msgpack(data, out)
+    return b"".join(out)
+
+
+def cbor_dumps(data):
+    if cbor2 is not None:
+        return cbor2.dumps(data)
+    out = []
+    _pack_cbor(data, out)
+    return b"".join(out)
+
+
+# Binary response formats by media type
+BINARY_ENCODERS = OrderedDict([
+    ("application/msgpack", msgpack_dumps),
+    ("application/x-msgpack", msgpack_dumps),
+    ("application/vnd.msgpack", msgpack_dumps),
+    ("application/cbor", cbor_dumps)])
+
+# Response formats in server preference order
+RESPONSE_FORMATS = ("application/json",) + tuple(BINARY_ENCODERS)
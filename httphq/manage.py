@@ -12,17 +12,29 @@ Production management script of HTTP Request & Response service
 :github: http://github.com/Lispython/httphq
 """
 
-import time
+import os
+import sys
+import errno
+import random
 import signal
+import socket
+import binascii
+from datetime import timedelta
 import logging as logging_module
 from logging import StreamHandler
 from optparse import OptionParser, Option
 
 import tornado.ioloop
-from tornado import httpserver, autoreload
-from tornado.options import _LogFormatter
-
-from httphq.app import application
+from tornado import autoreload, netutil, process
+from tornado.log import LogFormatter
+
+from httphq.app import application, wrap_application
+from httphq import bench
+from httphq.compat import add_callback_from_signal
+from httphq.admission import HTTPServer
+from httphq.chaos import FaultInjector, parse_options
+from httphq.network import NetworkProfiles
+from httphq.encoders import get_json_encoder
 from commandor import Command, Commandor
 
 logger = logging_module.getLogger('httphq')
@@ -37,11 +49,160 @@ def configure_logging(logging):
 
     if not logger.handlers:
         channel = StreamHandler()
-        channel.setFormatter(_LogFormatter(color=False))
+        channel.setFormatter(LogFormatter(color=False))
         logger.addHandler(channel)
     logger.info("Logging handler configured with level {0}".format(logging))
 
 
+def bind_sockets(port, host, reuse_port=False):
+    """Create listening sockets bound to `port` and `host`
+
+    With `reuse_port` every socket gets ``SO_REUSEPORT``, so each worker
+    can bind its own socket and the kernel balances connections between them.
+    """
+    if not reuse_port:
+        return netutil.bind_sockets(port, host)
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+    sockets = []
+    for res in set(socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM, 0, socket.AI_PASSIVE)):
+        af, socktype, proto, canonname, sockaddr = res
+        sock = socket.socket(af, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(128)
+        sockets.append(sock)
+    return sockets
+
+
+def set_cpu_affinity(cpu):
+    """Pin current process to given `cpu`"""
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU affinity is not supported on this platform")
+        return False
+    os.sched_setaffinity(0, [cpu])
+    return True
+
+
+class Supervisor(object):
+    """Pre-fork workers and respawn them when they crash
+
+    :param num_workers: number of worker processes
+    :param max_restarts: how many crashed workers can be respawned
+    :param cpu_affinity: pin every worker to its own CPU
+    """
+
+    def __init__(self, num_workers, max_restarts=100, cpu_affinity=False):
+        self.num_workers = num_workers
+        self.max_restarts = max_restarts
+        self.cpu_affinity = cpu_affinity
+        self.children = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def spawn(self, worker_id):
+        """Fork single worker
+
+        :return: `worker_id` in child process and None in parent
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Don't inherit supervisor signal handlers
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            # Workers must not share random state
+            random.seed(int(binascii.hexlify(os.urandom(16)), 16))
+
+            if self.cpu_affinity:
+                set_cpu_affinity(worker_id % process.cpu_count())
+            return worker_id
+
+        self.children[pid] = worker_id
+        return None
+
+    def sig_handler(self, sig, frame):
+        """Forward signal to workers and stop respawning
+        """
+        self.stopping = True
+        for pid in list(self.children.keys()):
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+
+    def terminate(self):
+        """Stop running workers and wait until they exit
+        """
+        self.sig_handler(signal.SIGTERM, None)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                if sys.exc_info()[1].errno == errno.EINTR:
+                    continue
+                self.children.clear()
+                break
+            self.children.pop(pid, None)
+
+    def start(self):
+        """Fork workers and supervise them
+
+        Returns worker id in every child process. Supervisor process
+        exits when all workers are stopped.
+        """
+        for worker_id in range(self.num_workers):
+            if self.spawn(worker_id) is not None:
+                return worker_id
+
+        signal.signal(signal.SIGTERM, self.sig_handler)
+        signal.signal(signal.SIGINT, self.sig_handler)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                if sys.exc_info()[1].errno == errno.EINTR:
+                    continue
+                raise
+
+            if pid not in self.children:
+                continue
+
+            worker_id = self.children.pop(pid)
+
+            if self.stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                logger.warning("Worker {0} (pid {1}) killed by signal {2}, restarting".format(
+                    worker_id, pid, os.WTERMSIG(status)))
+            elif os.WEXITSTATUS(status) != 0:
+                logger.warning("Worker {0} (pid {1}) exited with status {2}, restarting".format(
+                    worker_id, pid, os.WEXITSTATUS(status)))
+            else:
+                logger.info("Worker {0} (pid {1}) exited normally".format(worker_id, pid))
+                continue
+
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                # Don't leave orphaned workers behind
+                self.terminate()
+                raise RuntimeError("Too many worker restarts, giving up")
+
+            if self.spawn(worker_id) is not None:
+                return worker_id
+
+        sys.exit(0)
+
+
 class Commandor(Commandor):
     """Arguments management utilities
     """
@@ -74,24 +235,153 @@ class Start(Command):
         Option("-l", "--logging",
                metavar="str",
                default="none",
-               help="Log level")]
+               help="Log level"),
+        Option("-w", "--workers",
+               metavar="int",
+               type="int",
+               default=1,
+               help="Number of worker processes, 0 - one per CPU"),
+        Option("--reuse-port",
+               action="store_true",
+               dest="reuse_port",
+               default=False,
+               help="Bind SO_REUSEPORT socket in every worker"),
+        Option("--cpu-affinity",
+               action="store_true",
+               dest="cpu_affinity",
+               default=False,
+               help="Pin every worker to its own CPU"),
+        Option("--max-restarts",
+               metavar="int",
+               type="int",
+               dest="max_restarts",
+               default=100,
+               help="How many crashed workers can be respawned"),
+        Option("--json-encoder",
+               metavar="str",
+               dest="json_encoder",
+               default="auto",
+               help="JSON encoder: auto, orjson, ujson or stdlib"),
+        Option("--access-log",
+               metavar="str",
+               dest="access_log",
+               default=None,
+               help="Write JSON lines access log to file, "
+                    "worker id is appended to file name in multi-process mode"),
+        Option("--access-log-sample",
+               metavar="int",
+               type="int",
+               dest="access_log_sample",
+               default=1,
+               help="Record every N-th request only"),
+        Option("--max-connections",
+               metavar="int",
+               type="int",
+               dest="max_connections",
+               default=None,
+               help="Max open connections per worker"),
+        Option("--max-in-flight",
+               metavar="int",
+               type="int",
+               dest="max_in_flight",
+               default=None,
+               help="Max requests processed at once per worker"),
+        Option("--chaos",
+               metavar="str",
+               dest="chaos",
+               default=None,
+               help="Fault injection options for every request, "
+                    "e.g. error=0.1,error_status=503,reset=0.01"),
+        Option("--chaos-seed",
+               metavar="int",
+               type="int",
+               dest="chaos_seed",
+               default=None,
+               help="Seed of fault injection random generator, worker id is added to it"),
+        Option("--network-profile",
+               metavar="str",
+               dest="network_profile",
+               default=None,
+               help="Network profile of every request: 2g, 3g, 4g, satellite, "
+                    "wifi-lossy, slowloris or custom one from settings")]
 
-    def run(self, port, reload, host, logging, **kwargs):
+    def run(self, port, reload, host, logging, workers=1, reuse_port=False,
+            cpu_affinity=False, max_restarts=100, json_encoder="auto",
+            access_log=None, access_log_sample=1, max_connections=None,
+            max_in_flight=None, chaos=None, chaos_seed=None, network_profile=None, **kwargs):
 
         self.display("Configure logging")
         configure_logging(logging)
 
+        try:
+            application.json_dumps = get_json_encoder(json_encoder)
+        except ValueError:
+            self.abort(str(sys.exc_info()[1]))
+
+        if max_connections is not None:
+            application.admission.max_connections = max_connections
+        if max_in_flight is not None:
+            application.admission.max_in_flight = max_in_flight
+
+        if network_profile is not None:
+            settings = application.settings
+            try:
+                application.network = NetworkProfiles(settings['network_profiles'], network_profile,
+                                                      settings['network_profile_requests'],
+                                                      settings['network_seed'])
+            except ValueError:
+                self.abort(str(sys.exc_info()[1]))
+
+        if workers == 0:
+            workers = process.cpu_count()
+
+        # Shared sockets are bound once before fork,
+        # SO_REUSEPORT sockets are bound by every worker
+        sockets = None if reuse_port else bind_sockets(port, host)
+
+        # Metrics shared memory must be allocated before fork
+        application.metrics.allocate(workers)
+
+        worker_id = 0
+        if workers > 1:
+            if reload:
+                self.display("Autoreload disabled in multi-process mode")
+                reload = False
+            self.display("Starting {0} workers".format(workers))
+            worker_id = Supervisor(workers, max_restarts, cpu_affinity).start()
+        elif cpu_affinity:
+            set_cpu_affinity(0)
+
+        application.metrics.worker_id = worker_id
+
+        if chaos is not None or chaos_seed is not None:
+            application.faults = FaultInjector(
+                parse_options(chaos) if chaos else application.settings['chaos'],
+                chaos_seed + worker_id if chaos_seed is not None else None,
+                application.settings['chaos_requests'])
+
+        # Writer thread doesn't survive fork, so it is started by every worker
+        if access_log:
+            if workers > 1:
+                access_log = "{0}.{1}".format(access_log, worker_id)
+            application.open_access_log(access_log, access_log_sample)
+
+        if sockets is None:
+            sockets = bind_sockets(port, host, reuse_port=True)
+
+        # IOLoop must be created after fork
         ioloop = tornado.ioloop.IOLoop.instance()
         self.application = application
 
-        self.http_server = httpserver.HTTPServer(application)
-        self.http_server.listen(port, host)
+        self.http_server = HTTPServer(wrap_application(application))
+        self.http_server.add_sockets(sockets)
 
         if reload:
             self.display("Autoreload enabled")
-            autoreload.start(io_loop=ioloop, check_time=100)
+            autoreload.start(check_time=100)
 
-        self.display("httphq running on 127.0.0.1:{0}".format(port))
+        self.display("httphq worker {0} (pid {1}) running on {2}:{3}".format(
+            worker_id, os.getpid(), host, port))
 
         # Init signals handler
         signal.signal(signal.SIGTERM, self.sig_handler)
@@ -104,18 +394,77 @@ class Start(Command):
     def sig_handler(self, sig, frame):
         """Catch signal and init callback
         """
-        tornado.ioloop.IOLoop.instance().add_callback(self.shutdown)
+        add_callback_from_signal(tornado.ioloop.IOLoop.instance(), self.shutdown)
 
     def shutdown(self):
         """Stop server and add callback to stop i/o loop"""
         self.display("Shutting down service")
         self.http_server.stop()
         io_loop = tornado.ioloop.IOLoop.instance()
-        io_loop.add_timeout(time.time() + 2, io_loop.stop)
+        if application.access_log is not None:
+            io_loop.add_timeout(timedelta(seconds=2), application.access_log.stop)
+        io_loop.add_timeout(timedelta(seconds=2), io_loop.stop)
 
         self.display("httphq is down")
 
 
+class Bench(Command):
+    """Load test httphq or any other HTTP server"""
+    commandor = Commandor
+
+    options = [
+        Option("-u", "--url",
+               metavar="str",
+               default="http://127.0.0.1:8891",
+               help="Target base url"),
+        Option("-c", "--concurrency",
+               metavar="int",
+               type="int",
+               default=10,
+               help="Number of parallel connections"),
+        Option("-d", "--duration",
+               metavar="float",
+               type="float",
+               default=10,
+               help="Test duration in seconds"),
+        Option("-m", "--mix",
+               metavar="str",
+               default="/get",
+               help="Requests mix: comma separated `[METHOD ]path[:weight]` items "
+                    "or `all` for every registered route"),
+        Option("--no-keep-alive",
+               action="store_false",
+               dest="keep_alive",
+               default=True,
+               help="Open new connection for every request"),
+        Option("-P", "--processes",
+               metavar="int",
+               type="int",
+               default=1,
+               help="Spread connections over given number of processes"),
+        Option("-o", "--output",
+               metavar="str",
+               default=None,
+               help="Write JSON results to file")]
+
+    def run(self, url, concurrency, duration, mix, keep_alive, processes, output, **kwargs):
+        handlers = list(zip(application.endpoints, [x[1] for x in application.dirty_handlers]))
+        try:
+            mix = bench.parse_mix(mix, handlers)
+        except ValueError:
+            self.abort(str(sys.exc_info()[1]))
+
+        self.display("Benchmarking {0} with {1} connections for {2}s".format(
+            url, concurrency, duration))
+
+        report = bench.run(url, mix, concurrency, duration, keep_alive, processes)
+        self.display(bench.format_report(report))
+
+        if output:
+            bench.dump_report(report, output)
+            self.display("Results saved to {0}".format(output))
+
+
 def main():
     """Manager entry point"""
 
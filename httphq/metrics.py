@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.metrics
+~~~~~~~~~~~~~~
+
+Requests counters and latency histograms in Prometheus text format
+
+Counters live in anonymous shared memory allocated before fork.
+Every worker writes only to its own slab, `/metrics` sums all slabs.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import mmap
+import ctypes
+from bisect import bisect_left
+
+from httphq.settings import responses
+
+METHODS = ("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS")
+
+# Histogram upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def route_template(pattern):
+    """Replace named groups of route `pattern` with `{name}`
+
+    /status/(?P<status_code>\\d{3}) -> /status/{status_code}
+    """
+    result = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("(?P<", i):
+            end = pattern.index(">", i)
+            result.append("{%s}" % pattern[i + 4:end])
+            # Skip group body with nested parentheses
+            depth = 1
+            i = end + 1
+            while depth and i < len(pattern):
+                if pattern[i] == "\\":
+                    i += 1
+                elif pattern[i] == "(":
+                    depth += 1
+                elif pattern[i] == ")":
+                    depth -= 1
+                i += 1
+        else:
+            result.append(pattern[i])
+            i += 1
+    return "".join(result)
+
+
+class Metrics(object):
+    """Per route, method and status counters with latency histograms
+
+    Every slot has fixed index, so recording is a few array increments.
+
+    :param handlers: application routes, first route of handler class names it
+    """
+
+    def __init__(self, handlers):
+        self.routes = []
+        self.route_index = {}
+        for handler in handlers:
+            if handler[1] not in self.route_index:
+                self.route_index[handler[1]] = len(self.routes)
+                self.routes.append(route_template(handler[0]))
+
+        self.methods = METHODS + ("other",)
+        self.method_index = dict((m, i) for i, m in enumerate(METHODS))
+
+        self.statuses = tuple(sorted(responses.keys())) + ("other",)
+        self.status_index = dict((s, i) for i, s in enumerate(self.statuses[:-1]))
+
+        self.buckets = BUCKETS
+        # Buckets + +Inf bucket + sum in microseconds
+        self.histogram_size = len(BUCKETS) + 2
+
+        self.counters_size = len(self.routes) * len(self.methods) * len(self.statuses)
+        self.slab_size = self.counters_size + \
+                         len(self.routes) * len(self.methods) * self.histogram_size
+
+        self.worker_id = 0
+        self.allocate(1)
+
+    def allocate(self, workers):
+        """Allocate shared memory slabs for given number of workers
+
+        Must be called before fork.
+        """
+        self.workers = workers
+        size = self.slab_size * workers * ctypes.sizeof(ctypes.c_int64)
+        self._mmap = mmap.mmap(-1, size)
+        self._data = (ctypes.c_int64 * (self.slab_size * workers)).from_buffer(self._mmap)
+
+    def route(self, handler_class):
+        """Route template of handler class or None
+        """
+        route = self.route_index.get(handler_class)
+        return self.routes[route] if route is not None else None
+
+    def observe(self, handler_class, method, status, request_time):
+        """Record finished request
+        """
+        route = self.route_index.get(handler_class)
+        if route is None:
+            return
+
+        data = self._data
+        offset = self.worker_id * self.slab_size
+        method = self.method_index.get(method, len(METHODS))
+        series = route * len(self.methods) + method
+
+        data[offset + series * len(self.statuses) +
+             self.status_index.get(status, len(self.statuses) - 1)] += 1
+
+        offset += self.counters_size + series * self.histogram_size
+        data[offset + bisect_left(self.buckets, request_time)] += 1
+        data[offset + self.histogram_size - 1] += int(request_time * 1000000)
+
+    def _sum(self, index):
+        data = self._data
+        return sum(data[worker * self.slab_size + index] for worker in range(self.workers))
+
+    def render(self):
+        """Render all workers metrics in Prometheus text format
+        """
+        lines = ["# HELP httphq_requests_total Total finished requests",
+                 "# TYPE httphq_requests_total counter"]
+
+        for route_id, route in enumerate(self.routes):
+            for method_id, method in enumerate(self.methods):
+                series = route_id * len(self.methods) + method_id
+                for status_id, status in enumerate(self.statuses):
+                    value = self._sum(series * len(self.statuses) + status_id)
+                    if value:
+                        lines.append('httphq_requests_total{route="%s",method="%s",code="%s"} %d' % (
+                            route, method, status, value))
+
+        lines.extend(["# HELP httphq_request_duration_seconds Requests latency",
+                      "# TYPE httphq_request_duration_seconds histogram"])
+
+        bounds = ["%g" % x for x in self.buckets] + ["+Inf"]
+        for route_id, route in enumerate(self.routes):
+            for method_id, method in enumerate(self.methods):
+                offset = self.counters_size + \
+                         (route_id * len(self.methods) + method_id) * self.histogram_size
+                values = [self._sum(offset + i) for i in range(self.histogram_size)]
+                count = sum(values[:-1])
+                if not count:
+                    continue
+
+                labels = 'route="%s",method="%s"' % (route, method)
+                cumulative = 0
+                for bound, value in zip(bounds, values):
+                    cumulative += value
+                    lines.append('httphq_request_duration_seconds_bucket{%s,le="%s"} %d' % (
+                        labels, bound, cumulative))
+                lines.append('httphq_request_duration_seconds_sum{%s} %.6f' % (labels, values[-1] / 1000000.0))
+                lines.append('httphq_request_duration_seconds_count{%s} %d' % (labels, count))
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.network
+~~~~~~~~~~~~~~
+
+Network conditions emulation for HTTP responses
+
+Profile is selected by `X-Network-Profile` header, `network` query
+argument or server default. Response writes are queued and released
+by shared ticker: after sampled latency, within bandwidth budget,
+with stalls on simulated packet loss. Slow headers profile writes
+response head line by line and closes connection. Upgrade requests
+aren't shaped, upgraded connection is detached from HTTP connection.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import time
+import random
+from collections import deque, OrderedDict
+
+from tornado import httputil, iostream
+from tornado.concurrent import Future
+from tornado.escape import utf8, native_str
+
+# Minimal budget to send one TCP segment
+MTU = 1460
+
+DISTRIBUTIONS = ("uniform", "normal", "pareto")
+
+
+class Profile(object):
+    """Network conditions
+
+    :param latency: added response latency in seconds
+    :param jitter: latency deviation in seconds
+    :param distribution: latency distribution: uniform, normal or pareto
+    :param down: response bandwidth in bytes per second, None - unlimited
+    :param up: request body bandwidth in bytes per second, None - unlimited
+    :param loss: probability of stall after every sent piece
+    :param rto: stall duration in seconds
+    :param slow_headers: seconds between response head lines
+    """
+
+    __slots__ = ("name", "latency", "jitter", "distribution", "down", "up",
+                 "loss", "rto", "slow_headers")
+
+    def __init__(self, name, latency=0, jitter=0, distribution="uniform", down=None, up=None,
+                 loss=0, rto=0.2, slow_headers=0):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError("Unknown latency distribution: %s" % distribution)
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.down = down
+        self.up = up
+        self.loss = loss
+        self.rto = rto
+        self.slow_headers = slow_headers
+
+    def sample_latency(self, generator):
+        if not self.jitter:
+            return self.latency
+        if self.distribution == "normal":
+            value = generator.gauss(self.latency, self.jitter)
+        elif self.distribution == "pareto":
+            # Heavy tail with mean deviation equal to jitter
+            value = self.latency + self.jitter * (generator.paretovariate(2.0) - 1)
+        else:
+            value = self.latency + generator.uniform(-self.jitter, self.jitter)
+        return max(0.0, value)
+
+
+def kbit(value):
+    """Kilobits per second to bytes per second
+    """
+    return value * 1000 // 8
+
+
+PROFILES = OrderedDict((x.name, x) for x in (
+    Profile("2g", 0.3, 0.1, "normal", kbit(240), kbit(200)),
+    Profile("3g", 0.1, 0.03, "normal", kbit(750), kbit(250)),
+    Profile("4g", 0.02, 0.01, "normal", kbit(4000), kbit(3000)),
+    Profile("satellite", 0.6, 0.05, "normal", kbit(10000), kbit(1000)),
+    Profile("wifi-lossy", 0.005, 0.03, "pareto", kbit(20000), kbit(10000), loss=0.02),
+    Profile("slowloris", slow_headers=1.0)))
+
+
+class NetworkProfiles(object):
+    """Select profiles for requests
+
+    :param profiles: custom profiles as name -> `Profile` arguments
+    :param default: profile of requests without their own one
+    :param per_request: allow requests to select profile
+    :param seed: seed of latency and loss random generator
+    """
+
+    def __init__(self, profiles=None, default=None, per_request=True, seed=None):
+        self.profiles = OrderedDict(PROFILES)
+        for name, params in (profiles or {}).items():
+            self.profiles[name] = Profile(name, **params)
+        if default is not None and default not in self.profiles:
+            raise ValueError("Unknown network profile %s, choose one of: %s" % (
+                default, ", ".join(self.profiles)))
+        self.default = default
+        self.per_request = per_request
+        self.random = random.Random(seed)
+        self.selected = dict((name, 0) for name in self.profiles)
+
+    def select(self, start_line, headers):
+        """:return: `Profile` or None
+        """
+        if "Upgrade" in headers:
+            return None
+
+        name = None
+        if self.per_request:
+            name = headers.get("X-Network-Profile")
+            if name is None and "network=" in start_line.path:
+                values = httputil.parse_qs_bytes(start_line.path.partition("?")[2]).get("network")
+                name = native_str(values[0]) if values else None
+        if name == "none":
+            return None
+
+        profile = self.profiles.get(name) or self.profiles.get(self.default)
+        if profile is not None:
+            self.selected[profile.name] += 1
+        return profile
+
+    def render(self, worker_id=0):
+        """Render counters in Prometheus text format
+        """
+        lines = ["# HELP httphq_network_profile_requests_total Requests shaped by network profile",
+                 "# TYPE httphq_network_profile_requests_total counter"]
+        for name in self.profiles:
+            lines.append('httphq_network_profile_requests_total{worker="%d",profile="%s"} %d' % (
+                worker_id, name, self.selected[name]))
+        return "\n".join(lines) + "\n"
+
+
+def resolved(future, exception=None):
+    if exception is None:
+        future.set_result(None)
+    else:
+        future.set_exception(exception)
+        # Mark exception as retrieved, as tornado does for closed streams
+        future.exception()
+    return future
+
+
+class ShapedConnection(object):
+    """Request connection wrapper releasing writes by network profile
+
+    :param connection: wrapped request connection
+    :param ticker: shared periodic timer
+    """
+
+    def __init__(self, connection, ticker):
+        self.connection = connection
+        self.ticker = ticker
+        self.profile = None
+        self.method = None
+        self.random = None
+        # [kind, payload, future]
+        self._ops = deque()
+        # [(due, future)]
+        self._uploads = deque()
+        self._upload_at = 0
+        self._ready_at = None
+        self._budget = 0
+        self._last_tick = None
+        self._raw = False
+        self._chunked = False
+        self._subscribed = False
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def shape(self, profile, method, generator):
+        self.profile = profile
+        self.method = method
+        self.random = generator
+
+    def _subscribe(self):
+        if not self._subscribed:
+            self._subscribed = True
+            self._last_tick = time.time()
+            self.ticker.add(self._tick)
+
+    def _push(self, kind, payload=None):
+        future = Future()
+        self._ops.append([kind, payload, future])
+        if self._ready_at is None:
+            self._ready_at = time.time() + self.profile.sample_latency(self.random)
+        self._subscribe()
+        return future
+
+    def write_headers(self, start_line, headers, chunk=None):
+        if self.profile is None:
+            return self.connection.write_headers(start_line, headers, chunk)
+        headers["X-Network-Profile"] = self.profile.name
+        future = self._push("headers", (start_line, headers))
+        if chunk:
+            future = self._push("write", chunk)
+        return future
+
+    def write(self, chunk):
+        if self.profile is None:
+            return self.connection.write(chunk)
+        return self._push("write", chunk)
+
+    def finish(self):
+        if self.profile is None:
+            return self.connection.finish()
+        self._push("finish")
+
+    def upload(self, size):
+        """Future resolved when `size` request body bytes pass upstream bandwidth
+        """
+        now = time.time()
+        self._upload_at = max(now, self._upload_at) + float(size) / self.profile.up
+        future = Future()
+        self._uploads.append((self._upload_at, future))
+        self._subscribe()
+        return future
+
+    def _tick(self):
+        now = time.time()
+        stream = self.connection.stream
+        if stream is None or stream.closed():
+            self._abort()
+            return
+
+        while self._uploads and self._uploads[0][0] <= now:
+            resolved(self._uploads.popleft()[1])
+
+        rate = self.profile.down
+        if rate:
+            self._budget = min(self._budget + rate * (now - self._last_tick),
+                               max(rate * self.ticker.interval * 2, MTU))
+        self._last_tick = now
+
+        ops = self._ops
+        while ops and now >= self._ready_at:
+            op = ops[0]
+            kind, payload, future = op
+            if kind == "write":
+                if rate:
+                    if self._budget < 1:
+                        break
+                    size = int(self._budget)
+                    payload, op[1] = payload[:size], payload[size:]
+                    self._budget -= len(payload)
+                else:
+                    op[1] = b""
+                self._send(payload)
+                if self.profile.loss and self.random.random() < self.profile.loss:
+                    self._ready_at = now + self.profile.rto
+                if op[1]:
+                    continue
+            elif kind == "headers":
+                self._send_headers(*payload)
+            elif kind == "raw":
+                stream.write(payload)
+            elif kind == "pause":
+                self._ready_at = now + payload
+            elif kind == "finish":
+                self._finish()
+            ops.popleft()
+            resolved(future)
+
+        if not ops and not self._uploads:
+            self._subscribed = False
+            self.ticker.remove(self._tick)
+
+    def _send_headers(self, start_line, headers):
+        if not self.profile.slow_headers:
+            self.connection.write_headers(start_line, headers)
+            return
+
+        # Response head is written to stream line by line,
+        # connection can't be reused then
+        self._raw = True
+        has_body = self.method != "HEAD" and start_line.code not in (204, 304) and \
+            not 100 <= start_line.code < 200
+        self._chunked = has_body and "Content-Length" not in headers
+
+        lines = [utf8("HTTP/1.1 %d %s\r\n" % (start_line.code, start_line.reason))]
+        for name, value in headers.get_all():
+            if name not in ("Transfer-Encoding", "Connection"):
+                lines.append(utf8("%s: %s\r\n" % (name, value)))
+        lines.append(b"Connection: close\r\n")
+        if self._chunked:
+            lines.append(b"Transfer-Encoding: chunked\r\n")
+        lines.append(b"\r\n")
+
+        for line in reversed(lines[1:]):
+            self._ops.insert(1, ["raw", line, Future()])
+            self._ops.insert(1, ["pause", self.profile.slow_headers, Future()])
+        self.connection.stream.write(lines[0])
+
+    def _send(self, chunk):
+        if not self._raw:
+            self.connection.write(chunk)
+        elif self._chunked:
+            if chunk:
+                self.connection.stream.write(utf8("%x\r\n" % len(chunk)) + chunk + b"\r\n")
+        elif self.method != "HEAD":
+            self.connection.stream.write(chunk)
+
+    def _finish(self):
+        if not self._raw:
+            self.connection.finish()
+            return
+        connection = self.connection
+        connection.stream.write(b"0\r\n\r\n" if self._chunked else b"").add_done_callback(
+            lambda future: connection.close())
+
+    def _abort(self):
+        while self._ops:
+            resolved(self._ops.popleft()[2], iostream.StreamClosedError())
+        while self._uploads:
+            resolved(self._uploads.popleft()[1], iostream.StreamClosedError())
+        self._subscribed = False
+        self.ticker.remove(self._tick)
+
+
+class ShapingDelegate(httputil.HTTPMessageDelegate):
+    """Select network profile for request and throttle its body
+    """
+
+    def __init__(self, profiles, connection, delegate):
+        self.profiles = profiles
+        self.connection = connection
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        profile = self.profiles.select(start_line, headers)
+        if profile is not None:
+            self.connection.shape(profile, start_line.method, self.profiles.random)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        result = self.delegate.data_received(chunk)
+        profile = self.connection.profile
+        if result is None and profile is not None and profile.up:
+            return self.connection.upload(len(chunk))
+        return result
+
+    def finish(self):
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        self.delegate.on_connection_close()
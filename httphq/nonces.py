@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.nonces
+~~~~~~~~~~~~~
+
+Server nonces lifecycle
+
+Digest nonces carry signature, so nonce issued by other worker or
+already evicted from store is recognized as stale, not invalid,
+and client retries with fresh nonce.
+All nonces have the same TTL, so issue order is expiration order
+and the store is a FIFO queue: issue, check and expire are O(1).
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import hmac
+import time
+import binascii
+from hashlib import sha1
+from collections import OrderedDict
+
+from tornado.escape import utf8
+
+VALID = "valid"
+# Nonce was issued by server but expired or evicted
+STALE = "stale"
+# Nonce wasn't issued by server
+INVALID = "invalid"
+# Nonce count isn't greater than previous one
+REPLAY = "replay"
+
+
+class NonceStore(object):
+    """Bounded store of issued digest nonces with nonce count tracking
+
+    :param ttl: nonce lifetime in seconds
+    :param max_size: max tracked nonces, the oldest are dropped first
+    :param secret: nonces signing key, must be shared between workers
+    """
+
+    def __init__(self, ttl=300, max_size=100000, secret=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.secret = secret or os.urandom(16)
+        # nonce -> [expires, last nonce count, opaque]
+        self._nonces = OrderedDict()
+
+    def _sign(self, value):
+        return hmac.new(self.secret, utf8(value), sha1).hexdigest()[:16]
+
+    def _expire(self, now):
+        nonces = self._nonces
+        while nonces:
+            nonce, entry = next(iter(nonces.items()))
+            if entry[0] > now and len(nonces) <= self.max_size:
+                break
+            nonces.popitem(last=False)
+
+    def issue(self, opaque=None):
+        """Create new nonce
+        """
+        now = time.time()
+        value = "%08x%s" % (int(now), binascii.hexlify(os.urandom(8)).decode('ascii'))
+        nonce = value + self._sign(value)
+
+        self._nonces[nonce] = [now + self.ttl, 0, opaque]
+        self._expire(now)
+        return nonce
+
+    def check(self, nonce, nc=None, opaque=None):
+        """Check nonce and nonce count of client request
+
+        :param nc: hex nonce count, None if qop is not used
+        :return: one of VALID, STALE, INVALID, REPLAY
+        """
+        now = time.time()
+        self._expire(now)
+
+        entry = self._nonces.get(nonce)
+        if entry is None:
+            value, signature = nonce[:-16], nonce[-16:]
+            if len(value) != 24 or not hmac.compare_digest(utf8(self._sign(value)), utf8(signature)):
+                return INVALID
+            # Issued by other worker or evicted, its nonce count is unknown,
+            # so client gets fresh nonce instead of replaying old responses
+            return STALE
+        elif entry[0] <= now:
+            return STALE
+
+        if opaque is not None and entry[2] is not None and entry[2] != opaque:
+            return INVALID
+
+        if nc is not None:
+            try:
+                nc = int(nc, 16)
+            except ValueError:
+                return INVALID
+            if nc <= entry[1]:
+                return REPLAY
+            entry[1] = nc
+        return VALID
+
+    def __contains__(self, nonce):
+        return nonce in self._nonces
+
+    def __len__(self):
+        return len(self._nonces)
+
+
+class ReplayCache(object):
+    """Seen OAuth nonces within timestamp window
+
+    Nonces are grouped into sets by request timestamp, whole set is dropped
+    when its timestamps leave the window, so memory is bounded by
+    window * request rate and nothing is expired per entry.
+
+    :param window: max difference between request timestamp and server time
+    :param bucket_size: seconds of timestamps in one set
+    """
+
+    def __init__(self, window=300, bucket_size=10):
+        self.window = window
+        self.bucket_size = bucket_size
+        self._buckets = {}
+        self._oldest = None
+
+    def _expire(self, now):
+        oldest = int(now - self.window) // self.bucket_size
+        if oldest == self._oldest:
+            return
+        self._oldest = oldest
+        for bucket in [x for x in self._buckets if x < oldest]:
+            del self._buckets[bucket]
+
+    def add(self, timestamp, *key):
+        """Remember nonce `key` of request with given `timestamp`
+
+        :return: False if the same key with the same timestamp was seen
+                 or timestamp is out of window
+        """
+        self._expire(time.time())
+
+        bucket_id = int(timestamp) // self.bucket_size
+        if bucket_id < self._oldest:
+            return False
+
+        key = (timestamp,) + key
+        bucket = self._buckets.setdefault(bucket_id, set())
+        if key in bucket:
+            return False
+        bucket.add(key)
+        return True
+
+    def __len__(self):
+        return sum(len(x) for x in self._buckets.values())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.ratelimit
+~~~~~~~~~~~~~~~~
+
+Token bucket rate limiter
+
+Bucket is two numbers updated on every check. Buckets are kept in
+least recently used order, bucket refilled to burst is equal to a new
+one, so idle buckets are dropped from the old end of the queue and
+memory is bounded by `max_keys`.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import math
+import time
+from collections import OrderedDict
+
+
+class Decision(object):
+    """Result of rate limiter check
+
+    :param allowed: request is allowed
+    :param limit: bucket capacity
+    :param remaining: tokens left after request
+    :param reset: seconds until bucket is full
+    :param retry_after: seconds until request would be allowed, 0 if allowed
+    :param window: seconds to refill empty bucket
+    """
+
+    __slots__ = ("allowed", "limit", "remaining", "reset", "retry_after", "window")
+
+    def __init__(self, allowed, limit, remaining, reset, retry_after, window):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        self.retry_after = retry_after
+        self.window = window
+
+    def headers(self):
+        """`RateLimit-*` and `Retry-After` response headers
+        """
+        headers = [("RateLimit-Limit", str(self.limit)),
+                   ("RateLimit-Remaining", str(self.remaining)),
+                   ("RateLimit-Reset", str(int(math.ceil(self.reset)))),
+                   ("RateLimit-Policy", "%d;w=%d" % (self.limit, int(math.ceil(self.window))))]
+        if not self.allowed:
+            headers.append(("Retry-After", str(int(math.ceil(self.retry_after)))))
+        return headers
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class RateLimiter(object):
+    """Token buckets for many keys with different rates
+
+    :param max_keys: max tracked buckets, the least recently used are dropped first
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> [tokens, updated, full at]
+        self._buckets = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if bucket[2] > now and len(buckets) <= self.max_keys:
+                break
+            buckets.popitem(last=False)
+
+    def hit(self, key, rate, burst, cost=1, now=None):
+        """Take `cost` tokens from bucket of `key`
+
+        :param rate: tokens added per second
+        :param burst: bucket capacity
+        :param cost: tokens taken, request costing more than `burst` is never allowed
+        :return: `Decision`
+        """
+        if cost > burst:
+            raise ValueError("Cost %s is greater than burst %s" % (cost, burst))
+        if now is None:
+            now = time.time()
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = float(burst)
+        else:
+            tokens = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+            self.allowed += 1
+        else:
+            self.limited += 1
+
+        reset = (burst - tokens) / rate
+        self._buckets[key] = [tokens, now, now + reset]
+        self._expire(now)
+
+        return Decision(allowed, burst, int(tokens), reset,
+                        0 if allowed else (cost - tokens) / rate, burst / float(rate))
+
+    def render(self, worker_id=0):
+        """Render counters in Prometheus text format
+        """
+        lines = ["# HELP httphq_rate_limit_checks_total Rate limiter checks by result",
+                 "# TYPE httphq_rate_limit_checks_total counter"]
+        for name in ("allowed", "limited"):
+            lines.append('httphq_rate_limit_checks_total{worker="%d",result="%s"} %d' % (
+                worker_id, name, getattr(self, name)))
+        lines.extend(["# HELP httphq_rate_limit_buckets Tracked token buckets",
+                      "# TYPE httphq_rate_limit_buckets gauge",
+                      'httphq_rate_limit_buckets{worker="%d"} %d' % (worker_id, len(self._buckets))])
+        return "\n".join(lines) + "\n"
+
+    def __contains__(self, key):
+        return key in self._buckets
+
+    def __len__(self):
+        return len(self._buckets)
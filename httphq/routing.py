@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.routing
+~~~~~~~~~~~~~~
+
+Routes dispatcher indexed by path segments
+
+Route patterns are split by `/` into segments, literal segments are looked up
+in dict and only pattern segments are matched with regular expressions.
+Every pattern segment matches exactly one path segment, so long paths never
+backtrack through `.+` groups. Slashes in captured values must be encoded as `%2F`.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import re
+
+from tornado.escape import url_unescape
+
+# Characters which make segment a regular expression
+SPECIAL_CHARS = frozenset("\\.^$*+?{}[]|()")
+
+
+def split_pattern(pattern):
+    """Split route pattern by slashes outside of groups and character sets
+
+    /status/(?P<status_code>\\d{3}) -> ['status', '(?P<status_code>\\d{3})']
+    """
+    if pattern.endswith("$"):
+        pattern = pattern[:-1]
+    if not pattern.startswith("/"):
+        raise ValueError("Route pattern must start with /: %s" % pattern)
+
+    segments = []
+    current = []
+    depth = 0
+    in_set = False
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            current.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_set:
+            in_set = char != "]"
+        elif char == "[":
+            in_set = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "/" and not depth:
+            segments.append("".join(current))
+            current = []
+            i += 1
+            continue
+        current.append(char)
+        i += 1
+    segments.append("".join(current))
+    return segments
+
+
+class Node(object):
+    """Trie node
+
+    :param children: literal segment -> node
+    :param patterns: list of (segment regexp, node)
+    :param rules: list of (route index, handler class) ending in node
+    """
+
+    __slots__ = ("children", "patterns", "rules")
+
+    def __init__(self):
+        self.children = {}
+        self.patterns = []
+        self.rules = []
+
+
+class RouteTrie(object):
+    """Find handler for request path
+
+    When several routes match, the first one in handlers list wins,
+    as with sequential regexps scan.
+
+    :param handlers: list of (pattern, handler class, ...) tuples
+    """
+
+    def __init__(self, handlers):
+        self.root = Node()
+        self.depth = 0
+        for index, handler in enumerate(handlers):
+            self.add(index, handler[0], handler[1])
+
+    def add(self, index, pattern, handler):
+        segments = split_pattern(pattern)
+        node = self.root
+        for segment in segments:
+            if SPECIAL_CHARS.isdisjoint(segment):
+                node = node.children.setdefault(segment, Node())
+                continue
+
+            regexp = re.compile(segment + "$")
+            if regexp.groups != len(regexp.groupindex):
+                raise ValueError("Only named groups are supported: %s" % pattern)
+            for other, child in node.patterns:
+                if other.pattern == regexp.pattern:
+                    node = child
+                    break
+            else:
+                child = Node()
+                node.patterns.append((regexp, child))
+                node = child
+
+        node.rules.append((index, handler))
+        self.depth = max(self.depth, len(segments))
+
+    def _find(self, node, segments, position, kwargs, best):
+        if position == len(segments):
+            if node.rules and (best[0] is None or node.rules[0][0] < best[0][0]):
+                best[0] = (node.rules[0][0], node.rules[0][1], dict(kwargs))
+            return
+
+        segment = segments[position]
+        child = node.children.get(segment)
+        if child is not None:
+            self._find(child, segments, position + 1, kwargs, best)
+
+        for regexp, child in node.patterns:
+            match = regexp.match(segment)
+            if match is not None:
+                captured = match.groupdict()
+                kwargs.update(captured)
+                self._find(child, segments, position + 1, kwargs, best)
+                for name in captured:
+                    del kwargs[name]
+
+    def find(self, path):
+        """Find handler and its keyword arguments for `path`
+
+        :return: (handler class, kwargs) or None
+        """
+        if path.count("/") > self.depth:
+            return None
+        segments = path[1:].split("/")
+
+        best = [None]
+        self._find(self.root, segments, 0, {}, best)
+        if best[0] is None:
+            return None
+
+        # Arguments are unquoted like tornado does with regexp groups
+        kwargs = dict((str(k), url_unescape(v, encoding=None, plus=False) if v is not None else None)
+                      for k, v in best[0][2].items())
+        return best[0][1], kwargs
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding:  utf-8 -*-
+
+"""
+httphq.tokens
+~~~~~~~~~~~~~
+
+HS256 JSON Web Tokens for OAuth 2.0 endpoints
+
+Verified tokens are cached until their `exp`, so clients reusing
+a few tokens skip decoding and signature check.
+
+:copyright: (c) 2011 - 2013 by Alexandr Lispython (alex@obout.ru).
+:license: BSD, see LICENSE for more details.
+:github: http://github.com/Lispython/httphq
+"""
+
+import os
+import json
+import hmac
+import time
+import base64
+import binascii
+from hashlib import sha256
+
+from tornado.escape import utf8
+
+from httphq.utils import LRUCache
+
+JWT_HEADER = {"alg": "HS256", "typ": "JWT"}
+
+
+def b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def b64url_decode(data):
+    data = utf8(data)
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+def _sign(key, signing_input):
+    return b64url_encode(hmac.new(utf8(key), signing_input, sha256).digest())
+
+
+def jwt_encode(claims, key):
+    """Build HS256 signed token with given claims
+    """
+    signing_input = b".".join(
+        b64url_encode(utf8(json.dumps(x, separators=(",", ":"), sort_keys=True)))
+        for x in (JWT_HEADER, claims))
+    return (signing_input + b"." + _sign(key, signing_input)).decode('ascii')
+
+
+def jwt_decode(token, key, now=None):
+    """Verify token signature and expiration
+
+    :return: (header, claims)
+    :raises ValueError: if token is malformed, has wrong signature or expired
+    """
+    token = utf8(token)
+    try:
+        signing_input, signature = token.rsplit(b".", 1)
+        header, claims = [json.loads(b64url_decode(x).decode('utf-8'))
+                          for x in signing_input.split(b".")]
+    except (ValueError, TypeError, binascii.Error):
+        raise ValueError("Malformed token")
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise ValueError("Malformed token")
+
+    # Only HS256 is accepted, so "none" algorithm can't bypass signature
+    if header.get("alg") != "HS256":
+        raise ValueError("Unsupported algorithm: %s" % header.get("alg"))
+
+    if not hmac.compare_digest(_sign(key, signing_input), signature):
+        raise ValueError("Invalid signature")
+
+    exp = claims.get("exp")
+    if exp is not None and exp <= (now or time.time()):
+        raise ValueError("Token expired")
+    return header, claims
+
+
+class TokenCache(object):
+    """Issue and verify tokens, verified tokens are cached until expiration
+
+    :param key: signing key
+    :param max_size: max cached tokens
+    """
+
+    def __init__(self, key=None, max_size=10000):
+        self.key = key or binascii.hexlify(os.urandom(32))
+        self.hits = 0
+        self.misses = 0
+        self._cache = LRUCache(max_size)
+
+    def issue(self, claims, expires_in):
+        """Build token with `iat`, `exp` and unique `jti` claims
+        """
+        now = int(time.time())
+        claims = dict(claims, iat=now, exp=now + expires_in,
+                      jti=binascii.hexlify(os.urandom(8)).decode('ascii'))
+        return jwt_encode(claims, self.key)
+
+    def verify(self, token):
+        """Return claims of valid token
+
+        :raises ValueError: if token is invalid or expired
+        """
+        now = time.time()
+        entry = self._cache.get(token)
+        if entry is not None:
+            if entry[0] is None or entry[0] > now:
+                self.hits += 1
+                return entry[2]
+            self._cache.pop(token)
+
+        self.misses += 1
+        header, claims = jwt_decode(token, self.key, now)
+        self._cache.set(token, (claims.get("exp"), header, claims))
+        return claims
+
+    def __len__(self):
+        return len(self._cache)
@@ -44,7 +44,7 @@ tests_require = [
     'mock==1.0.1']
 
 install_requires = [
-    "tornado==2.4.1",
+    "tornado>=4.5",
     "commandor==0.1.5"]
 
 if not (is_py3 or (is_py2 and py_ver[1] >= 7)):
@@ -81,10 +81,8 @@ setup(
         "Environment :: Web Environment",
         "License :: OSI Approved :: BSD License",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2.6",
         "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.2",
-        "Programming Language :: Python :: 3.3",
+        "Programming Language :: Python :: 3",
         "Operating System :: MacOS :: MacOS X",
         "Operating System :: POSIX",
         "Topic :: Internet",
@@ -2,10 +2,50 @@
 # -*- coding:  utf-8 -*-
 
 
+import os
+import sys
+import json
+import time
+import zlib
+import gzip
+import random
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import subprocess
 import unittest
+from httphq.compat import BytesIO, urlencode
+from httphq.bench import parse_mix, Histogram, ResponseParser, Bench
+from httphq.metrics import Metrics, route_template
+from httphq.bins import BinsStorage, Record, BIN_OVERHEAD
+from httphq.accesslog import AccessLog
+from httphq.admission import Admission
+from httphq.ratelimit import RateLimiter
+from httphq.chaos import FaultInjector, FaultyConnection, Plan, parse_options, serialize
+from httphq.network import Profile, NetworkProfiles, ShapedConnection
+from httphq import nonces
+from httphq.app import normalize_request, SIGNATURES_METHODS
+from httphq.tokens import TokenCache, jwt_encode, jwt_decode, b64url_decode
+from httphq.routing import RouteTrie, split_pattern
+from httphq.encoders import JSON_ENCODERS, get_json_encoder, msgpack_dumps, cbor_dumps
+import tornado.escape
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.iostream import IOStream
+from tornado.websocket import websocket_connect
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, gen_test
+from httphq.app import HTTPApplication, PagesCache, wrap_application
+from httphq.admission import HTTPServer
+from tornado.escape import utf8
+from tornado.httputil import HTTPServerRequest, HTTPHeaders, RequestStartLine, ResponseStartLine
 from httphq.utils import (parse_dict_header, parse_authorization_header,
                           parse_authenticate_header, Authorization, WWWAuthentication,
-                          H, HA1, HA2, response)
+                          H, HA1, HA2, response, etag_matches, random_bytes, BytesPool,
+                          parse_range_header, pattern_chunks, LRUCache,
+                          deflate_static, compress_chunks, choose_media_type,
+                          finite_float)
 
 class UtilsTestCase(unittest.TestCase):
     def setUp(self):
@@ -141,10 +181,1702 @@ class UtilsTestCase(unittest.TestCase):
                                       cr.get('qop'),
                                       HA2(cr, request)])))
 
+    def test_digest_algorithms(self):
+        # RFC 7616 section 3.9.1 example
+        cr = {'username': "Mufasa",
+              'realm': "http-auth@example.org",
+              'nonce': "7ypf/xlj9XXwfDPEoM4URrv/xwf94BcCAzFZH4GiTo0v",
+              'uri': "/dir/index.html",
+              'qop': "auth",
+              'nc': "00000001",
+              'cnonce': "f2/wE4q74E6zIJEtWaHKaf5wv/H5QzzpXusqGemxURZJ"}
+        request = {'method': 'GET', 'uri': '/dir/index.html'}
+
+        cr['algorithm'] = "MD5"
+        self.assertEqual(response(cr, "Circle of Life", request), "8ca523f5e9506fed4657c9700eebdbec")
+        cr['algorithm'] = "SHA-256"
+        self.assertEqual(response(cr, "Circle of Life", request),
+                         "753927fa0e85d155564e2e272a28d1802ca10daf4496794697cf8db5856cb6c1")
+
+        cr['algorithm'] = "SHA-256-sess"
+        ha1 = H("%s:%s:%s" % (H("Mufasa:http-auth@example.org:Circle of Life", "SHA-256"),
+                              cr['nonce'], cr['cnonce']), "SHA-256")
+        self.assertEqual(response(cr, "Circle of Life", request),
+                         H(":".join([ha1, cr['nonce'], cr['nc'], cr['cnonce'], cr['qop'],
+                                     HA2(cr, request)]), "SHA-256"))
+
+        cr['algorithm'] = "SHA-512"
+        self.assertRaises(ValueError, response, cr, "Circle of Life", request)
+
+        # auth-int body is hashed by chunks
+        cr['algorithm'] = "MD5-sess"
+        cr['qop'] = "auth-int"
+        self.assertEqual(HA2(cr, dict(request, body=[b"request ", b"body"])),
+                         HA2(cr, dict(request, body=b"request body")))
+
+    def test_etag_matches(self):
+        etag = '"e966c932a9242554e42c8ee200cec7f6"'
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches('"a", W/%s' % etag, etag))
+        self.assertTrue(etag_matches('*', etag))
+        self.assertFalse(etag_matches('"a", "b"', etag))
+        self.assertFalse(etag_matches(None, etag))
+
+    def test_random_bytes(self):
+        self.assertEqual(len(random_bytes(100)), 100)
+        self.assertEqual(random_bytes(100, seed=1), random_bytes(100, seed=1))
+        self.assertNotEqual(random_bytes(100, seed=1), random_bytes(100, seed=2))
+        self.assertEqual(random_bytes(0, seed=1), b"")
+
+    def test_finite_float(self):
+        self.assertEqual(finite_float("1.5"), 1.5)
+        for value in ("nan", "inf", "-inf", "x"):
+            self.assertRaises(ValueError, finite_float, value)
+
+    def test_bytes_pool(self):
+        pool = BytesPool(buffer_size=100)
+        self.assertEqual(list(pool.chunks(0)), [])
+
+        chunks = list(pool.chunks(250, seed=1))
+        self.assertEqual([len(x) for x in chunks], [100, 100, 50])
+        self.assertTrue(chunks[0] is pool.get_buffer(seed=1))
+        self.assertEqual(b"".join(chunks), b"".join(pool.chunks(250, chunk_size=30, seed=1)))
+        self.assertTrue(max(len(x) for x in pool.chunks(250, chunk_size=30)) <= 30)
+        self.assertRaises(ValueError, pool.chunks, 10, chunk_size=0)
+        self.assertRaises(ValueError, pool.chunks, 10, chunk_size=-1)
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header(None, 30), None)
+        self.assertEqual(parse_range_header("bytes=2-5", 30), [(2, 5)])
+        self.assertEqual(parse_range_header("bytes=2-", 30), [(2, 29)])
+        self.assertEqual(parse_range_header("bytes=-3", 30), [(27, 29)])
+        self.assertEqual(parse_range_header("bytes=0-1, 28-100", 30), [(0, 1), (28, 29)])
+        self.assertEqual(parse_range_header("bytes=40-", 30), [])
+        self.assertEqual(parse_range_header("bytes=5-2", 30), None)
+        self.assertEqual(parse_range_header("items=1-2", 30), None)
+
+    def test_pattern_chunks(self):
+        self.assertEqual(b"".join(pattern_chunks(2, 6)), b"cdef")
+        self.assertEqual(b"".join(pattern_chunks(25, 28)), b"zab")
+        content = b"".join(pattern_chunks(0, 200000))
+        self.assertEqual(len(content), 200000)
+        self.assertEqual(b"".join(pattern_chunks(123456, 123466)), content[123456:123466])
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_compress_chunks(self):
+        static = [b"static ", b"prefix "]
+        dynamic = [b"dynamic ", b"part"]
+        control = b"".join(static + dynamic)
+
+        body = b"".join(compress_chunks(dynamic, 7, "gzip", deflate_static(static, 7)))
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(body)).read(), control)
+
+        body = b"".join(compress_chunks(dynamic, 1, "deflate", deflate_static(static, 1)))
+        self.assertEqual(zlib.decompress(body), control)
+
+        body = b"".join(compress_chunks(static + dynamic, 9, "deflate"))
+        self.assertEqual(zlib.decompress(body), control)
+
+
+class BenchTestCase(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix("/get:3, POST /post, /status/200:1"),
+                         [("GET", "/get", 3), ("POST", "/post", 1), ("GET", "/status/200", 1)])
+        self.assertRaises(ValueError, parse_mix, "/get:0")
+        self.assertRaises(ValueError, parse_mix, "all")
+
+    def test_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), None)
+        self.assertEqual(histogram.mean(), None)
+
+        other = Histogram()
+        for x in range(1, 1001):
+            (histogram if x % 2 else other).add(x / 1000.0)
+        histogram.merge(other)
+
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual((histogram.min, histogram.max), (0.001, 1.0))
+        self.assertAlmostEqual(histogram.mean(), 0.5005)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99.9), 0.999, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 1.0)
+
+        # Memory doesn't grow with requests count
+        for x in range(10000):
+            histogram.add(0.5)
+        self.assertTrue(len(histogram.buckets) < 1000)
+
+    def test_response_parser(self):
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\nbody"
+        parser = ResponseParser("GET")
+        self.assertEqual(parser.feed(bytearray(response[:-1])), None)
+        self.assertEqual(parser.feed(bytearray(response + b"HTTP/1.1")), len(response))
+        self.assertFalse(parser.close)
+
+        response = b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n" \
+                   b"4\r\nbody\r\n0\r\n\r\n"
+        parser = ResponseParser("GET")
+        self.assertEqual(parser.feed(bytearray(response[:-2])), None)
+        self.assertEqual(parser.feed(bytearray(response)), len(response))
+        self.assertTrue(parser.close)
+
+        response = b"HTTP/1.1 200 OK\r\nContent-Length: 4\r\n\r\n"
+        self.assertEqual(ResponseParser("HEAD").feed(bytearray(response)), len(response))
+
+    def test_closed_port(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        # Connections back off and stop long before duration
+        started = time.time()
+        result = Bench("http://127.0.0.1:%d" % port, [("GET", "/get", 1)],
+                       concurrency=2, duration=30, max_failures=3).run()
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(result["errors"], 6)
+        self.assertEqual(result["requests"], 0)
+
+    def test_silent_server(self):
+        # Connections are accepted by kernel but never answered
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        try:
+            started = time.time()
+            result = Bench("http://127.0.0.1:%d" % sock.getsockname()[1], [("GET", "/get", 1)],
+                           concurrency=4, duration=0.2).run()
+        finally:
+            sock.close()
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(result["requests"], 0)
+        self.assertEqual(result["errors"], 0)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_route_template(self):
+        self.assertEqual(route_template(r"/status/(?P<status_code>\d{3})"), "/status/{status_code}")
+        self.assertEqual(route_template(r"/delay/(?P<seconds>\d+(?:\.\d+)?)"), "/delay/{seconds}")
+        self.assertEqual(route_template(r"/get"), "/get")
+
+    def test_observe(self):
+        metrics = Metrics([(r"/get", dict), (r"/status/(?P<status_code>\d{3})", list)])
+        metrics.observe(dict, "GET", 200, 0.003)
+        metrics.observe(dict, "GET", 200, 20)
+        metrics.observe(list, "POST", 404, 0.0001)
+        metrics.observe(set, "GET", 200, 0.1)
+
+        output = metrics.render()
+        self.assertTrue('httphq_requests_total{route="/get",method="GET",code="200"} 2' in output)
+        self.assertTrue('httphq_requests_total{route="/status/{status_code}",method="POST",code="404"} 1' in output)
+        self.assertTrue('httphq_request_duration_seconds_bucket{route="/get",method="GET",le="0.0025"} 0' in output)
+        self.assertTrue('httphq_request_duration_seconds_bucket{route="/get",method="GET",le="0.005"} 1' in output)
+        self.assertTrue('httphq_request_duration_seconds_bucket{route="/get",method="GET",le="+Inf"} 2' in output)
+        self.assertTrue('httphq_request_duration_seconds_count{route="/get",method="GET"} 2' in output)
+
+
+class BinsTestCase(unittest.TestCase):
+
+    def make_record(self, body, args=None, files=None):
+        return Record("POST", {"url": "/bin/test", "ip": "127.0.0.1", "headers": {},
+                               "args": args or {}, "body": body, "files": files,
+                               "start_time": 0})
+
+    def test_ring_buffer(self):
+        storage = BinsStorage()
+        bin = storage.create(3)
+        for i in range(5):
+            storage.record(bin.id, self.make_record(str(i).encode()))
+
+        self.assertEqual(len(bin), 3)
+        self.assertEqual([x.body for x in bin], [b"4", b"3", b"2"])
+        self.assertEqual(storage.size, bin.size)
+        self.assertEqual(bin.size, BIN_OVERHEAD + 8 * 3 + sum(x.size for x in bin))
+        self.assertEqual(storage.record("unknown", self.make_record(b"")), None)
+
+        storage.delete(bin.id)
+        self.assertEqual(storage.size, 0)
+        self.assertEqual(len(storage), 0)
+
+        bin = storage.create(-5)
+        self.assertEqual(bin.capacity, 1)
+        storage.record(bin.id, self.make_record(b"x"))
+        self.assertEqual(len(bin), 1)
+
+    def test_eviction(self):
+        size = self.make_record(b"x" * 1000).size
+        overhead = BIN_OVERHEAD + 8 * 50
+        storage = BinsStorage(max_size=(overhead + size) * 3)
+        first, second, third = storage.create(), storage.create(), storage.create()
+
+        storage.record(first.id, self.make_record(b"x" * 1000))
+        storage.record(second.id, self.make_record(b"x" * 1000))
+        storage.get(first.id)
+        storage.record(third.id, self.make_record(b"x" * 1000))
+        storage.record(third.id, self.make_record(b"x" * 1000))
+
+        self.assertEqual(storage.get(second.id), None)
+        self.assertEqual(storage.evicted, 1)
+        self.assertEqual(storage.size, overhead * 2 + size * 3)
+        self.assertTrue(storage.size <= storage.max_size)
+
+    def test_single_bin(self):
+        size = self.make_record(b"x" * 1000).size
+        overhead = BIN_OVERHEAD + 8 * 50
+        storage = BinsStorage(max_size=overhead + size * 3)
+        bin = storage.create()
+        for i in range(10):
+            storage.record(bin.id, self.make_record(str(i).encode() * 1000))
+
+        # The oldest records are dropped
+        self.assertEqual([x.body[:1] for x in bin], [b"9", b"8", b"7"])
+        self.assertEqual(storage.size, bin.size)
+        self.assertTrue(storage.size <= storage.max_size)
+
+        storage.record(bin.id, self.make_record(b"a"))
+        self.assertEqual([x.body[:1] for x in bin], [b"a", b"9", b"8"])
+
+    def test_max_bins(self):
+        storage = BinsStorage(max_bins=3)
+        bins = [storage.create() for i in range(5)]
+        self.assertEqual(len(storage), 3)
+        self.assertEqual(storage.evicted, 2)
+        self.assertEqual([x.id for x in storage], [x.id for x in bins[2:]])
+        self.assertEqual(storage.size, sum(x.size for x in bins[2:]))
+
+    def test_truncate(self):
+        record = Record("POST", {"url": "/bin/test", "ip": "127.0.0.1", "headers": {},
+                                 "args": {"a": ["x" * 60, "y" * 60], "b": ["z"]},
+                                 "body": b"x" * 50,
+                                 "files": {"f": [{"filename": "f", "content_type": "text/plain",
+                                                  "body": b"f" * 10}]},
+                                 "start_time": 0}, max_body_size=100)
+        self.assertEqual(record.body, b"x" * 50)
+        self.assertEqual(record.args, {"a": ["x" * 49]})
+        self.assertEqual(record.files, {})
+
+        record = self.make_record(b"", {"a": ["x" * 10]}, {"f": [{"body": b"f" * 200000}]})
+        self.assertEqual(record.args, {"a": ["x" * 10]})
+        self.assertEqual(len(record.files["f"][0]["body"]), 64 * 1024 - 11)
+        self.assertTrue(record.size < 70 * 1024)
+
+
+class NonceStoreTestCase(unittest.TestCase):
+
+    def test_nonce_count(self):
+        store = nonces.NonceStore()
+        nonce = store.issue("opaque")
+        self.assertEqual(store.check(nonce, "00000001", "opaque"), nonces.VALID)
+        self.assertEqual(store.check(nonce, "00000002", "opaque"), nonces.VALID)
+        self.assertEqual(store.check(nonce, "00000002", "opaque"), nonces.REPLAY)
+        self.assertEqual(store.check(nonce, "00000003", "other"), nonces.INVALID)
+        self.assertEqual(store.check("a" * 40, "00000001"), nonces.INVALID)
+        self.assertEqual(store.check(nonce[:-1] + "x", None), nonces.INVALID)
+
+    def test_expiration(self):
+        store = nonces.NonceStore(ttl=-1)
+        nonce = store.issue()
+        self.assertEqual(store.check(nonce), nonces.STALE)
+        self.assertEqual(len(store), 0)
+
+    def test_max_size(self):
+        store = nonces.NonceStore(max_size=10)
+        issued = [store.issue() for x in range(20)]
+        self.assertEqual(len(store), 10)
+        self.assertFalse(issued[0] in store)
+
+        # Evicted nonce can't be replayed, client gets fresh one
+        self.assertEqual(store.check(issued[0], "00000001"), nonces.STALE)
+        self.assertEqual(store.check(issued[0]), nonces.STALE)
+        self.assertFalse(issued[0] in store)
+        self.assertEqual(len(store), 10)
+
+        # Other worker nonces share signing key
+        other = nonces.NonceStore(secret=store.secret)
+        self.assertEqual(other.check(issued[15]), nonces.STALE)
+        self.assertEqual(other.check(issued[15][:-1] + "x"), nonces.INVALID)
+
+
+class ReplayCacheTestCase(unittest.TestCase):
+
+    def test_replay(self):
+        cache = nonces.ReplayCache(window=300)
+        now = int(time.time())
+        self.assertTrue(cache.add(now, "consumer", "token", "nonce"))
+        self.assertFalse(cache.add(now, "consumer", "token", "nonce"))
+        self.assertTrue(cache.add(now, "other", "token", "nonce"))
+        self.assertTrue(cache.add(now - 1, "consumer", "token", "nonce"))
+        self.assertEqual(len(cache), 3)
+
+    def test_expiration(self):
+        cache = nonces.ReplayCache(window=300, bucket_size=10)
+        now = int(time.time())
+        for i in range(100):
+            cache.add(now - 300 + i, "consumer", None, str(i))
+        self.assertFalse(cache.add(now - 600, "consumer", None, "nonce"))
+        self.assertEqual(len(cache), 100)
+
+        # Buckets out of window are dropped as a whole
+        cache.window = 250
+        self.assertTrue(cache.add(now, "consumer", None, "nonce"))
+        self.assertTrue(len(cache) < 100)
+        self.assertTrue(all(k >= (now - 250) // 10 for k in cache._buckets))
+
+
+class OAuthSignatureTestCase(unittest.TestCase):
+
+    def make_authorization(self, signature_method):
+        # RFC 5849 section 1.2 example
+        return Authorization('OAuth', {'realm': "Photos",
+                                       'oauth_consumer_key': "dpf43f3p2l4k3l03",
+                                       'oauth_token': "nnch734d00sl2jdk",
+                                       'oauth_signature_method': signature_method,
+                                       'oauth_timestamp': "137131202",
+                                       'oauth_nonce': "chapoH"})
+
+    def test_normalize_request(self):
+        # RFC 5849 section 3.4.1 example
+        request = HTTPServerRequest(
+            method="POST", uri="/request?b5=%3D%253D&a3=a&c%40=&a2=r%20b", body=b"c2&a3=2+q",
+            headers=HTTPHeaders({"Host": "example.com",
+                                 "Content-Type": "application/x-www-form-urlencoded"}))
+        authorization = Authorization('OAuth', {'realm': "Example",
+                                                'oauth_consumer_key': "9djdj82h48djs9d2",
+                                                'oauth_token': "kkk9d7dh3k39sjv7",
+                                                'oauth_signature_method': "HMAC-SHA1",
+                                                'oauth_timestamp': "137131201",
+                                                'oauth_nonce': "7d8f3e4a",
+                                                'oauth_signature': "djosJKDKJSD8743243/jdk33klY="})
+        request_info = normalize_request(request, authorization)
+        self.assertEqual(request_info['normalized_url'], "http://example.com/request")
+        self.assertEqual(request_info['normalized_parameters'],
+                         "a2=r%20b&a3=2%20q&a3=a&b5=%3D%253D&c%40=&c2=&oauth_consumer_key=9djdj82h48djs9d2"
+                         "&oauth_nonce=7d8f3e4a&oauth_signature_method=HMAC-SHA1"
+                         "&oauth_timestamp=137131201&oauth_token=kkk9d7dh3k39sjv7")
+
+    def test_signatures(self):
+        request = HTTPServerRequest(method="GET", uri="/photos?file=vacation.jpg&size=original",
+                                    headers=HTTPHeaders({"Host": "photos.example.net"}))
+
+        request_info = normalize_request(request, self.make_authorization("HMAC-SHA1"))
+        signature_method = SIGNATURES_METHODS["HMAC-SHA1"]
+        self.assertEqual(signature_method.sign(request_info, "kd94hf93k423kf44", "pfkkdhi9sl3r4s00"),
+                         "MdpQcU8iPSUjWoN/UDMsK2sui9I=")
+        self.assertTrue(signature_method.check(request_info, "kd94hf93k423kf44", "pfkkdhi9sl3r4s00",
+                                               "MdpQcU8iPSUjWoN/UDMsK2sui9I="))
+        self.assertFalse(signature_method.check(request_info, "kd94hf93k423kf44", "other",
+                                                "MdpQcU8iPSUjWoN/UDMsK2sui9I="))
+
+        for name in ("HMAC-SHA256", "RSA-SHA1", "PLAINTEXT"):
+            signature_method = SIGNATURES_METHODS[name]
+            request_info = normalize_request(request, self.make_authorization(name))
+            signature = signature_method.sign(request_info, "kd94hf93k423kf44", "pfkkdhi9sl3r4s00")
+            self.assertTrue(signature_method.check(request_info, "kd94hf93k423kf44",
+                                                   "pfkkdhi9sl3r4s00", signature))
+            self.assertFalse(signature_method.check(request_info, "kd94hf93k423kf44",
+                                                    "pfkkdhi9sl3r4s00", signature[::-1]))
+        self.assertEqual(signature, "kd94hf93k423kf44&pfkkdhi9sl3r4s00")
+
+
+class TokensTestCase(unittest.TestCase):
+
+    def test_jwt(self):
+        # RFC 7515 appendix A.1 example
+        key = b64url_decode("AyM1SysPpbyDfgZld3umj1qzKObwVMkoqQ-EstJQLr_T-1qS0gZH75aKtMN3Yj0iPS4hcgUuTwjAzZr1Z9CAow")
+        token = ("eyJ0eXAiOiJKV1QiLA0KICJhbGciOiJIUzI1NiJ9"
+                 ".eyJpc3MiOiJqb2UiLA0KICJleHAiOjEzMDA4MTkzODAsDQogImh0dHA6Ly9leGFtcGxlLmNvbS9pc19yb290Ijp0cnVlfQ"
+                 ".dBjftJeZ4CVP-mB92K27uhbUJU1p1r_wW1gFWFOEjXk")
+        header, claims = jwt_decode(token, key, now=1300819370)
+        self.assertEqual(claims, {"iss": "joe", "exp": 1300819380, "http://example.com/is_root": True})
+        self.assertRaises(ValueError, jwt_decode, token, key, 1300819380)
+        self.assertRaises(ValueError, jwt_decode, token, b"other key", 1300819370)
+        self.assertRaises(ValueError, jwt_decode, "token", key)
+
+        token = jwt_encode({"sub": "user"}, "secret")
+        self.assertEqual(jwt_decode(token, "secret")[1], {"sub": "user"})
+
+        # Unsigned tokens are rejected
+        self.assertRaises(ValueError, jwt_decode,
+                          "eyJhbGciOiJub25lIn0." + token.split(".")[1] + ".", "secret")
+
+    def test_token_cache(self):
+        tokens = TokenCache("secret")
+        token = tokens.issue({"sub": "user"}, 60)
+        self.assertEqual(tokens.verify(token)["sub"], "user")
+        self.assertEqual(tokens.verify(token)["sub"], "user")
+        self.assertEqual((tokens.hits, tokens.misses), (1, 1))
+
+        token = tokens.issue({"sub": "user"}, -1)
+        self.assertRaises(ValueError, tokens.verify, token)
+        self.assertEqual(len(tokens), 1)
+
+
+class RoutingTestCase(unittest.TestCase):
+
+    def test_split_pattern(self):
+        self.assertEqual(split_pattern(r"/"), [""])
+        self.assertEqual(split_pattern(r"/status/(?P<status_code>\d{3})"), ["status", r"(?P<status_code>\d{3})"])
+        self.assertEqual(split_pattern(r"/a/(?P<x>[/a]+)/(?P<y>(?:b|/c))$"), ["a", "(?P<x>[/a]+)", "(?P<y>(?:b|/c))"])
+
+    def test_find(self):
+        routes = RouteTrie([(r"/", dict),
+                            (r"/redirect/(?P<num>\d{1,2})", list),
+                            (r"/redirect/end", set),
+                            (r"/oauth/2.0/token/(?P<client_id>.+)", tuple),
+                            (r"/oauth/(?P<version>.+)/token/(?P<key>.+)", int),
+                            (r"/robots.txt", str)])
+
+        self.assertEqual(routes.find("/"), (dict, {}))
+        self.assertEqual(routes.find("/redirect/12"), (list, {"num": b"12"}))
+        self.assertEqual(routes.find("/redirect/end"), (set, {}))
+        self.assertEqual(routes.find("/redirect/123"), None)
+        self.assertEqual(routes.find("/robots.txt"), (str, {}))
+
+        # The first route in list wins
+        self.assertEqual(routes.find("/oauth/2.0/token/a%2Fb"), (tuple, {"client_id": b"a/b"}))
+        self.assertEqual(routes.find("/oauth/1.0/token/key"), (int, {"version": b"1.0", "key": b"key"}))
+
+        # Groups don't span slashes
+        self.assertEqual(routes.find("/oauth/1.0/token/key/other"), None)
+        self.assertEqual(routes.find("/oauth/" + "a/" * 10000), None)
+
+
+class EncodersTestCase(unittest.TestCase):
+
+    data = {"args": {"a": ["1", u"\u0439"]}, "body": b"</script>\xff", "time": 0.25, "none": None}
+
+    def test_stdlib(self):
+        data = dict(self.data, body=u"</script>\ufffd")
+        self.assertEqual(get_json_encoder("stdlib")(data), utf8(tornado.escape.json_encode(data)))
+
+    def test_encoders(self):
+        expected = json.loads(get_json_encoder("stdlib")(self.data).decode('utf-8'))
+        self.assertEqual(expected["body"], u"</script>\ufffd")
+
+        for name, encoder in JSON_ENCODERS.items():
+            output = encoder(self.data)
+            self.assertTrue(isinstance(output, bytes))
+            self.assertTrue(b"<\\/script>" in output)
+            self.assertEqual(json.loads(output.decode('utf-8')), expected)
+
+        self.assertTrue(get_json_encoder("auto") in JSON_ENCODERS.values())
+        self.assertRaises(ValueError, get_json_encoder, "unknown")
+
+    def test_msgpack(self):
+        for value, expected in ((None, b"\xc0"), (True, b"\xc3"), (127, b"\x7f"), (-32, b"\xe0"),
+                                (128, b"\xcc\x80"), (-33, b"\xd0\xdf"), (65536, b"\xce\x00\x01\x00\x00"),
+                                (1.5, b"\xcb\x3f\xf8" + b"\x00" * 6), (u"\u0439", b"\xa2\xd0\xb9"),
+                                (b"\xff", b"\xc4\x01\xff"), ([1, [2]], b"\x92\x01\x91\x02"),
+                                ({"a": b""}, b"\x81\xa1a\xc4\x00")):
+            self.assertEqual(msgpack_dumps(value), expected)
+        self.assertEqual(msgpack_dumps(u"x" * 32)[:2], b"\xd9\x20")
+        self.assertEqual(msgpack_dumps(list(range(16)))[:3], b"\xdc\x00\x10")
+        self.assertRaises(TypeError, msgpack_dumps, object())
+
+    def test_cbor(self):
+        # RFC 8949 Appendix A
+        for value, expected in ((0, b"\x00"), (23, b"\x17"), (24, b"\x18\x18"), (1000, b"\x19\x03\xe8"),
+                                (1000000, b"\x1a\x00\x0f\x42\x40"), (-1, b"\x20"), (-1000, b"\x39\x03\xe7"),
+                                (18446744073709551615, b"\x1b" + b"\xff" * 8),
+                                (1.1, b"\xfb\x3f\xf1\x99\x99\x99\x99\x99\x9a"), (False, b"\xf4"),
+                                (None, b"\xf6"), (b"\x01\x02\x03\x04", b"\x44\x01\x02\x03\x04"),
+                                (u"\u00fc", b"\x62\xc3\xbc"), ([1, [2, 3]], b"\x82\x01\x82\x02\x03"),
+                                ({"a": 1}, b"\xa1\x61\x61\x01")):
+            self.assertEqual(cbor_dumps(value), expected)
+        self.assertRaises(TypeError, cbor_dumps, object())
+
+    def test_choose_media_type(self):
+        available = ("application/json", "application/msgpack", "application/cbor")
+        self.assertEqual(choose_media_type(None, available), "application/json")
+        self.assertEqual(choose_media_type("application/cbor", available), "application/cbor")
+        self.assertEqual(choose_media_type("text/html,*/*;q=0.8", available), "application/json")
+        self.assertEqual(choose_media_type("application/json;q=0.5, application/msgpack", available),
+                         "application/msgpack")
+        self.assertEqual(choose_media_type("application/*;q=0.9, application/json;q=0.1", available),
+                         "application/msgpack")
+        self.assertEqual(choose_media_type("text/plain", available), None)
+
+
+class AccessLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "access.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, path=None):
+        with open(path or self.path, "rb") as f:
+            return [json.loads(x.decode('utf-8')) for x in f.read().splitlines()]
+
+    def test_write(self):
+        log = AccessLog(self.path, flush_interval=0.01)
+        log.start()
+        self.assertTrue(log.record("GET", "/status/{status_code}", "/status/404", 404, 0, 0.001, "127.0.0.1"))
+        log.stop()
+
+        records = self.read()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["route"], "/status/{status_code}")
+        self.assertEqual(records[0]["status"], 404)
+        self.assertEqual(records[0]["ip"], "127.0.0.1")
+        self.assertEqual(log.written, 1)
+
+    def test_sample_and_drop(self):
+        log = AccessLog(self.path, sample=2, queue_size=3)
+        for i in range(10):
+            log.record("GET", "/get", "/get", 200, 10, 0.001, "127.0.0.1")
+        self.assertEqual(log.skipped, 5)
+        self.assertEqual(log.dropped, 2)
+        self.assertEqual(log.stats()["queued"], 3)
+
+    def test_rotate(self):
+        log = AccessLog(self.path, max_bytes=200, backups=2)
+        log._open()
+        for i in range(6):
+            log.record("GET", "/get", "/get", 200, i, 0.001, "127.0.0.1")
+            log.write_batch()
+        log._file.close()
+
+        self.assertTrue(log.rotations >= 2)
+        self.assertTrue(os.path.exists(self.path + ".2"))
+        self.assertFalse(os.path.exists(self.path + ".3"))
+        self.assertEqual(self.read(self.path + ".1")[-1]["bytes"], 5)
+
+
+class AdmissionTestCase(unittest.TestCase):
+
+    start_line = RequestStartLine("POST", "/post?a=1", "HTTP/1.1")
+
+    def test_limits(self):
+        admission = Admission(max_in_flight=1, max_body_size=100, max_header_size=200, retry_after=5)
+        rejection, limit = admission.check_request(self.start_line, HTTPHeaders({"Content-Length": "100"}))
+        self.assertEqual((rejection, limit), (None, None))
+
+        rejection, limit = admission.check_request(self.start_line, HTTPHeaders({"Content-Length": "101"}))
+        self.assertTrue(rejection.startswith(b"HTTP/1.1 413 "))
+        self.assertTrue(b"\r\nRetry-After: 5\r\n" in rejection)
+
+        rejection, limit = admission.check_request(self.start_line, HTTPHeaders({"X-Big": "x" * 200}))
+        self.assertTrue(rejection.startswith(b"HTTP/1.1 431 "))
+
+        connection = BytesIO()
+        admission.acquire(connection)
+        rejection, limit = admission.check_request(self.start_line, HTTPHeaders())
+        self.assertTrue(rejection.startswith(b"HTTP/1.1 503 "))
+        admission.release(connection)
+        self.assertEqual(admission.in_flight, 0)
+
+        self.assertEqual(admission.rejected, {"connections": 0, "in_flight": 1, "headers": 1,
+                                              "body": 1, "route_body": 0})
+        self.assertTrue('limit="body",code="413"} 1' in admission.render())
+
+    def test_route_body_limits(self):
+        routes = RouteTrie([("/post", "post"), ("/put", "put")])
+        admission = Admission(route_body_limits={"post": 10}, routes=routes)
+
+        rejection, limit = admission.check_request(self.start_line, HTTPHeaders({"Content-Length": "11"}))
+        self.assertTrue(rejection.startswith(b"HTTP/1.1 413 "))
+        self.assertEqual(admission.rejected["route_body"], 1)
+
+        # Chunked body is checked while it is read
+        rejection, limit = admission.check_request(self.start_line, HTTPHeaders({"Transfer-Encoding": "chunked"}))
+        self.assertEqual((rejection, limit), (None, 10))
+
+        put = RequestStartLine("PUT", "/put", "HTTP/1.1")
+        self.assertEqual(admission.check_request(put, HTTPHeaders({"Content-Length": "11"})), (None, None))
+
+    def test_connections(self):
+        admission = Admission(max_connections=2)
+        self.assertEqual(admission.check_connection(1), None)
+        self.assertEqual(admission.connections, 2)
+        self.assertTrue(admission.check_connection(2).startswith(b"HTTP/1.1 503 "))
+        self.assertEqual(admission.rejected["connections"], 1)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_bucket(self):
+        limiter = RateLimiter()
+        decisions = [limiter.hit("client", 2, 3, now=100) for i in range(4)]
+        self.assertEqual([x.allowed for x in decisions], [True, True, True, False])
+        self.assertEqual(decisions[0].remaining, 2)
+        self.assertEqual(decisions[3].retry_after, 0.5)
+        self.assertEqual(dict(decisions[3].headers())["Retry-After"], "1")
+        self.assertEqual(dict(decisions[3].headers())["RateLimit-Policy"], "3;w=2")
+
+        # Refilled by rate, but not over burst
+        self.assertTrue(limiter.hit("client", 2, 3, now=100.5).allowed)
+        self.assertFalse(limiter.hit("client", 2, 3, now=100.5).allowed)
+        self.assertEqual(limiter.hit("client", 2, 3, now=1000).remaining, 2)
+        self.assertTrue(limiter.hit("other", 2, 3, now=1000).allowed)
+        self.assertEqual((limiter.allowed, limiter.limited), (6, 2))
+
+    def test_cost(self):
+        limiter = RateLimiter()
+        # Explicit zero time isn't replaced by current time
+        decision = limiter.hit("client", 1, 5, cost=3, now=0)
+        self.assertEqual((decision.allowed, decision.remaining, decision.reset), (True, 2, 3))
+        decision = limiter.hit("client", 1, 5, cost=3, now=0)
+        self.assertEqual((decision.allowed, decision.retry_after), (False, 1))
+        self.assertTrue(limiter.hit("client", 1, 5, cost=3, now=1).allowed)
+        self.assertRaises(ValueError, limiter.hit, "client", 1, 5, cost=6)
+
+    def test_expire(self):
+        limiter = RateLimiter(max_keys=3)
+        limiter.hit("a", 1, 2, now=100)
+        limiter.hit("b", 1, 2, now=100)
+        # Full bucket is forgotten
+        limiter.hit("c", 1, 2, now=102)
+        self.assertEqual(len(limiter), 1)
+
+        for key in ("d", "e", "f", "g"):
+            limiter.hit(key, 1, 2, now=103)
+        self.assertEqual(len(limiter), 3)
+        self.assertFalse("c" in limiter)
+
+
+class ChaosTestCase(unittest.TestCase):
+
+    start_line = RequestStartLine("GET", "/get", "HTTP/1.1")
+
+    def test_parse_options(self):
+        self.assertEqual(parse_options("error=0.5, error_status:503,unknown=1,reset=bad"),
+                         {"error": 0.5, "error_status": 503})
+        self.assertEqual(parse_options("seed=1", {"error": 1.0}), {"error": 1.0, "seed": 1})
+
+    def test_plan(self):
+        injector = FaultInjector()
+        self.assertEqual(injector.plan(self.start_line, HTTPHeaders()), None)
+
+        plan = injector.plan(self.start_line, HTTPHeaders({"X-Chaos": "error=1, error_status=503"}))
+        self.assertEqual(plan.faults, set(["error"]))
+        self.assertEqual(plan.option("error_status"), 503)
+        self.assertFalse(plan.wire)
+
+        query = RequestStartLine("GET", "/get?chaos=truncate:1,bad_status:1", "HTTP/1.1")
+        self.assertEqual(injector.plan(query, HTTPHeaders()).faults, set(["truncate", "bad_status"]))
+        self.assertEqual(injector.injected["truncate"], 1)
+
+        # The same seed draws the same faults
+        headers = HTTPHeaders({"X-Chaos": "seed=7,error=0.5,reset=0.5,truncate=0.5"})
+        plans = [injector.plan(self.start_line, headers) for i in range(2)]
+        self.assertEqual(*[x and x.faults for x in plans])
+
+        # Upgraded connection can get error only
+        headers = HTTPHeaders({"X-Chaos": "error=1,reset=1", "Upgrade": "websocket"})
+        self.assertEqual(injector.plan(self.start_line, headers).faults, set(["error"]))
+
+        injector = FaultInjector({"error": 1.0}, per_request=False)
+        self.assertEqual(injector.plan(self.start_line, HTTPHeaders({"X-Chaos": "error=0"})).faults,
+                         set(["error"]))
+
+    def test_serialize(self):
+        start_line = ResponseStartLine("HTTP/1.1", 200, "OK")
+        headers = HTTPHeaders({"Content-Type": "text/plain", "Content-Length": "6"})
+
+        plan = Plan(set(["content_length"]), {"content_length_delta": -2}, None, "GET")
+        head = serialize(plan, start_line, headers, 6)
+        self.assertTrue(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(head.endswith(b"Connection: close\r\nContent-Length: 4\r\n\r\n"))
+
+        plan = Plan(set(["truncate", "bad_status"]), {}, random.Random(1), "GET")
+        head = serialize(plan, start_line, headers, 6)
+        self.assertFalse(head.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(b"Transfer-Encoding: chunked\r\n" in head)
+        self.assertTrue(b"Content-Length" not in head)
+
+        plan = Plan(set(["reset"]), {}, None, "GET")
+        self.assertTrue(serialize(plan, start_line, headers, None).endswith(
+            b"Transfer-Encoding: chunked\r\n\r\n"))
+
+
+class FakeConnection(object):
+    """Request connection and its stream
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.data = []
+        self.stream = self
+        self.closed_connection = False
+        self.reset = False
+
+    def closed(self):
+        return self.closed_connection
+
+    def close(self):
+        self.closed_connection = True
+
+    @property
+    def socket(self):
+        return self
+
+    def setsockopt(self, *args):
+        self.reset = True
+
+    def write_headers(self, start_line, headers, chunk=None):
+        self.calls.append(("headers", start_line.code))
+
+    def write(self, chunk):
+        self.calls.append(("write", chunk))
+        self.data.append(chunk)
+
+    def finish(self):
+        self.calls.append(("finish", None))
+
+
+class FakeTicker(set):
+
+    interval = 0.01
+
+
+class FakeStream(FakeConnection):
+    """Connection with stream writes resolved on IOLoop
+    """
+
+    def write(self, chunk):
+        super(FakeStream, self).write(chunk)
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class FaultyConnectionTestCase(AsyncTestCase):
+
+    def run_callbacks(self):
+        self.io_loop.run_sync(lambda: gen.sleep(0))
+
+    def faulty(self, faults, options=None):
+        connection = FakeStream()
+        faulty = FaultyConnection(connection)
+        faulty.plan = Plan(set(faults), options or {}, random.Random(1), "GET")
+        return connection, faulty
+
+    def test_stream_content_length(self):
+        connection, faulty = self.faulty(["content_length"], {"content_length_delta": 5})
+        headers = HTTPHeaders({"Content-Length": "6"})
+        faulty.write_headers(ResponseStartLine("HTTP/1.1", 200, "OK"), headers, b"abc")
+        # Body isn't buffered
+        self.assertEqual(connection.data[-1], b"abc")
+        self.assertTrue(b"Content-Length: 11\r\n" in connection.data[0])
+        future = faulty.write(b"def")
+        self.assertTrue(future.done())
+        faulty.finish()
+        self.run_callbacks()
+        self.assertEqual(b"".join(connection.data).split(b"\r\n\r\n", 1)[1], b"abcdef")
+        self.assertTrue(connection.closed_connection)
+
+        # Streamed response is wrong relative to its first part
+        connection, faulty = self.faulty(["content_length"], {"content_length_delta": -1})
+        faulty.write_headers(ResponseStartLine("HTTP/1.1", 200, "OK"), HTTPHeaders(), b"abc")
+        self.assertTrue(b"Content-Length: 2\r\n" in connection.data[0])
+
+    def test_stream_reset(self):
+        connection, faulty = self.faulty(["reset"], {"reset_after": 4})
+        faulty.write_headers(ResponseStartLine("HTTP/1.1", 200, "OK"), HTTPHeaders())
+        faulty.write(b"abc")
+        faulty.write(b"def")
+        self.run_callbacks()
+        self.assertTrue(connection.closed_connection and connection.reset)
+        self.assertEqual(connection.data[1:], [b"3\r\nabc\r\n", b"3\r\nd"])
+
+        # Writes after reset fail as on closed stream
+        self.assertTrue(faulty.write(b"ghi").exception() is not None)
+        faulty.finish()
+        self.assertEqual(len(connection.data), 3)
+
+    def test_stream_truncate(self):
+        connection, faulty = self.faulty(["truncate"])
+        faulty.write_headers(ResponseStartLine("HTTP/1.1", 200, "OK"),
+                             HTTPHeaders({"Content-Length": "1000"}))
+        self.assertTrue(connection.data[0].endswith(b"chunked\r\n\r\n3e8\r\n"))
+        for i in range(10):
+            faulty.write(b"x" * 100)
+        self.run_callbacks()
+        self.assertTrue(connection.closed_connection)
+        self.assertFalse(connection.reset)
+        self.assertTrue(len(b"".join(connection.data[1:])) <= 500)
+
+        # Chunk of streamed response is cut
+        connection, faulty = self.faulty(["truncate"])
+        faulty.write_headers(ResponseStartLine("HTTP/1.1", 200, "OK"), HTTPHeaders(), b"x" * 100)
+        self.assertTrue(connection.data[1].startswith(b"64\r\n"))
+        self.assertTrue(len(connection.data[1]) <= 54)
+        self.run_callbacks()
+        self.assertTrue(connection.closed_connection)
+
+
+class NetworkTestCase(AsyncTestCase):
+
+    def test_latency(self):
+        generator = random.Random(1)
+        self.assertEqual(Profile("fixed", 0.1).sample_latency(generator), 0.1)
+        for distribution in ("uniform", "normal", "pareto"):
+            profile = Profile("test", 0.1, 0.05, distribution)
+            values = [profile.sample_latency(generator) for i in range(1000)]
+            self.assertTrue(min(values) >= 0)
+            self.assertTrue(0.08 < sum(values) / len(values) < 0.2)
+        self.assertRaises(ValueError, Profile, "test", distribution="unknown")
+
+    def test_select(self):
+        profiles = NetworkProfiles({"lan": {"latency": 0.001}}, default="lan")
+        start_line = RequestStartLine("GET", "/get", "HTTP/1.1")
+        self.assertEqual(profiles.select(start_line, HTTPHeaders()).name, "lan")
+        self.assertEqual(profiles.select(start_line, HTTPHeaders({"X-Network-Profile": "3g"})).name, "3g")
+        self.assertEqual(profiles.select(start_line, HTTPHeaders({"X-Network-Profile": "none"})), None)
+
+        query = RequestStartLine("GET", "/get?network=satellite", "HTTP/1.1")
+        self.assertEqual(profiles.select(query, HTTPHeaders()).name, "satellite")
+        self.assertEqual(profiles.selected["lan"], 1)
+
+        self.assertEqual(NetworkProfiles().select(start_line, HTTPHeaders()), None)
+        self.assertEqual(profiles.select(start_line, HTTPHeaders({"Upgrade": "websocket"})), None)
+        self.assertRaises(ValueError, NetworkProfiles, default="unknown")
+
+    def test_shaping(self):
+        connection = FakeConnection()
+        ticker = FakeTicker()
+        shaped = ShapedConnection(connection, ticker)
+
+        # Not shaped requests are passed as is
+        shaped.write(b"a")
+        self.assertEqual(connection.calls, [("write", b"a")])
+        connection.calls = []
+
+        shaped.shape(Profile("test", latency=60, down=1000), "GET", random.Random(1))
+        shaped.write_headers(ResponseStartLine("HTTP/1.1", 200, "OK"), HTTPHeaders())
+        future = shaped.write(b"x" * 2000)
+        shaped.finish()
+        self.assertEqual(len(ticker), 1)
+
+        shaped._tick()
+        self.assertEqual(connection.calls, [])
+
+        # Budget is capped to one segment
+        shaped._ready_at = shaped._last_tick = time.time() - 10
+        shaped._tick()
+        self.assertEqual(connection.calls, [("headers", 200), ("write", b"x" * 1460)])
+        self.assertFalse(future.done())
+
+        shaped._last_tick = time.time() - 10
+        shaped._tick()
+        self.assertEqual(connection.calls[2:], [("write", b"x" * 540), ("finish", None)])
+        self.assertTrue(future.done())
+        self.assertEqual(len(ticker), 0)
+
+
+class HandlerTestCase(AsyncHTTPTestCase):
+    """Requests to application served by httphq server stack
+    """
+
+    settings = {}
+
+    def get_app(self):
+        application = HTTPApplication()
+        application.settings.update(self.settings)
+        return application
+
+    def get_http_server(self):
+        return HTTPServer(wrap_application(self._app), **self.get_httpserver_options())
+
+    def fetch_json(self, path, **kwargs):
+        response = self.fetch(path, **kwargs)
+        return response, json.loads(response.body)
+
+
+class HomeHandlerTestCase(HandlerTestCase):
+
+    def test_cached(self):
+        response = self.fetch("/")
+        self.assertEqual(response.code, 200)
+        etag, body = response.headers["Etag"], response.body
+        self.assertTrue(b"Request time" not in body)
+
+        # The same page for every request
+        response = self.fetch("/")
+        self.assertEqual((response.headers["Etag"], response.body), (etag, body))
+        self.assertEqual(self.fetch("/", headers={"If-None-Match": etag}).code, 304)
+        self.assertEqual(len(self._app.pages), 1)
+
+    def test_hosts(self):
+        self._app.pages = PagesCache(max_size=3)
+
+        self.fetch("/", headers={"Host": "example.com"})
+        self.fetch("/", headers={"Host": "EXAMPLE.com:80"})
+        self.assertEqual(len(self._app.pages), 1)
+
+        # Random hosts evict the least recently used pages only
+        for x in range(10):
+            self.fetch("/", headers={"Host": "host%d.example.com" % x})
+            self.fetch("/", headers={"Host": "example.com"})
+        self.assertEqual(len(self._app.pages), 3)
+        self.assertTrue(self._app.pages.get(("index.html", "example.com")) is not None)
+
+
+class DelayHandlerTestCase(HandlerTestCase):
+
+    settings = {"max_delay": 0.5}
+
+    def test_delay(self):
+        started = time.time()
+        response, data = self.fetch_json("/delay/0.2?a=1")
+        self.assertEqual(response.code, 200)
+        self.assertTrue(time.time() - started >= 0.2)
+        self.assertEqual(data["delay"], 0.2)
+        self.assertEqual(data["args"], {"a": ["1"]})
+
+        response, data = self.fetch_json("/delay/0.1", method="POST", body="x=1")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(data["delay"], 0.1)
+
+    def test_max_delay(self):
+        started = time.time()
+        response, data = self.fetch_json("/delay/30")
+        self.assertEqual(data["delay"], 0.5)
+        self.assertTrue(time.time() - started < 5)
+
+        self.assertEqual(self.fetch("/delay/1.5.5").code, 404)
+        self.assertEqual(self.fetch("/delay/-1").code, 404)
+
+    @gen_test
+    def test_not_blocking(self):
+        finished = []
+
+        def fetch(path):
+            future = self.http_client.fetch(self.get_url(path))
+            future.add_done_callback(lambda future: finished.append(path))
+            return future
+
+        # Below client max_clients, so /get isn't queued behind them
+        delayed = [fetch("/delay/0.3") for i in range(5)]
+        yield fetch("/get")
+        self.assertEqual(finished, ["/get"])
+        responses = yield delayed
+        self.assertEqual(set(x.code for x in responses), set([200]))
+
+
+class StreamHandlerTestCase(HandlerTestCase):
+
+    def test_stream(self):
+        chunks = []
+        response = self.fetch("/stream/5", streaming_callback=chunks.append)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        self.assertTrue("Content-Length" not in response.headers)
+        self.assertTrue(len(chunks) > 1)
+
+        lines = b"".join(chunks).split(b"\n")
+        self.assertEqual(lines[-1], b"")
+        self.assertEqual([json.loads(x)["id"] for x in lines[:-1]], list(range(5)))
+        self.assertEqual(json.loads(lines[0])["url"], self.get_url("/stream/5"))
+
+    def test_empty(self):
+        response = self.fetch("/stream/0")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b"")
+
+    def test_head(self):
+        response = self.fetch("/stream/3", method="HEAD")
+        self.assertEqual(response.code, 405)
+
+
+class BytesHandlerTestCase(HandlerTestCase):
+
+    def test_bytes(self):
+        response = self.fetch("/bytes/100?seed=1")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/octet-stream")
+        self.assertEqual(response.headers["Content-Length"], "100")
+        self.assertEqual(response.body, self._app.bytes_pool.get_buffer(1)[:100])
+        self.assertEqual(self.fetch("/bytes/100?seed=1&chunk_size=7").body, response.body)
+        self.assertNotEqual(self.fetch("/bytes/100?seed=2").body, response.body)
+
+    def test_stream_bytes(self):
+        chunks = []
+        response = self.fetch("/stream-bytes/100?seed=1&chunk_size=30",
+                              streaming_callback=chunks.append)
+        self.assertEqual(response.code, 200)
+        self.assertTrue("Content-Length" not in response.headers)
+        self.assertEqual(b"".join(chunks), self._app.bytes_pool.get_buffer(1)[:100])
+
+    def test_invalid_chunk_size(self):
+        self.assertEqual(self.fetch("/bytes/10?chunk_size=-1").code, 400)
+        self.assertEqual(self.fetch("/stream-bytes/10?chunk_size=-1").code, 400)
+        self.assertEqual(self.fetch("/stream-bytes/10?chunk_size=x").code, 400)
+
+
+class RangeHandlerTestCase(HandlerTestCase):
+
+    def content(self, start, stop):
+        return b"".join(pattern_chunks(start, stop))
+
+    def test_full(self):
+        response = self.fetch("/range/100")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+        self.assertEqual(response.headers["Etag"], '"range-100"')
+        self.assertEqual(response.body, self.content(0, 100))
+
+    def test_single_range(self):
+        response = self.fetch("/range/100", headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(response.headers["Content-Length"], "10")
+        self.assertEqual(response.body, self.content(10, 20))
+
+        response = self.fetch("/range/100", headers={"Range": "bytes=-5"})
+        self.assertEqual(response.headers["Content-Range"], "bytes 95-99/100")
+        self.assertEqual(response.body, self.content(95, 100))
+
+    def test_multiple_ranges(self):
+        response = self.fetch("/range/100", headers={"Range": "bytes=0-4, 90-"})
+        self.assertEqual(response.code, 206)
+        content_type, boundary = response.headers["Content-Type"].split("; boundary=")
+        self.assertEqual(content_type, "multipart/byteranges")
+        self.assertEqual(int(response.headers["Content-Length"]), len(response.body))
+
+        parts = response.body.split(utf8("\r\n--%s" % boundary))
+        self.assertEqual(parts[0], b"")
+        self.assertEqual(parts[-1], b"--\r\n")
+        self.assertEqual([x.split(b"\r\n\r\n", 1) for x in parts[1:-1]],
+                         [[b"\r\nContent-Type: application/octet-stream\r\n"
+                           b"Content-Range: bytes 0-4/100", self.content(0, 5)],
+                          [b"\r\nContent-Type: application/octet-stream\r\n"
+                           b"Content-Range: bytes 90-99/100", self.content(90, 100)]])
+
+    def test_not_satisfiable(self):
+        response = self.fetch("/range/100", headers={"Range": "bytes=100-200"})
+        self.assertEqual(response.code, 416)
+        self.assertEqual(response.headers["Content-Range"], "bytes */100")
+
+    def test_if_range(self):
+        response = self.fetch("/range/100", headers={"Range": "bytes=10-19",
+                                                     "If-Range": '"range-100"'})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.body, self.content(10, 20))
+
+        # Changed representation, whole content is returned
+        response = self.fetch("/range/100", headers={"Range": "bytes=10-19",
+                                                     "If-Range": '"range-99"'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, self.content(0, 100))
+
+    def test_head(self):
+        response = self.fetch("/range/100", method="HEAD")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Length"], "100")
+        self.assertEqual(response.body, b"")
+
+        response = self.fetch("/range/100", method="HEAD", headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.code, 206)
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/100")
+        self.assertEqual(response.headers["Content-Length"], "10")
+        self.assertEqual(response.body, b"")
+
+
+class GZipHandlerTestCase(HandlerTestCase):
+
+    settings = {"compress_cache_max_size": 1000, "max_compress_size": 10000}
+
+    def fetch_compressed(self, path):
+        response = self.fetch(path, decompress_response=False)
+        self.assertEqual(response.code, 200)
+        encoding = response.headers["Content-Encoding"]
+        if encoding == "gzip":
+            body = gzip.GzipFile(fileobj=BytesIO(response.body)).read()
+        else:
+            body = zlib.decompress(response.body)
+        return response, encoding, json.loads(body.decode("utf-8"))
+
+    def test_gzip(self):
+        response, encoding, data = self.fetch_compressed("/gzip")
+        self.assertEqual(encoding, "gzip")
+        self.assertTrue(data["gzipped"])
+        self.assertEqual(response.headers["Content-Length"], str(len(response.body)))
+
+    def test_deflate(self):
+        response, encoding, data = self.fetch_compressed("/deflate?level=1")
+        self.assertEqual(encoding, "deflate")
+        self.assertTrue(data["deflated"])
+
+    def test_padding(self):
+        # Cached static prefix and compressed on the fly
+        for size in (500, 500, 5000):
+            for path in ("/gzip", "/deflate"):
+                response, encoding, data = self.fetch_compressed("%s?size=%d" % (path, size))
+                self.assertEqual(data["padding"].encode("ascii"),
+                                 b"".join(pattern_chunks(0, size)))
+
+    def test_limits(self):
+        for query in ("size=10001", "size=-1", "size=x", "level=10", "level=x"):
+            self.assertEqual(self.fetch("/gzip?" + query).code, 400)
+            self.assertEqual(self.fetch("/deflate?" + query).code, 400)
+
+
+class DripHandlerTestCase(HandlerTestCase):
+
+    settings = {"max_drip_size": 1024 * 1024, "max_drip_duration": 0.3, "max_delay": 0.2}
+
+    def test_drip(self):
+        started = time.time()
+        chunks = []
+        response = self.fetch("/drip?numbytes=100&duration=0.25", streaming_callback=chunks.append)
+        self.assertEqual(response.code, 200)
+        self.assertTrue(time.time() - started >= 0.2)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(response.headers["Content-Length"], "100")
+        self.assertEqual(b"".join(chunks), b"".join(pattern_chunks(0, 100)))
+
+        started = time.time()
+        response = self.fetch("/drip?numbytes=10&duration=0&delay=0.15")
+        self.assertTrue(time.time() - started >= 0.15)
+        self.assertEqual(response.body, b"abcdefghij")
+
+    def test_whole_body(self):
+        # Written by slices between flushes
+        response = self.fetch("/drip?numbytes=%d&duration=0" % (1024 * 1024))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(response.body), 1024 * 1024)
+
+    def test_code(self):
+        response = self.fetch("/drip?numbytes=5&duration=0&code=201")
+        self.assertEqual((response.code, response.body), (201, b"abcde"))
+        response = self.fetch("/drip?numbytes=5&duration=0&code=204")
+        self.assertEqual((response.code, response.body), (204, b""))
+        for code in (100, 101, 199):
+            response = self.fetch("/drip?numbytes=5&duration=0&code=%d" % code)
+            self.assertEqual(response.code, 400)
+
+    def test_limits(self):
+        started = time.time()
+        self.assertEqual(self.fetch("/drip?numbytes=10&duration=30&delay=30").code, 200)
+        self.assertTrue(time.time() - started < 5)
+
+        for query in ("numbytes=%d" % (1024 * 1024 + 1), "numbytes=-1", "numbytes=x",
+                      "code=999", "duration=x", "duration=nan", "delay=nan",
+                      "duration=inf", "delay=-inf"):
+            self.assertEqual(self.fetch("/drip?" + query).code, 400)
+
+
+class DigestAuthHandlerTestCase(HandlerTestCase):
+
+    uri = "/digest-auth/auth/user/passwd"
+
+    def challenge(self, uri=None):
+        response = self.fetch(uri or self.uri)
+        self.assertEqual(response.code, 401)
+        return parse_authenticate_header(response.headers["WWW-Authenticate"])
+
+    def authorize(self, challenge, nc, password="passwd", uri=None):
+        uri = uri or self.uri
+        credentials = {"username": "user", "realm": challenge["realm"],
+                       "nonce": challenge["nonce"], "uri": uri, "qop": "auth",
+                       "nc": nc, "cnonce": "0a4f113b", "opaque": challenge["opaque"],
+                       "algorithm": challenge["algorithm"]}
+        credentials["response"] = response(credentials, password,
+                                           {"method": "GET", "uri": uri, "body": b""})
+        header = "Digest " + ", ".join(
+            '%s="%s"' % (k, v) if k not in ("qop", "nc", "algorithm") else "%s=%s" % (k, v)
+            for k, v in credentials.items())
+        return self.fetch(uri, headers={"Authorization": header})
+
+    def test_authenticated(self):
+        challenge = self.challenge()
+        self.assertTrue("stale" not in challenge)
+        result = self.authorize(challenge, "00000001")
+        self.assertEqual(result.code, 200)
+        self.assertTrue(json.loads(result.body)["authenticated"])
+        self.assertEqual(self.authorize(challenge, "00000002").code, 200)
+
+    def test_replay(self):
+        challenge = self.challenge()
+        self.assertEqual(self.authorize(challenge, "00000001").code, 200)
+
+        # The same nonce count again gets new challenge, not fresh nonce notice
+        result = self.authorize(challenge, "00000001")
+        self.assertEqual(result.code, 401)
+        self.assertTrue("stale" not in parse_authenticate_header(result.headers["WWW-Authenticate"]))
+
+    def test_stale(self):
+        # Nonces expire as soon as they are issued
+        self._app.nonces.ttl = -1
+        challenge = self.challenge()
+        self._app.nonces.ttl = 300
+
+        result = self.authorize(challenge, "00000001")
+        self.assertEqual(result.code, 401)
+        challenge = parse_authenticate_header(result.headers["WWW-Authenticate"])
+        self.assertEqual(challenge["stale"], "true")
+
+        # Client retries with fresh nonce without asking user
+        self.assertEqual(self.authorize(challenge, "00000001").code, 200)
+
+    def test_algorithms(self):
+        for algorithm in ("MD5-sess", "SHA-256", "SHA-256-sess"):
+            uri = "%s/%s" % (self.uri, algorithm)
+            challenge = self.challenge(uri)
+            self.assertEqual(challenge["algorithm"], algorithm)
+            self.assertEqual(self.authorize(challenge, "00000001", uri=uri).code, 200)
+            self.assertEqual(self.authorize(self.challenge(uri), "00000001", "other", uri).code, 403)
+
+    def test_wrong_password(self):
+        self.assertEqual(self.authorize(self.challenge(), "00000001", "other").code, 403)
+
+
+class OAuthHandlerTestCase(HandlerTestCase):
+
+    def protected_resource(self, nonce, timestamp=None, signature="csecret&tsecret"):
+        query = urlencode([("oauth_consumer_key", "ckey"),
+                           ("oauth_nonce", nonce),
+                           ("oauth_signature", signature),
+                           ("oauth_signature_method", "PLAINTEXT"),
+                           ("oauth_timestamp", str(timestamp or int(time.time())))])
+        return self.fetch("/oauth/1.0/protected_resource/csecret/tsecret?" + query)
+
+    def test_protected_resource(self):
+        response = self.protected_resource("nonce1")
+        self.assertEqual(response.code, 200)
+        self.assertTrue(json.loads(response.body)["success"])
+
+        self.assertEqual(self.protected_resource("nonce2", signature="csecret&other").code, 403)
+        self.assertEqual(self.protected_resource("nonce3", int(time.time()) - 1000).code, 401)
+
+    def test_nonce_replay(self):
+        timestamp = int(time.time())
+        self.assertEqual(self.protected_resource("nonce", timestamp).code, 200)
+
+        response = self.protected_resource("nonce", timestamp)
+        self.assertEqual(response.code, 401)
+        self.assertEqual(json.loads(response.body)["oauth_problem"], "nonce_used")
+        self.assertTrue("nonce_used" in response.headers["WWW-Authenticate"])
+
+        # Nonce is unique per timestamp
+        self.assertEqual(self.protected_resource("other", timestamp).code, 200)
+        self.assertEqual(self.protected_resource("nonce", timestamp - 1).code, 200)
+
+
+class OAuth2HandlerTestCase(HandlerTestCase):
+
+    def token(self, **kwargs):
+        kwargs.setdefault("client_id", "client")
+        kwargs.setdefault("client_secret", "secret")
+        return self.fetch_json("/oauth/2.0/token/client/secret", method="POST",
+                               body=urlencode(kwargs))
+
+    def resource(self, token):
+        headers = {"Authorization": "Bearer " + token} if token else {}
+        return self.fetch("/oauth/2.0/protected_resource", headers=headers)
+
+    def test_client_credentials(self):
+        response, data = self.token(grant_type="client_credentials", scope="read")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+        self.assertEqual((data["token_type"], data["scope"]), ("Bearer", "read"))
+        self.assertTrue("refresh_token" not in data)
+
+        response = self.resource(data["access_token"])
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["claims"]["client_id"], "client")
+
+        response = self.resource(None)
+        self.assertEqual(response.code, 401)
+        self.assertTrue(response.headers["WWW-Authenticate"].startswith("Bearer"))
+        self.assertEqual(self.resource(data["access_token"] + "x").code, 401)
+
+    def test_refresh_token(self):
+        response, data = self.token(grant_type="password", username="user", password="passwd")
+        self.assertEqual(response.code, 200)
+
+        # Refresh token isn't access token
+        response = self.resource(data["refresh_token"])
+        self.assertEqual(response.code, 401)
+        self.assertTrue("invalid_token" in response.headers["WWW-Authenticate"])
+
+        response, data = self.token(grant_type="refresh_token", refresh_token=data["refresh_token"])
+        self.assertEqual(response.code, 200)
+        response = self.resource(data["access_token"])
+        self.assertEqual(json.loads(response.body)["claims"]["sub"], "user")
+
+    def test_errors(self):
+        response, data = self.token(grant_type="client_credentials", client_secret="other")
+        self.assertEqual((response.code, data["error"]), (401, "invalid_client"))
+        response, data = self.token(grant_type="implicit")
+        self.assertEqual((response.code, data["error"]), (400, "unsupported_grant_type"))
+        response, data = self.token(grant_type="password", username="user")
+        self.assertEqual((response.code, data["error"]), (400, "invalid_request"))
+        response, data = self.token(grant_type="refresh_token", refresh_token="x")
+        self.assertEqual((response.code, data["error"]), (400, "invalid_grant"))
+        response, data = self.token(grant_type="client_credentials", expires_in="0")
+        self.assertEqual((response.code, data["error"]), (400, "invalid_request"))
+
+
+class MetricsHandlerTestCase(HandlerTestCase):
+
+    def get_app(self):
+        application = super(MetricsHandlerTestCase, self).get_app()
+        application.metrics.allocate(2)
+        return application
+
+    def test_metrics(self):
+        # Requests served by two workers are summed up
+        for worker_id in (0, 1):
+            self._app.metrics.worker_id = worker_id
+            self.assertEqual(self.fetch("/get").code, 200)
+            self.assertEqual(self.fetch("/status/404").code, 404)
+        self.fetch("/status/404", method="POST", body="")
+
+        response = self.fetch("/metrics")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers["Content-Type"], "text/plain; version=0.0.4")
+
+        output = response.body.decode("utf-8")
+        for line in ('httphq_requests_total{route="/get",method="GET",code="200"} 2',
+                     'httphq_requests_total{route="/status/{status_code}",method="GET",code="404"} 2',
+                     'httphq_requests_total{route="/status/{status_code}",method="POST",code="405"} 1',
+                     'httphq_request_duration_seconds_bucket{route="/get",method="GET",le="+Inf"} 2',
+                     'httphq_request_duration_seconds_count{route="/get",method="GET"} 2'):
+            self.assertTrue(line in output.splitlines(), line)
+
+        # Request to /metrics itself is recorded when it's finished
+        self.assertTrue('route="/metrics"' not in output)
+        self.assertTrue('route="/metrics"' in self.fetch("/metrics").body.decode("utf-8"))
+
+
+class BinsHandlerTestCase(HandlerTestCase):
+
+    def test_bin(self):
+        response, data = self.fetch_json("/bins?capacity=2", method="POST", body="")
+        self.assertEqual(response.code, 201)
+        self.assertEqual(data["capacity"], 2)
+        self.assertEqual(data["url"], self.get_url("/bin/" + data["id"]))
+
+        for x in range(3):
+            response = self.fetch("/bin/%s?x=%d" % (data["id"], x), method="POST", body="body")
+            self.assertEqual(response.code, 200)
+
+        response, data = self.fetch_json("/bins/" + data["id"])
+        self.assertEqual(data["count"], 2)
+        self.assertEqual([(x["method"], x["args"]["x"], x["body"]) for x in data["requests"]],
+                         [("POST", ["2"], "body"), ("POST", ["1"], "body")])
+
+        self.assertEqual(self.fetch("/bins/" + data["id"], method="DELETE").code, 200)
+        self.assertEqual(self.fetch("/bins/" + data["id"]).code, 404)
+        self.assertEqual(self.fetch("/bin/" + data["id"]).code, 404)
+
+    def test_capacity(self):
+        for capacity in ("-5", "0", "x"):
+            response = self.fetch("/bins?capacity=" + capacity, method="POST", body="")
+            self.assertEqual(response.code, 400)
+
+        response, data = self.fetch_json("/bins", method="POST", body="")
+        self.assertEqual(data["capacity"], self._app.bins.default_capacity)
+
+        response, data = self.fetch_json("/bins")
+        self.assertEqual(len(data["bins"]), 1)
+        self.assertEqual(data["max_bins"], self._app.bins.max_bins)
+
+
+class AdmissionHandlerTestCase(HandlerTestCase):
+
+    def get_app(self):
+        application = super(AdmissionHandlerTestCase, self).get_app()
+        application.admission.max_body_size = 100
+        return application
+
+    @gen_test
+    def send(self, head, chunks):
+        stream = IOStream(socket.socket())
+        yield stream.connect(("127.0.0.1", self.get_http_port()))
+        yield stream.write(head + b"".join(utf8("%x\r\n" % len(x)) + x + b"\r\n" for x in chunks))
+        response = yield stream.read_until_close()
+        raise gen.Return(response)
+
+    def test_chunked_body(self):
+        head = b"POST /post HTTP/1.1\r\nHost: test\r\nConnection: close\r\n" \
+               b"Transfer-Encoding: chunked\r\n\r\n"
+        response = self.send(head, [b"x" * 60, b"x" * 40, b""])
+        self.assertTrue(response.startswith(b"HTTP/1.1 201 "))
+
+        response = self.send(head, [b"x" * 60, b"x" * 60, b""])
+        self.assertTrue(response.startswith(b"HTTP/1.1 413 "))
+        self.assertTrue(b"\r\nRetry-After: 1\r\n" in response)
+        self.assertEqual(self._app.admission.rejected["body"], 1)
+        self.assertEqual(self._app.admission.in_flight, 0)
+
+    def test_content_length(self):
+        response = self.fetch("/post", method="POST", body="x" * 101)
+        self.assertEqual(response.code, 413)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+
+class RateLimitHandlerTestCase(HandlerTestCase):
+
+    def test_ratelimit(self):
+        codes = [self.fetch("/ratelimit/1/2").code for i in range(3)]
+        self.assertEqual(codes, [200, 200, 429])
+
+        response, data = self.fetch_json("/ratelimit/1/5?cost=5")
+        self.assertEqual((response.code, data["remaining"]), (200, 0))
+        self.assertEqual(response.headers["RateLimit-Limit"], "5")
+
+        response, data = self.fetch_json("/ratelimit/1/5?cost=5")
+        self.assertEqual(response.code, 429)
+        self.assertEqual(response.headers["Retry-After"], "5")
+
+    def test_invalid(self):
+        for path in ("/ratelimit/1/5?cost=6", "/ratelimit/1/5?cost=0", "/ratelimit/1/5?cost=x",
+                     "/ratelimit/0/5", "/ratelimit/1/0"):
+            self.assertEqual(self.fetch(path).code, 400)
+
+
+def ws_frame(opcode, payload, fin=True):
+    """Masked client WebSocket frame with short payload
+    """
+    mask = b"mask"
+    masked = bytearray(x ^ y for x, y in zip(bytearray(payload), bytearray(mask * len(payload))))
+    return bytes(bytearray([opcode | (0x80 if fin else 0), 0x80 | len(payload)])) + mask + bytes(masked)
+
+
+class WebSocketTestCase(HandlerTestCase):
+
+    settings = {"websocket_max_message_size": 1024, "max_delay": 0.2}
+
+    def ws_url(self, path):
+        return "ws://127.0.0.1:%d%s" % (self.get_http_port(), path)
+
+    @gen_test
+    def test_echo(self):
+        ws = yield websocket_connect(self.ws_url("/ws/echo"))
+        ws.write_message(u"привет")
+        message = yield ws.read_message()
+        self.assertEqual(message, u"привет")
+
+        ws.write_message(b"\x00\xff" * 512, binary=True)
+        message = yield ws.read_message()
+        self.assertEqual(message, b"\x00\xff" * 512)
+
+        # Message over max size closes connection
+        ws.write_message(b"x" * 1025, binary=True)
+        message = yield ws.read_message()
+        self.assertEqual(message, None)
+        self.assertEqual(ws.close_code, 1009)
+        ws.close()
+
+    @gen_test
+    def test_frames(self):
+        stream = IOStream(socket.socket())
+        yield stream.connect(("127.0.0.1", self.get_http_port()))
+        yield stream.write(b"GET /ws/echo HTTP/1.1\r\nHost: test\r\nUpgrade: websocket\r\n"
+                           b"Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+                           b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n\r\n")
+        head = yield stream.read_until(b"\r\n\r\n")
+        self.assertTrue(head.startswith(b"HTTP/1.1 101 "))
+        self.assertEqual(self._app.admission.in_flight, 0)
+
+        # Fragments are echoed as one message, ping is answered between them
+        yield stream.write(ws_frame(0x1, b"hel", fin=False) + ws_frame(0x9, b"ping") +
+                           ws_frame(0x0, b"lo"))
+        pong = yield stream.read_bytes(6)
+        self.assertEqual(pong, b"\x8a\x04ping")
+        message = yield stream.read_bytes(7)
+        self.assertEqual(message, b"\x81\x05hello")
+
+        yield stream.write(ws_frame(0x8, b"\x03\xe8"))
+        close = yield stream.read_bytes(4)
+        self.assertEqual(close, b"\x88\x02\x03\xe8")
+        stream.close()
+
+    @gen_test
+    def test_stream(self):
+        ws = yield websocket_connect(self.ws_url("/ws/stream/5?size=100&seed=1"))
+        messages = []
+        while True:
+            message = yield ws.read_message()
+            if message is None:
+                break
+            messages.append(message)
+        self.assertEqual(len(messages), 5)
+        self.assertEqual(set(messages), set([self._app.bytes_pool.get_buffer(1)[:100]]))
+        self.assertEqual(ws.close_code, 1000)
+        ws.close()
+
+        ws = yield websocket_connect(self.ws_url("/ws/stream/0"))
+        message = yield ws.read_message()
+        self.assertEqual((message, ws.close_code), (None, 1000))
+        ws.close()
+
+    @gen_test
+    def test_interval(self):
+        started = time.time()
+        ws = yield websocket_connect(self.ws_url("/ws/stream/4?size=10&interval=0.1"))
+        count = 0
+        while (yield ws.read_message()) is not None:
+            count += 1
+        self.assertEqual(count, 4)
+        ws.close()
+        self.assertTrue(0.25 <= time.time() - started < 2)
+
+        # Interval is capped by max_delay
+        started = time.time()
+        ws = yield websocket_connect(self.ws_url("/ws/stream/2?size=10&interval=30"))
+        while (yield ws.read_message()) is not None:
+            pass
+        self.assertTrue(time.time() - started < 2)
+        ws.close()
+
+    @gen_test
+    def test_client_close(self):
+        ws = yield websocket_connect(self.ws_url("/ws/stream/100?interval=0.2"))
+        message = yield ws.read_message()
+        self.assertEqual(len(message), 1024)
+        ws.close(1000)
+        message = yield ws.read_message()
+        self.assertEqual(message, None)
+        yield gen.sleep(0.3)
+        self.assertEqual(self._app.admission.in_flight, 0)
+
+    def test_limits(self):
+        for query in ("size=1025", "size=-1", "size=x", "interval=-1", "interval=x",
+                      "interval=nan", "seed=x"):
+            response = self.fetch("/ws/stream/1?" + query, headers={
+                "Upgrade": "websocket", "Connection": "Upgrade", "Sec-WebSocket-Version": "13",
+                "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ=="})
+            self.assertEqual(response.code, 400)
+
+        # Plain HTTP request isn't upgraded
+        self.assertEqual(self.fetch("/ws/echo").code, 400)
+
+
+MANAGE_SCRIPT = "import sys; from httphq.manage import main; sys.argv[0] = 'httphq'; main()"
+
+# Worker 0 crashes and can't be restarted, worker 1 runs until killed.
+# After supervisor gives up no child process must be left.
+SUPERVISOR_SCRIPT = """
+import os, sys, time, errno
+from httphq.manage import Supervisor
+
+try:
+    worker_id = Supervisor(2, max_restarts=0).start()
+except RuntimeError:
+    try:
+        os.waitpid(-1, os.WNOHANG)
+    except OSError:
+        assert sys.exc_info()[1].errno == errno.ECHILD
+        sys.stdout.write("no children")
+    sys.exit(0)
+
+if worker_id == 0:
+    os._exit(1)
+time.sleep(60)
+os._exit(0)
+"""
+
+
+class ManageTestCase(unittest.TestCase):
+    """Run management commands in separate process
+    """
+
+    def free_port(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def wait_port(self, port, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                return socket.create_connection(("127.0.0.1", port), timeout=1)
+            except socket.error:
+                time.sleep(0.1)
+        self.fail("Server didn't start on port {0}".format(port))
+
+    def test_server_start(self):
+        port = self.free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-c", MANAGE_SCRIPT, "server", "start",
+             "-p", str(port), "-w", "2"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # Don't hang test run if server ignores SIGTERM
+        watchdog = threading.Timer(20, server.kill)
+        watchdog.start()
+        try:
+            sock = self.wait_port(port)
+            sock.sendall(b"GET /get HTTP/1.0\r\nHost: localhost\r\n\r\n")
+            data = b""
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            self.assertTrue(data.startswith(b"HTTP/1.1 200"))
+
+            server.send_signal(signal.SIGTERM)
+            output = server.communicate()[0]
+        finally:
+            watchdog.cancel()
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+        self.assertEqual(server.returncode, 0)
+        self.assertTrue(b"Starting 2 workers" in output)
+
+    def test_supervisor_gives_up(self):
+        output = subprocess.check_output([sys.executable, "-c", SUPERVISOR_SCRIPT])
+        self.assertEqual(output, b"no children")
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(UtilsTestCase))
+    suite.addTest(unittest.makeSuite(BenchTestCase))
+    suite.addTest(unittest.makeSuite(MetricsTestCase))
+    suite.addTest(unittest.makeSuite(BinsTestCase))
+    suite.addTest(unittest.makeSuite(NonceStoreTestCase))
+    suite.addTest(unittest.makeSuite(ReplayCacheTestCase))
+    suite.addTest(unittest.makeSuite(OAuthSignatureTestCase))
+    suite.addTest(unittest.makeSuite(TokensTestCase))
+    suite.addTest(unittest.makeSuite(RoutingTestCase))
+    suite.addTest(unittest.makeSuite(EncodersTestCase))
+    suite.addTest(unittest.makeSuite(AccessLogTestCase))
+    suite.addTest(unittest.makeSuite(AdmissionTestCase))
+    suite.addTest(unittest.makeSuite(RateLimiterTestCase))
+    suite.addTest(unittest.makeSuite(ChaosTestCase))
+    suite.addTest(unittest.makeSuite(FaultyConnectionTestCase))
+    suite.addTest(unittest.makeSuite(NetworkTestCase))
+    suite.addTest(unittest.makeSuite(HomeHandlerTestCase))
+    suite.addTest(unittest.makeSuite(DelayHandlerTestCase))
+    suite.addTest(unittest.makeSuite(StreamHandlerTestCase))
+    suite.addTest(unittest.makeSuite(BytesHandlerTestCase))
+    suite.addTest(unittest.makeSuite(RangeHandlerTestCase))
+    suite.addTest(unittest.makeSuite(GZipHandlerTestCase))
+    suite.addTest(unittest.makeSuite(DripHandlerTestCase))
+    suite.addTest(unittest.makeSuite(DigestAuthHandlerTestCase))
+    suite.addTest(unittest.makeSuite(OAuthHandlerTestCase))
+    suite.addTest(unittest.makeSuite(OAuth2HandlerTestCase))
+    suite.addTest(unittest.makeSuite(MetricsHandlerTestCase))
+    suite.addTest(unittest.makeSuite(BinsHandlerTestCase))
+    suite.addTest(unittest.makeSuite(AdmissionHandlerTestCase))
+    suite.addTest(unittest.makeSuite(RateLimitHandlerTestCase))
+    suite.addTest(unittest.makeSuite(WebSocketTestCase))
+    suite.addTest(unittest.makeSuite(ManageTestCase))
     return suite
 
 